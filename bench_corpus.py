@@ -0,0 +1,257 @@
+"""
+画像コーパスのベンチマーク — 大きさ・形式・色モード・縦横比を変えた合成画像で
+myCrypter のパイプラインを計測する。
+
+各画像について file2image → executeEncryption → image2file を繰り返し実行し、
+ステージごとの所要時間の中央値とメモリのピーク（RSSの最大値の増加）を JSON に保存する。
+--baseline を指定すると、以前の結果と比べて閾値を超えて遅く（または大きく）なった
+ステージを報告する。
+
+encryptByID・encryptByLabel・encryptByTime は描画操作を記録するだけで、実際の描画は
+executeEncryption の中で行う。その内訳は crypt/render_mask（IDとラベルの層をまとめて
+描く）と crypt/encryptByTime_draw（日時）として、中央値だけを載せる。
+
+実行:
+    python bench_corpus.py --sizes 256,1024,4000,7680 --out corpus.json
+    python bench_corpus.py --baseline corpus.json --threshold 0.15
+"""
+
+import argparse
+import itertools
+import json
+import sys
+from io import BytesIO
+from typing import NamedTuple, Optional
+
+import discord
+
+from bench_e2e import makeImage, reportHeader
+from main import file2image, image2file
+from myCrypter import myCrypter
+from perf import StageTimer, current_rss_kb, metrics, peak_rss_kb, reset_peak_rss
+
+STAGES = ("file2image", "executeEncryption", "image2file")
+
+# 形式ごとに保存できる色モード（JPEG・WebPはパレットを持てない）
+FORMAT_MODES = {
+    "png": ("RGB", "RGBA", "P", "L"),
+    "jpeg": ("RGB", "L"),
+    "webp": ("RGB", "RGBA"),
+}
+
+
+class CorpusConfig(NamedTuple):
+    """コーパスとベンチマークの条件。"""
+
+    sizes: tuple[int, ...] = (256, 1024, 4000)
+    """長辺の画素数（スタンプ程度から 8K=7680 まで）"""
+    aspects: tuple[tuple[int, int], ...] = ((1, 1), (4, 3), (9, 16))
+    formats: tuple[str, ...] = ("png", "jpeg", "webp")
+    modes: tuple[str, ...] = ("RGB", "RGBA", "P", "L")
+    repeats: int = 3
+    profile: str = "fast_png"
+    """image2file のエンコード設定"""
+    seed: int = 0
+
+
+class CorpusImage(NamedTuple):
+    name: str
+    size: tuple[int, int]
+    format: str
+    mode: str
+    data: bytes
+
+
+def generateCorpus(config: CorpusConfig):
+    """条件の組み合わせごとに合成画像を1枚ずつ作る（保存できない組み合わせは除く）。
+
+    8Kの画像は1枚で数百MBになるので、リストにせず1枚ずつ返す。
+    """
+    for i, (side, (aw, ah), format, mode) in enumerate(
+        itertools.product(config.sizes, config.aspects, config.formats, config.modes)
+    ):
+        if mode not in FORMAT_MODES[format]:
+            continue
+        if aw >= ah:
+            size = (side, max(1, side * ah // aw))
+        else:
+            size = (max(1, side * aw // ah), side)
+        yield CorpusImage(
+            f"{size[0]}x{size[1]}_{format}_{mode}",
+            size,
+            format,
+            mode,
+            makeImage(size, config.seed + i, format, mode),
+        )
+
+
+def _pipeline(image: CorpusImage, num: int, profile: str, timed: bool):
+    """1回分のパイプライン。timed なら各ステージを StageTimer で計測する。
+
+    timed でなければ、ステージごとのRSSの最大値の増加（MB）を返す。Pillowなど
+    Cの確保も含むよう、tracemalloc ではなく VmHWM をステージごとに戻して測る。
+    """
+    peaks = {}
+
+    def stage(name: str, fn):
+        if timed:
+            with StageTimer(f"corpus/{name}"):
+                return fn()
+        reset_peak_rss()
+        base = current_rss_kb()
+        result = fn()
+        peaks[name] = (peak_rss_kb() - base) / 1024
+        return result
+
+    file = discord.File(BytesIO(image.data), filename=f"image.{image.format}")
+    im = stage("file2image", lambda: file2image(file))
+    crypter = myCrypter(im)
+    # 閲覧者ごとに番号を変え、マスクキャッシュに当たらない（初回閲覧の）経路を測る
+    crypter.encryptByID(num).encryptByLabel(f"user{num}").encryptByTime()
+    encrypted = stage("executeEncryption", crypter.executeEncryption)
+    stage("image2file", lambda: image2file(encrypted, profile))
+    return peaks
+
+
+def benchImage(image: CorpusImage, config: CorpusConfig, num: int) -> dict:
+    """1枚の画像について、ステージごとの中央値（ms）とメモリのピーク（MB）を返す。
+
+    所要時間は repeats 回測り、メモリはもう1回別に測る（RSSの最大値を戻せない
+    環境ではメモリは測らない）。executeEncryption の内訳（crypt/ のステージ）も
+    中央値を載せる。
+    """
+    metrics.drain()
+    for r in range(config.repeats):
+        _pipeline(image, num + r, config.profile, timed=True)
+    histograms, _ = metrics.drain()
+
+    peaks = {}
+    if reset_peak_rss():
+        peaks = _pipeline(image, num + config.repeats, config.profile, timed=False)
+    metrics.drain()
+
+    stages = {}
+    for name in STAGES:
+        stages[name] = {
+            "median_ms": round(histograms[f"corpus/{name}"].quantile(0.5), 3)
+        }
+        if name in peaks:
+            stages[name]["peak_mb"] = round(peaks[name], 2)
+    for name, h in sorted(histograms.items()):
+        if name.startswith("crypt/"):
+            stages[name] = {"median_ms": round(h.quantile(0.5), 3)}
+    return {
+        "name": image.name,
+        "size": image.size,
+        "format": image.format,
+        "mode": image.mode,
+        "bytes": len(image.data),
+        "total_ms": round(sum(stages[name]["median_ms"] for name in STAGES), 3),
+        "peak_mb": round(max(peaks.values()), 2) if peaks else None,
+        "stages": stages,
+    }
+
+
+def run(config: CorpusConfig, out: Optional[str] = None, log=print) -> dict:
+    """コーパス全体を計測し、結果を返す（out を指定するとJSONで保存する）。"""
+    cases = []
+    for i, image in enumerate(generateCorpus(config)):
+        case = benchImage(image, config, i * (config.repeats + 1) + 1)
+        peak = "-" if case["peak_mb"] is None else f"{case['peak_mb']:.1f}"
+        log(f"{case['name']:<28} {case['total_ms']:>10.1f}ms peak {peak:>8}MB")
+        cases.append(case)
+    report = {**reportHeader(config), "cases": cases}
+    if out:
+        with open(out, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+class Regression(NamedTuple):
+    case: str
+    stage: str
+    metric: str
+    baseline: float
+    current: float
+
+    @property
+    def ratio(self) -> float:
+        return self.current / self.baseline
+
+
+def compare(
+    baseline: dict,
+    current: dict,
+    threshold: float = 0.1,
+    min_ms: float = 1.0,
+    min_mb: float = 1.0,
+) -> list[Regression]:
+    """baseline より (1 + threshold) 倍を超えて悪化したステージを返す。
+
+    ノイズで誤検出しないよう、baseline が min_ms・min_mb 未満の値は比べない。
+    片方にしかない画像は無視する。
+    """
+    previous = {case["name"]: case for case in baseline["cases"]}
+    regressions = []
+    for case in current["cases"]:
+        old = previous.get(case["name"])
+        if old is None:
+            continue
+        for stage, values in case["stages"].items():
+            for metric, floor in (("median_ms", min_ms), ("peak_mb", min_mb)):
+                before = old["stages"].get(stage, {}).get(metric)
+                after = values.get(metric)
+                if before is None or after is None or before < floor:
+                    continue
+                if after > before * (1 + threshold):
+                    regressions.append(
+                        Regression(case["name"], stage, metric, before, after)
+                    )
+    return regressions
+
+
+def _parseList(cast):
+    return lambda text: tuple(cast(v) for v in text.split(",") if v)
+
+
+def _parseAspect(text: str) -> tuple[int, int]:
+    w, h = text.split(":")
+    return int(w), int(h)
+
+
+def _parseArgs(argv: Optional[list[str]] = None):
+    defaults = CorpusConfig()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=_parseList(int), default=defaults.sizes)
+    parser.add_argument(
+        "--aspects", type=_parseList(_parseAspect), default=defaults.aspects
+    )
+    parser.add_argument(
+        "--formats", type=_parseList(str.lower), default=defaults.formats
+    )
+    parser.add_argument("--modes", type=_parseList(str.upper), default=defaults.modes)
+    parser.add_argument("--repeats", type=int, default=defaults.repeats)
+    parser.add_argument("--profile", default=defaults.profile)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--out", help="結果を保存するJSONファイル")
+    parser.add_argument("--baseline", help="比較する以前の結果のJSONファイル")
+    parser.add_argument("--threshold", type=float, default=0.1, help="悪化とみなす割合")
+    args = vars(parser.parse_args(argv))
+    options = {k: args.pop(k) for k in ("out", "baseline", "threshold")}
+    return CorpusConfig(**args), options
+
+
+if __name__ == "__main__":
+    config, options = _parseArgs()
+    report = run(config, options["out"])
+    if options["baseline"]:
+        with open(options["baseline"]) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, options["threshold"])
+        for r in regressions:
+            print(
+                f"REGRESSION {r.case} {r.stage} {r.metric}: "
+                f"{r.baseline:.1f} -> {r.current:.1f} ({r.ratio:.2f}x)"
+            )
+        print(f"{len(regressions)} regression(s) over {options['threshold']:.0%}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,636 @@
+"""
+エンドツーエンドのベンチマーク — Discord・PostgreSQL なしで、投稿と閲覧の流れを
+通して計測する。
+
+main.py の processImageUpload・myUploader.upload・processButtonclickImageView を、
+discord.py の Thread/Message/Attachment/Interaction を真似た偽物（遅延を指定可能）と
+メモリ上の UserIdMapper/ImageCacheMapper に対して実行する。暗号化のプロセスプールと
+元画像キャッシュは本物を使う。
+
+N人 × M投稿 × K枚 の閲覧の集中（クリックの嵐）を再生し、スループット・遅延の分位点・
+ピークRSSを JSON に保存するので、コミット間で比較できる。
+
+実行:
+    python bench_e2e.py --users 20 --posts 5 --images 3 --size 1280x960 \
+        --out result.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import tempfile
+import time
+from io import BytesIO
+from typing import Callable, NamedTuple, Optional
+
+import numpy as np
+from PIL import Image
+
+# main.py は起動時に環境変数を読むので、import より前に既定値を入れておく
+_ENV_DEFAULTS = {
+    "ID_ROOM_BOT": "1",
+    "ID_ROOM_SHOMIN": "2",
+    "ID_ROOM_PIC": "3",
+    "PERF_LOG_LEVEL": "WARNING",
+}
+_saved_env = {name: os.environ.get(name) for name in _ENV_DEFAULTS}
+for _name, _value in _ENV_DEFAULTS.items():
+    os.environ.setdefault(_name, _value)
+
+import main  # noqa: E402
+from cache import DecodedCache, OriginalCache  # noqa: E402
+from db import CachedMessage, ImageHashMapper  # noqa: E402
+from executor import EncryptExecutor  # noqa: E402
+from perf import metrics  # noqa: E402
+
+# 読み込みは済んだので、import した側（テストなど）の環境変数は元に戻す
+for _name, _value in _saved_env.items():
+    if _value is None:
+        del os.environ[_name]
+    else:
+        os.environ[_name] = _value
+
+
+class BenchConfig(NamedTuple):
+    """ベンチマークの条件。"""
+
+    users: int = 10
+    posts: int = 3
+    images: int = 3
+    size: tuple[int, int] = (1280, 960)
+    rounds: int = 2
+    """同じ閲覧の嵐を繰り返す回数（2回目以降はキャッシュに当たる）"""
+    concurrency: int = 32
+    """同時に処理するクリックの上限"""
+    duplicate: float = 0.0
+    """二重クリックするクリックの割合"""
+    latency: float = 0.05
+    """Discord API 1回あたりの遅延（秒）"""
+    bandwidth: float = 0.0
+    """添付ファイルの転送速度（バイト/秒、0なら無制限）"""
+    db_latency: float = 0.002
+    """DBの問い合わせ1回あたりの遅延（秒）"""
+    workers: int = 0
+    """暗号化プールのワーカー数（0ならCPUコア数）"""
+    seed: int = 0
+
+
+# ===============================
+# Discord の偽物
+# ===============================
+
+
+class FakeUser:
+    def __init__(self, id: int, name: str):
+        self.id = id
+        self.name = name
+        self.display_name = name
+        self.mention = f"<@{id}>"
+
+
+class FakeAttachment:
+    def __init__(self, discord: "FakeDiscord", filename: str, data: bytes):
+        self.id = discord.next_id()
+        self.filename = filename
+        self.description = None
+        self.size = len(data)
+        expires = int(time.time()) + 24 * 60 * 60
+        self.url = (
+            f"https://cdn.fake/attachments/{self.id}/{filename}"
+            f"?ex={expires:x}&is=0&hm=0"
+        )
+        discord.cdn[self.url] = data
+        self._discord = discord
+
+    def is_spoiler(self) -> bool:
+        return False
+
+    async def read(self) -> bytes:
+        return await self._discord.download(self.url)
+
+
+class FakeMessage:
+    def __init__(
+        self,
+        discord: "FakeDiscord",
+        channel,
+        content: Optional[str],
+        attachments: list[FakeAttachment],
+        view=None,
+    ):
+        self.id = discord.next_id()
+        self.channel = channel
+        self.content = content
+        self.attachments = attachments
+        self.view = view
+        self.author = discord.bot
+        self.guild = discord.guild
+        self._discord = discord
+
+    async def delete(self):
+        await self._discord.call("delete_message")
+        self.channel.messages.pop(self.id, None)
+
+    async def reply(self, content=None, view=None, **_):
+        await self._discord.call("reply")
+        self.view = view
+        self._discord.replies.append(view)
+
+
+class FakeChannel:
+    """テキストチャンネルとスレッドを兼ねる。"""
+
+    def __init__(self, discord: "FakeDiscord", id: int, name: str):
+        self.id = id
+        self.name = name
+        self.mention = f"<#{id}>"
+        self.messages: dict[int, FakeMessage] = {}
+        self._discord = discord
+
+    async def create_thread(self, name: str, **_) -> "FakeChannel":
+        await self._discord.call("create_thread")
+        thread = FakeChannel(self._discord, self._discord.next_id(), name)
+        self._discord.channels[thread.id] = thread
+        self._discord.threads.append(thread)
+        return thread
+
+    async def send(self, content=None, *, file=None, files=None, **kwargs):
+        files = list(files or []) + ([file] if file else [])
+        attachments = []
+        for f in files:
+            data = f.fp.read()
+            await self._discord.transfer(len(data))
+            attachments.append(FakeAttachment(self._discord, f.filename, data))
+        await self._discord.call("send")
+        msg = FakeMessage(self._discord, self, content, attachments, kwargs.get("view"))
+        self.messages[msg.id] = msg
+        return msg
+
+    async def history(self, oldest_first: bool = False, limit: Optional[int] = None):
+        await self._discord.call("history")
+        messages = list(self.messages.values())
+        if not oldest_first:
+            messages.reverse()
+        for msg in messages[:limit]:
+            yield msg
+
+    async def fetch_message(self, id: int) -> FakeMessage:
+        await self._discord.call("fetch_message")
+        return self.messages[id]
+
+
+class FakeGuild:
+    def __init__(self, discord: "FakeDiscord"):
+        self._discord = discord
+
+    async def fetch_channel(self, id: int) -> FakeChannel:
+        await self._discord.call("fetch_channel")
+        return self._discord.channels[id]
+
+
+class FakeResponse:
+    def __init__(self, interaction: "FakeInteraction"):
+        self._interaction = interaction
+
+    async def send_message(self, content=None, **kwargs):
+        await self._interaction._discord.call("interaction_response")
+        self._interaction.responses.append((content, kwargs))
+
+    async def defer(self, **_):
+        await self._interaction._discord.call("interaction_response")
+
+
+class FakeInteraction:
+    def __init__(self, discord: "FakeDiscord", user: FakeUser):
+        self.user = user
+        self.guild = discord.guild
+        self.response = FakeResponse(self)
+        self.responses: list = []
+        self._discord = discord
+
+    async def edit_original_response(self, content=None, **kwargs):
+        await self._discord.call("edit_original_response")
+        self.responses.append((content, kwargs))
+
+
+class FakeDiscord:
+    """偽のDiscord全体。API呼び出しごとに遅延を入れ、回数を数える。"""
+
+    def __init__(self, latency: float, bandwidth: float):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.calls: dict[str, int] = {}
+        self.cdn: dict[str, bytes] = {}
+        self.channels: dict[int, FakeChannel] = {}
+        self.threads: list[FakeChannel] = []
+        self.replies: list = []
+        self._ids = itertools.count(10**17)
+        self.bot = FakeUser(self.next_id(), "bot")
+        self.guild = FakeGuild(self)
+        for id, name in (
+            (main.ID_ROOM_BOT, "bot"),
+            (main.ID_ROOM_VIEW, "view"),
+            (main.ID_ROOM_PIC, "pic"),
+        ):
+            self.channels[id] = FakeChannel(self, id, name)
+
+    def next_id(self) -> int:
+        return next(self._ids)
+
+    def get_channel(self, id: int) -> Optional[FakeChannel]:
+        return self.channels.get(id)
+
+    async def call(self, name: str):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        await asyncio.sleep(self.latency)
+
+    async def transfer(self, nbytes: int):
+        if self.bandwidth:
+            await asyncio.sleep(nbytes / self.bandwidth)
+
+    async def download(self, url: str) -> bytes:
+        await self.call("cdn_download")
+        data = self.cdn[url]
+        await self.transfer(len(data))
+        return data
+
+
+class FakeDownloader:
+    """download.AttachmentDownloader と同じインターフェースで偽のCDNから読む。"""
+
+    def __init__(self, discord: FakeDiscord):
+        self._discord = discord
+
+    async def fetch(self, url: str, stage: str = "download"):
+        return BytesIO(await self._discord.download(url))
+
+    async def fetch_all(self, urls: list[str], stage: str = "download"):
+        return await asyncio.gather(*(self.fetch(url, stage) for url in urls))
+
+    async def close(self):
+        pass
+
+
+# ===============================
+# DB の代わり
+# ===============================
+
+
+class MemoryUserIdMapper:
+    """UserIdMapper と同じインターフェースのメモリ上の実装。
+
+    本物と同じく2回目以降はメモリから返すので、遅延は初回だけ入れる。
+    """
+
+    def __init__(self, latency: float):
+        self._latency = latency
+        self._ids: dict[int, int] = {}
+        self._discord_ids: dict[int, int] = {}
+
+    async def get_or_create_internal_id(self, discord_user_id: int) -> int:
+        internal_id = self._ids.get(discord_user_id)
+        if internal_id is None:
+            await asyncio.sleep(self._latency)
+            internal_id = self._ids.setdefault(discord_user_id, len(self._ids) + 1)
+            self._discord_ids[internal_id] = discord_user_id
+        return internal_id
+
+    async def get_discord_id(self, internal_id: int) -> Optional[int]:
+        return self._discord_ids.get(internal_id)
+
+
+class MemoryImageCacheMapper:
+    """ImageCacheMapper と同じインターフェースのメモリ上の実装。
+
+    本物と同じく閲覧者ごとの最初の prefetch でだけ遅延を入れる。
+    """
+
+    def __init__(self, latency: float):
+        self._latency = latency
+        self._messages: dict[tuple[int, int], CachedMessage] = {}
+        self._prefetched: set[int] = set()
+
+    async def prefetch(self, internal_id: int) -> None:
+        if internal_id not in self._prefetched:
+            self._prefetched.add(internal_id)
+            await asyncio.sleep(self._latency)
+
+    async def get_message(
+        self, thread_id: int, internal_id: int
+    ) -> Optional[CachedMessage]:
+        return self._messages.get((thread_id, internal_id))
+
+    async def get_message_id(self, thread_id: int, internal_id: int) -> Optional[int]:
+        cached = self._messages.get((thread_id, internal_id))
+        return cached.message_id if cached else None
+
+    async def set_message_id(
+        self, thread_id, internal_id, message_id, urls=(), expires_at=None
+    ) -> None:
+        key = (thread_id, internal_id)
+        self._messages[key] = CachedMessage(message_id, tuple(urls), expires_at)
+
+    async def add_prerendered(
+        self, thread_id, internal_id, message_id, urls=(), expires_at=None
+    ) -> bool:
+        key = (thread_id, internal_id)
+        if key in self._messages:
+            return False
+        self._messages[key] = CachedMessage(message_id, tuple(urls), expires_at)
+        return True
+
+    async def mark_viewed(self, thread_id: int, internal_id: int) -> None:
+        pass
+
+    async def active_viewers(self, limit: int, days: int) -> list[tuple[int, int]]:
+        return []
+
+
+class _NullPool:
+    """ImageHashMapper の永続化を省略するためのプール（索引はメモリ上で動く）。"""
+
+    async def execute(self, *_):
+        pass
+
+    async def fetch(self, *_):
+        return []
+
+    async def executemany(self, *_):
+        pass
+
+
+# ===============================
+# 計測
+# ===============================
+
+
+def _latencyStats(latencies: list[float], wall: float) -> dict:
+    ordered = sorted(latencies)
+    if not ordered:
+        return {"count": 0}
+
+    def q(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000
+
+    return {
+        "count": len(ordered),
+        "wall_s": round(wall, 3),
+        "throughput_per_s": round(len(ordered) / wall, 2) if wall else None,
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 1),
+        "p50_ms": round(q(0.5), 1),
+        "p95_ms": round(q(0.95), 1),
+        "p99_ms": round(q(0.99), 1),
+        "max_ms": round(ordered[-1] * 1000, 1),
+    }
+
+
+def _peakRssMB(pid: int) -> Optional[float]:
+    """/proc のピークRSS（VmHWM）。取得できなければNone。"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _childPids() -> list[int]:
+    pids = []
+    me = os.getpid()
+    for name in os.listdir("/proc") if os.path.isdir("/proc") else []:
+        if name.isdigit():
+            try:
+                with open(f"/proc/{name}/stat") as f:
+                    # comm に空白や括弧を含みうるので、最後の ")" の後ろを読む
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == me:
+                        pids.append(int(name))
+            except (OSError, IndexError, ValueError):
+                pass
+    return pids
+
+
+def _gitCommit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def reportHeader(config: NamedTuple) -> dict:
+    """結果のJSONの先頭に付ける、実行環境と条件。"""
+    return {
+        "commit": _gitCommit(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "config": config._asdict(),
+    }
+
+
+def makeImage(
+    size: tuple[int, int], seed: int, format: str = "png", mode: str = "RGB"
+) -> bytes:
+    """写真に近い圧縮率になるよう、グラデーションにノイズを重ねた画像を作る。
+
+    Args:
+        format: PILの保存形式（png / jpeg / webp）
+        mode: RGB / RGBA（透明度のグラデーション付き）/ P（適応パレット）/ L
+    """
+    w, h = size
+    rng = np.random.default_rng(seed)
+    x = np.arange(w, dtype=np.int32)[None, :]
+    y = np.arange(h, dtype=np.int32)[:, None]
+    # 8Kでも一時配列がチャンネル1枚分（int16）で済むよう、チャンネルごとに作る
+    pixels = np.empty((h, w, 4 if mode == "RGBA" else 3), dtype=np.uint8)
+    for c, base in enumerate(
+        (
+            x * 255 // max(w - 1, 1),
+            y * 255 // max(h - 1, 1),
+            (x + y) * 127 // (w + h),
+            (x + y) * 255 // (w + h),
+        )[: pixels.shape[2]]
+    ):
+        noise = rng.integers(-12, 13, (h, w), dtype=np.int16)
+        pixels[..., c] = np.clip(base + noise, 0, 255)
+    image = Image.fromarray(pixels)
+    if mode == "P":
+        image = image.convert("P", palette=Image.ADAPTIVE)
+    elif mode == "L":
+        image = image.convert("L")
+    buf = BytesIO()
+    image.save(buf, format=format)
+    return buf.getvalue()
+
+
+# ===============================
+# 実行
+# ===============================
+
+
+def _patchMain(fake: FakeDiscord, **values) -> Callable[[], None]:
+    """main のグローバル変数と client.get_channel を差し替え、元に戻す関数を返す。"""
+    saved = {name: getattr(main, name) for name in values}
+    for name, value in values.items():
+        setattr(main, name, value)
+    main.client.get_channel = fake.get_channel
+
+    def restore():
+        del main.client.get_channel
+        for name, value in saved.items():
+            setattr(main, name, value)
+
+    return restore
+
+
+async def _run(config: BenchConfig, workdir: str) -> dict:
+    fake = FakeDiscord(config.latency, config.bandwidth)
+    rng = random.Random(config.seed)
+    author = FakeUser(fake.next_id(), "author")
+    pic_room = fake.channels[main.ID_ROOM_PIC]
+    results: dict = {}
+    restore = _patchMain(
+        fake,
+        attachment_downloader=FakeDownloader(fake),
+        user_id_mapper=MemoryUserIdMapper(config.db_latency),
+        image_cache_mapper=MemoryImageCacheMapper(config.db_latency),
+        image_hash_mapper=ImageHashMapper(_NullPool()),
+        original_cache=OriginalCache(os.path.join(workdir, "originals"), 1 << 40),
+        decoded_cache=DecodedCache(os.path.join(workdir, "decoded"), 1 << 40),
+        encrypt_executor=EncryptExecutor(max_workers=config.workers or None),
+        prerender_queue=None,
+    )
+    metrics.drain()
+    try:
+        # 投稿: processImageUpload（ダウンロード）→ 投稿ボタン → myUploader.upload
+        async def post(i: int) -> float:
+            attachments = [
+                FakeAttachment(
+                    fake, f"image{k}.png", makeImage(config.size, i * 97 + k)
+                )
+                for k in range(config.images)
+            ]
+            msg = FakeMessage(fake, pic_room, None, attachments)
+            msg.author = author
+            started = time.perf_counter()
+            await main.processImageUpload(msg)
+            view = msg.view
+            await view.uploader.upload(view.files)
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        upload_latencies = await asyncio.gather(*(post(i) for i in range(config.posts)))
+        results["upload"] = _latencyStats(
+            upload_latencies, time.perf_counter() - started
+        )
+
+        # 閲覧: 全員が全投稿を（一部は二重に）クリックする
+        users = [FakeUser(fake.next_id(), f"user{u}") for u in range(config.users)]
+        semaphore = asyncio.Semaphore(config.concurrency)
+
+        async def click(user: FakeUser, thread: FakeChannel) -> float:
+            async with semaphore:
+                ctx = FakeInteraction(fake, user)
+                t = time.perf_counter()
+                await main.processButtonclickImageView(ctx, thread.id)
+                return time.perf_counter() - t
+
+        for r in range(config.rounds):
+            clicks = [(u, t) for u in users for t in fake.threads]
+            clicks += [c for c in clicks if rng.random() < config.duplicate]
+            rng.shuffle(clicks)
+            started = time.perf_counter()
+            latencies = await asyncio.gather(*(click(u, t) for u, t in clicks))
+            results[f"view_round{r + 1}"] = _latencyStats(
+                latencies, time.perf_counter() - started
+            )
+
+        worker_rss = [_peakRssMB(pid) for pid in _childPids()]
+        worker_rss = [v for v in worker_rss if v is not None]
+    finally:
+        main.encrypt_executor.shutdown()
+        restore()
+
+    histograms, counters = metrics.drain()
+    main_rss = _peakRssMB(os.getpid())
+    if main_rss is None:
+        main_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    results.update(
+        {
+            "stages": {
+                name: {
+                    "count": h.count,
+                    "p50_ms": round(h.quantile(0.5), 2),
+                    "p95_ms": round(h.quantile(0.95), 2),
+                    "p99_ms": round(h.quantile(0.99), 2),
+                    "max_ms": round(h.max, 2),
+                }
+                for name, h in sorted(histograms.items())
+            },
+            "counters": dict(sorted(counters.items())),
+            "discord_calls": dict(sorted(fake.calls.items())),
+            "view_messages": sum(len(t.messages) - 1 for t in fake.threads),
+            "peak_rss_mb": {
+                "main": round(main_rss, 1),
+                "worker_max": round(max(worker_rss), 1) if worker_rss else None,
+            },
+        }
+    )
+    return results
+
+
+def run(config: BenchConfig, out: Optional[str] = None) -> dict:
+    """ベンチマークを1回実行し、結果を返す（out を指定するとJSONで保存する）。"""
+    with tempfile.TemporaryDirectory() as workdir:
+        results = asyncio.run(_run(config, workdir))
+    report = {**reportHeader(config), **results}
+    if out:
+        with open(out, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+def _parseSize(text: str) -> tuple[int, int]:
+    w, h = text.lower().split("x")
+    return int(w), int(h)
+
+
+def _parseArgs(argv: Optional[list[str]] = None) -> tuple[BenchConfig, Optional[str]]:
+    defaults = BenchConfig()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=defaults.users)
+    parser.add_argument("--posts", type=int, default=defaults.posts)
+    parser.add_argument("--images", type=int, default=defaults.images)
+    parser.add_argument("--size", type=_parseSize, default=defaults.size)
+    parser.add_argument("--rounds", type=int, default=defaults.rounds)
+    parser.add_argument("--concurrency", type=int, default=defaults.concurrency)
+    parser.add_argument("--duplicate", type=float, default=defaults.duplicate)
+    parser.add_argument("--latency", type=float, default=defaults.latency)
+    parser.add_argument("--bandwidth", type=float, default=defaults.bandwidth)
+    parser.add_argument("--db-latency", type=float, default=defaults.db_latency)
+    parser.add_argument("--workers", type=int, default=defaults.workers)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--out", help="結果を保存するJSONファイル")
+    args = vars(parser.parse_args(argv))
+    out = args.pop("out")
+    return BenchConfig(**args), out
+
+
+if __name__ == "__main__":
+    config, out = _parseArgs()
+    report = run(config, out)
+    print(json.dumps({k: v for k, v in report.items() if k != "stages"}, indent=2))
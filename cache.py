@@ -0,0 +1,284 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, NamedTuple, Optional
+
+
+class ByteBudgetLRU:
+    """合計サイズ（バイト）の上限を持つLRUキャッシュ。
+
+    上限を超えた場合は最も長く参照されていないエントリから追い出す。
+    上限より大きい値は保持しない。on_evictを指定すると、追い出したエントリの
+    (キー, 値) を渡して呼び出す（pop・clearでは呼ばない）。
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        on_evict: Optional[Callable[[Hashable, Any], None]] = None,
+    ):
+        self.max_bytes = max_bytes
+        self._on_evict = on_evict
+        self._entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._nbytes = 0
+
+    @property
+    def nbytes(self) -> int:
+        """現在保持しているエントリの合計バイト数。"""
+        return self._nbytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: Hashable, value: Any, nbytes: int) -> None:
+        self.pop(key)
+        if nbytes > self.max_bytes:
+            return
+        self._entries[key] = (value, nbytes)
+        self._nbytes += nbytes
+        while self._nbytes > self.max_bytes:
+            evicted_key, (evicted, size) = self._entries.popitem(last=False)
+            self._nbytes -= size
+            if self._on_evict is not None:
+                self._on_evict(evicted_key, evicted)
+
+    def pop(self, key: Hashable, default: Optional[Any] = None) -> Optional[Any]:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        self._nbytes -= entry[1]
+        return entry[0]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._nbytes = 0
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _load_files(lru: ByteBudgetLRU, directory: str, keep: Callable[[str], bool]):
+    """ディレクトリ内のファイルを更新日時の古い順にLRUへ登録する。
+
+    keepがFalseを返すファイル（書き込み途中のものや不要になったもの）は削除する。
+    """
+    files = sorted(os.scandir(directory), key=lambda e: e.stat().st_mtime)
+    for entry in files:
+        if keep(entry.name):
+            lru.put(entry.name, entry.path, entry.stat().st_size)
+        else:
+            _remove_file(entry.path)
+
+
+class CachedOriginal(NamedTuple):
+    """OriginalCacheに保存された元画像1枚。"""
+
+    attachment_id: int
+    filename: str
+    path: str
+    """画像ファイルのパス（myImageCodec.openImage でmmapして読む）"""
+    digest: str
+    """内容のSHA-256（DecodedCacheのキー）"""
+
+
+class OriginalCache:
+    """元画像ファイルのディスクキャッシュ。
+
+    ファイルは内容のSHA-256を名前にして保存し（同じ画像は1つだけ持つ）、
+    スレッドIDごとに添付ファイルIDとファイル名の一覧を索引に記録する。
+    合計サイズが上限を超えた場合は、最も長く参照されていないファイルから削除する。
+    参照順はファイルの更新日時として残すので、再起動後も引き継がれる。
+
+    索引は変更を1行ずつ追記するログとして保存し、起動時に読み直す。put は
+    ハッシュの計算とファイルの書き込みを行うので、イベントループからは
+    asyncio.to_thread で呼ぶ（状態の更新はロックで守る）。
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self._objects_dir = os.path.join(directory, "objects")
+        self._index_path = os.path.join(directory, "index.log")
+        os.makedirs(self._objects_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._files = ByteBudgetLRU(max_bytes, on_evict=self._remove)
+        # スレッドID -> [(添付ファイルID, ファイル名, ダイジェスト)]
+        self._posts: dict[int, list[tuple[int, str, str]]] = {}
+        # 索引のログにまだ書いていない行（discard の分は次の put でまとめて書く）
+        self._pending: list[str] = []
+        self._load()
+
+    @property
+    def nbytes(self) -> int:
+        """保存しているファイルの合計バイト数。"""
+        return self._files.nbytes
+
+    def _load(self):
+        records = 0
+        if os.path.exists(self._index_path):
+            with open(self._index_path) as f:
+                for line in f:
+                    try:
+                        thread_id, entries = json.loads(line)
+                    except ValueError:
+                        continue  # 書き込み途中で止まった行
+                    records += 1
+                    if entries is None:
+                        self._posts.pop(thread_id, None)
+                    else:
+                        self._posts[thread_id] = [tuple(e) for e in entries]
+        referenced = {e[2] for entries in self._posts.values() for e in entries}
+        _load_files(self._files, self._objects_dir, referenced.__contains__)
+        if records > 2 * len(self._posts):
+            self._compact()
+
+    def _compact(self):
+        """ログを現在の索引だけに書き直す。"""
+        tmp = self._index_path + ".tmp"
+        with open(tmp, "w") as f:
+            for thread_id, entries in self._posts.items():
+                f.write(json.dumps([thread_id, entries]) + "\n")
+        os.replace(tmp, self._index_path)
+
+    def flush(self):
+        """まだ書いていない索引の変更をログに追記する。"""
+        with self._lock:
+            lines, self._pending = self._pending, []
+        if lines:
+            with open(self._index_path, "a") as f:
+                f.write("".join(lines))
+
+    def _remove(self, digest: str, path: str):
+        _remove_file(path)
+
+    def get(self, thread_id: int) -> Optional[list[CachedOriginal]]:
+        """スレッドの元画像を返す。1枚でも欠けている場合はNone。"""
+        with self._lock:
+            entries = self._posts.get(thread_id)
+            if entries is None:
+                return None
+            originals = []
+            for attachment_id, filename, digest in entries:
+                path = self._files.get(digest)
+                if path is None:
+                    self._discard(thread_id)
+                    return None
+                originals.append(CachedOriginal(attachment_id, filename, path, digest))
+        for o in originals:
+            try:
+                os.utime(o.path)
+            except FileNotFoundError:
+                pass  # 直前に追い出された。読む側で取得し直す
+        return originals
+
+    def put(
+        self, thread_id: int, originals: list[tuple[int, str, bytes]]
+    ) -> Optional[list[CachedOriginal]]:
+        """スレッドの元画像を保存する（ファイルを書くのでイベントループの外で呼ぶ）。
+
+        Args:
+            thread_id: 元画像を保管しているスレッドのID
+            originals: [(添付ファイルID, ファイル名, ファイルのバイト列)]
+
+        Returns:
+            保存した元画像。上限より大きいファイルを含み保存しなかった場合はNone
+        """
+        if any(len(data) > self._files.max_bytes for _, _, data in originals):
+            return None
+        entries = []
+        sizes = []
+        for attachment_id, filename, data in originals:
+            digest = hashlib.sha256(data).hexdigest()
+            path = os.path.join(self._objects_dir, digest)
+            with self._lock:
+                stored = digest in self._files
+            if not stored:
+                # 同じ内容を並行して書いても壊れないよう、一時ファイルはスレッドごと
+                tmp = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            entries.append((attachment_id, filename, digest))
+            sizes.append(len(data))
+        with self._lock:
+            for (_, _, digest), nbytes in zip(entries, sizes):
+                path = os.path.join(self._objects_dir, digest)
+                self._files.put(digest, path, nbytes)
+            self._posts[thread_id] = entries
+            self._pending.append(json.dumps([thread_id, entries]) + "\n")
+        self.flush()
+        return [
+            CachedOriginal(a, f, os.path.join(self._objects_dir, d), d)
+            for a, f, d in entries
+        ]
+
+    def discard(self, thread_id: int):
+        """スレッドを索引から外す。保存済みのファイルはLRUで追い出されるまで残る。"""
+        with self._lock:
+            self._discard(thread_id)
+
+    def _discard(self, thread_id: int):
+        if self._posts.pop(thread_id, None) is not None:
+            self._pending.append(json.dumps([thread_id, None]) + "\n")
+
+
+class DecodedCache:
+    """元画像を展開したRGBA画素（.npy）のディスクキャッシュ。
+
+    ファイルの書き出しはワーカープロセスが myImageCodec.loadPixels で行い、
+    このクラスはメインプロセスで合計サイズを管理して古いものから削除する。
+    ワーカーは .npy をmmapで読むので、同じ画像を開くワーカー同士で
+    ページキャッシュを共有する。
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self._dir = directory
+        os.makedirs(directory, exist_ok=True)
+        self._files = ByteBudgetLRU(max_bytes, on_evict=self._remove)
+        _load_files(self._files, directory, lambda name: name.endswith(".npy"))
+
+    @property
+    def nbytes(self) -> int:
+        """保存しているファイルの合計バイト数。"""
+        return self._files.nbytes
+
+    def _remove(self, name: str, path: str):
+        _remove_file(path)
+
+    def path(self, digest: str) -> str:
+        """元画像（内容のSHA-256）に対応する .npy ファイルのパス。"""
+        return os.path.join(self._dir, f"{digest}.npy")
+
+    def touch(self, digest: str) -> bool:
+        """ワーカーが書き出した（または読んだ）ファイルを登録し、参照順を更新する。
+
+        Returns:
+            ファイルが存在したか
+        """
+        name = f"{digest}.npy"
+        if self._files.get(name) is not None:
+            os.utime(self.path(digest))
+            return True
+        try:
+            nbytes = os.path.getsize(self.path(digest))
+        except FileNotFoundError:
+            return False
+        self._files.put(name, self.path(digest), nbytes)
+        if name not in self._files:
+            # 上限より大きい
+            _remove_file(self.path(digest))
+        return True
@@ -24,6 +24,11 @@ MASK_BASE = 0
 MASK_COLOR = 1  # 透かしの強度（1 = ほぼ不可視）
 TEXT_COLOR = 64  # タイムスタンプのテキスト色
 
+# ID・ラベルのマスク層キャッシュの上限（バイト、プロセスごと）
+MASK_CACHE_BYTES = 128 * 1024 * 1024
+# ラベルの文字列を描いたタイルのキャッシュの上限（バイト、プロセスごと）
+LABEL_TILE_CACHE_BYTES = 32 * 1024 * 1024
+
 # ===============================
 # Discord UI関連定数
 # ===============================
@@ -48,3 +53,142 @@ EMOJI_TRASHCAN = "\N{WASTEBASKET}"
 KEY_ID = "id"
 KEY_THREAD_ID = "thread_id"
 KEY_AUTHOR_ID = "author_id"
+
+# ===============================
+# 処理プール関連定数
+# ===============================
+
+# 暗号化プールに同時投入できるジョブ数（超えた分は空きを待つ）
+ENCRYPT_MAX_PENDING = 32
+
+# 暗号化ジョブ1件あたりのタイムアウト（秒）
+ENCRYPT_JOB_TIMEOUT = 60.0
+
+# 閲覧用画像のエンコードプロファイル（myImageCodec.ENCODE_PROFILES）
+ENCODE_PROFILE = "capped"
+
+# この画素数以上の画像は、全体のマスクを作らず帯ごとに暗号化・エンコードする
+ENCRYPT_BAND_MIN_PIXELS = 20_000_000
+
+# Discordにアップロードできる1ファイルあたりの上限（バイト）
+DISCORD_UPLOAD_LIMIT = 10 * 1024 * 1024
+
+# ===============================
+# ダウンロード関連定数
+# ===============================
+
+# 添付ファイルを同時にダウンロードする数の上限
+DOWNLOAD_CONCURRENCY = 8
+
+# ダウンロードに失敗したときの再試行の回数と、最初の待ち時間（秒、以降は倍々）
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 0.5
+
+# 1件のダウンロードのタイムアウト（秒）
+DOWNLOAD_TIMEOUT = 60.0
+
+# これを超える添付ファイルはメモリではなく一時ファイルに書く（バイト）
+DOWNLOAD_SPOOL_BYTES = 8 * 1024 * 1024
+
+# 1回に読み込む大きさ（バイト）
+DOWNLOAD_CHUNK_BYTES = 256 * 1024
+
+# ===============================
+# プレビュー関連定数
+# ===============================
+
+# ぼかしプレビューの長辺のブロック数（小さい画像でもブロックは最小値以上）
+PREVIEW_BLOCKS = 80
+PREVIEW_MIN_BLOCK_PX = 16
+
+# ぼかしプレビュー画像の長辺の上限（px）
+PREVIEW_MAX_SIDE = 480
+
+# ===============================
+# 元画像キャッシュ関連定数
+# ===============================
+
+# 元画像ファイルを保存するディレクトリ
+ORIGINAL_CACHE_DIR = "./cache/originals"
+
+# 元画像キャッシュの合計サイズの上限（バイト）
+ORIGINAL_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+
+# 展開済みの画素（.npy）を保存するディレクトリ
+DECODED_CACHE_DIR = "./cache/decoded"
+
+# 展開済み画素キャッシュの合計サイズの上限（バイト、4K画像1枚で約33MB）
+DECODED_CACHE_BYTES = 4 * 1024 * 1024 * 1024
+
+# ===============================
+# データベース関連定数
+# ===============================
+
+# Discord UserID ↔ 内部IDのキャッシュ件数（ID空間全体が収まる）
+USER_ID_CACHE_SIZE = ID_MAX
+
+# last_accessed_at をまとめて更新する間隔（秒）
+USER_ID_FLUSH_INTERVAL = 30.0
+
+# この日数アクセスのないユーザーの内部IDを回収する（0なら回収しない）
+USER_ID_RETENTION_DAYS = 0
+
+# (スレッド, 閲覧者) → 暗号化済み画像のメッセージ のキャッシュ件数
+IMAGE_CACHE_SIZE = 100_000
+
+# 閲覧者が最初に操作したときに読み込む、最近のスレッドの数
+IMAGE_CACHE_PREFETCH_THREADS = 50
+
+# 暗号化済み画像の登録をまとめてDBに書き込む間隔（秒）
+IMAGE_CACHE_FLUSH_INTERVAL = 1.0
+
+# 同時に来た問い合わせをまとめるために待つ時間（秒）
+IMAGE_CACHE_BATCH_DELAY = 0.005
+
+# 添付ファイルのURLの有効期限がこの秒数以内なら、メッセージを取得して更新する
+ATTACHMENT_URL_MARGIN = 60 * 60
+
+# ===============================
+# 事前生成関連定数
+# ===============================
+
+# 投稿時に透かし入り画像を事前生成するか
+PRERENDER_ENABLED = False
+
+# 1投稿あたり事前生成する閲覧者の数（閲覧の多い順）
+PRERENDER_VIEWERS = 10
+
+# 閲覧の多さを数える期間（日）
+PRERENDER_HISTORY_DAYS = 14
+
+# 事前生成に使う時間の割合の上限（0〜1）
+PRERENDER_CPU_BUDGET = 0.25
+
+# ===============================
+# メトリクス関連定数
+# ===============================
+
+# Prometheus形式でメトリクスを公開するアドレスとポート（0なら公開しない）
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 0
+
+# メモリのプロファイリング（/profile start で開始。PROFILE_ENABLED=1 なら起動時から）
+PROFILE_ENABLED = False
+# tracemalloc のスナップショットを取る間隔（秒）と、保存しておく数
+PROFILE_SNAPSHOT_INTERVAL = 60.0
+PROFILE_SNAPSHOTS = 10
+# 割り当て1件ごとに記録する呼び出し元の深さ
+PROFILE_TRACE_FRAMES = 1
+
+# ===============================
+# 流出調査関連定数
+# ===============================
+
+# IDの復元まで行う候補の数
+LEAKSCAN_CANDIDATES = 5
+
+# 候補とみなすハッシュ距離の上限（ahash・phash・dhash の合計、最大192）
+LEAKSCAN_MAX_DISTANCE = 40
+
+# 重複投稿とみなすハッシュ距離の上限
+DUPLICATE_MAX_DISTANCE = 6
@@ -1,22 +1,60 @@
-from typing import Optional
+import asyncio
+import datetime
+from typing import Awaitable, Callable, NamedTuple, Optional
 
 import asyncpg
 
-from constants import ID_MAX
+from cache import ByteBudgetLRU
+from constants import (
+    ID_MAX,
+    USER_ID_CACHE_SIZE,
+    USER_ID_FLUSH_INTERVAL,
+    IMAGE_CACHE_SIZE,
+    IMAGE_CACHE_PREFETCH_THREADS,
+    IMAGE_CACHE_FLUSH_INTERVAL,
+    IMAGE_CACHE_BATCH_DELAY,
+)
+from hashindex import BKTree, hash_key
+from idalloc import FreeIdBitmap
+
+# ID 0 はセルに何も描かれず、透かしのない画像と区別できないので割り当てない
+RESERVED_INTERNAL_ID = 0
 
 
 class UserIdMapper:
     """Discord UserIDと16bit内部IDの1:1マッピングをPostgreSQLで永続化する。
 
-    myCrypterが要求する16bit ID空間（0〜65535）に対して、
+    myCrypterが要求する16bit ID空間（1〜65535、0は予約）に対して、
     Discord UserID（19桁整数）を衝突なしにマッピングする。
+
+    一度割り当てたマッピングは変わらないので、メモリ上のLRUにも保持して
+    DBへの問い合わせを省略する。キャッシュから返した分の last_accessed_at は
+    flush（start後は flush_interval 秒ごと）でまとめて更新する。
+
+    新規割り当ては、起動時にDBから作る空きIDのビットマップから最小の空きIDを選び、
+    INSERT ... ON CONFLICT DO NOTHING で確定する。別の接続が先に同じIDや同じユーザーを
+    登録していた場合は衝突として検出し、次の候補で再試行する。
     """
 
-    def __init__(self, pool: asyncpg.Pool):
+    def __init__(
+        self,
+        pool: asyncpg.Pool,
+        cache_size: int = USER_ID_CACHE_SIZE,
+        flush_interval: float = USER_ID_FLUSH_INTERVAL,
+    ):
         self._pool = pool
+        self._flush_interval = flush_interval
+        # 件数で上限を設ける（1件 = 1）。逆引きは追い出しに合わせて消す
+        self._internal_ids = ByteBudgetLRU(
+            cache_size, on_evict=lambda _, i: self._discord_ids.pop(i, None)
+        )
+        self._discord_ids: dict[int, int] = {}
+        self._touched: set[int] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._free_ids = FreeIdBitmap(ID_MAX, (RESERVED_INTERNAL_ID,))
 
     async def init(self):
-        """テーブルが存在しなければ作成する。"""
+        """テーブルが存在しなければ作成し、使用中のIDを読み込む。"""
         await self._pool.execute("""
             CREATE TABLE IF NOT EXISTS user_id_mapping (
                 internal_id INTEGER PRIMARY KEY
@@ -30,6 +68,13 @@ class UserIdMapper:
             CREATE INDEX IF NOT EXISTS idx_discord_user_id
                 ON user_id_mapping(discord_user_id)
         """)
+        await self._pool.execute("""
+            CREATE INDEX IF NOT EXISTS idx_user_id_mapping_last_accessed_at
+                ON user_id_mapping(last_accessed_at)
+        """)
+        rows = await self._pool.fetch("SELECT internal_id FROM user_id_mapping")
+        used = [RESERVED_INTERNAL_ID] + [r["internal_id"] for r in rows]
+        self._free_ids = FreeIdBitmap(ID_MAX, used)
 
     async def get_or_create_internal_id(self, discord_user_id: int) -> int:
         """Discord UserIDに対応するinternal_idを取得する。未登録なら新規割り当て。
@@ -38,11 +83,16 @@ class UserIdMapper:
             discord_user_id: Discord UserID（19桁整数）
 
         Returns:
-            0〜65535の範囲のinternal_id
+            1〜65535の範囲のinternal_id
 
         Raises:
-            RuntimeError: ID空間（65536）が枯渇した場合
+            RuntimeError: ID空間（65535）が枯渇した場合
         """
+        internal_id = self._internal_ids.get(discord_user_id)
+        if internal_id is not None:
+            self._touched.add(discord_user_id)
+            return internal_id
+
         # 既存のマッピングを検索し、last_accessed_atを更新
         row = await self._pool.fetchrow(
             """
@@ -54,27 +104,40 @@ class UserIdMapper:
             discord_user_id,
         )
         if row is not None:
+            self._remember(discord_user_id, row["internal_id"])
             return row["internal_id"]
 
         # 新規割り当て: 未使用の最小IDを取得
-        row = await self._pool.fetchrow(
-            """
-            INSERT INTO user_id_mapping (internal_id, discord_user_id)
-            SELECT s.id, $1
-            FROM generate_series(0, $2 - 1) AS s(id)
-            WHERE s.id NOT IN (SELECT internal_id FROM user_id_mapping)
-            ORDER BY s.id
-            LIMIT 1
-            RETURNING internal_id
-            """,
-            discord_user_id,
-            ID_MAX,
-        )
-        if row is None:
-            raise RuntimeError(
-                f"ID空間が枯渇しました（上限: {ID_MAX}ユーザー）"
+        while True:
+            candidate = self._free_ids.allocate()
+            if candidate is None:
+                raise RuntimeError(
+                    f"ID空間が枯渇しました（上限: {ID_MAX - 1}ユーザー）"
+                )
+            row = await self._pool.fetchrow(
+                """
+                INSERT INTO user_id_mapping (internal_id, discord_user_id)
+                VALUES ($1, $2)
+                ON CONFLICT DO NOTHING
+                RETURNING internal_id
+                """,
+                candidate,
+                discord_user_id,
+            )
+            if row is not None:
+                self._remember(discord_user_id, candidate)
+                return candidate
+
+            # 同じユーザーが並行して登録済みなら候補を戻してそれを返す。
+            # そうでなければ候補のIDが別の接続で使われたので、使用中のまま次を試す
+            internal_id = await self._pool.fetchval(
+                "SELECT internal_id FROM user_id_mapping WHERE discord_user_id = $1",
+                discord_user_id,
             )
-        return row["internal_id"]
+            if internal_id is not None:
+                self._free_ids.release(candidate)
+                self._remember(discord_user_id, internal_id)
+                return internal_id
 
     async def get_discord_id(self, internal_id: int) -> Optional[int]:
         """internal_idからDiscord UserIDを逆引きする。
@@ -85,23 +148,169 @@ class UserIdMapper:
         Returns:
             対応するDiscord UserID。見つからない場合はNone。
         """
+        discord_user_id = self._discord_ids.get(internal_id)
+        if discord_user_id is not None:
+            return discord_user_id
         row = await self._pool.fetchrow(
             "SELECT discord_user_id FROM user_id_mapping WHERE internal_id = $1",
             internal_id,
         )
         if row is None:
             return None
+        self._remember(row["discord_user_id"], internal_id)
         return row["discord_user_id"]
 
+    async def reclaim(
+        self,
+        retention_days: int,
+        on_reclaimed: Optional[Callable[[list[int]], Awaitable[None]]] = None,
+    ) -> list[int]:
+        """retention_days日以上アクセスのないユーザーのIDを回収する。
+
+        回収したIDは別のユーザーに割り当てられるので、そのIDに紐づくデータ
+        （暗号化済み画像のキャッシュなど）を on_reclaimed で先に消してから
+        マッピングを削除する。回収前の流出画像のIDは新しいユーザーを指すようになる点に注意。
+
+        Args:
+            retention_days: 保持する日数
+            on_reclaimed: 回収するIDのリストを受け取るコルーチン関数
+
+        Returns:
+            回収したinternal_idのリスト
+        """
+        await self.flush()
+        cutoff = await self._pool.fetchval(
+            "SELECT NOW() - make_interval(days => $1)", retention_days
+        )
+        expired = await self._pool.fetch(
+            "SELECT internal_id FROM user_id_mapping WHERE last_accessed_at < $1",
+            cutoff,
+        )
+        if not expired:
+            return []
+        if on_reclaimed is not None:
+            await on_reclaimed([r["internal_id"] for r in expired])
+        # その間にアクセスがあったユーザーは残す
+        await self.flush()
+        rows = await self._pool.fetch(
+            """
+            DELETE FROM user_id_mapping
+            WHERE internal_id = ANY($1::INTEGER[]) AND last_accessed_at < $2
+            RETURNING internal_id, discord_user_id
+            """,
+            [r["internal_id"] for r in expired],
+            cutoff,
+        )
+        for r in rows:
+            self._internal_ids.pop(r["discord_user_id"])
+            self._discord_ids.pop(r["internal_id"], None)
+            if r["internal_id"] != RESERVED_INTERNAL_ID:
+                self._free_ids.release(r["internal_id"])
+        return [r["internal_id"] for r in rows]
+
+    def _remember(self, discord_user_id: int, internal_id: int):
+        self._internal_ids.put(discord_user_id, internal_id, 1)
+        self._discord_ids[internal_id] = discord_user_id
+
+    async def flush(self):
+        """キャッシュから返したユーザーの last_accessed_at を1文でまとめて更新する。"""
+        if not self._touched:
+            return
+        touched, self._touched = self._touched, set()
+        try:
+            await self._pool.execute(
+                """
+                UPDATE user_id_mapping AS m
+                SET last_accessed_at = NOW()
+                FROM unnest($1::BIGINT[]) AS t(discord_user_id)
+                WHERE m.discord_user_id = t.discord_user_id
+                """,
+                list(touched),
+            )
+        except BaseException:
+            # 次回の flush で書き込む
+            self._touched |= touched
+            raise
+
+    def start(self):
+        """flush を flush_interval 秒ごとに実行する（実行中なら何もしない）。"""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """定期実行を止め、未反映の分を書き込む。"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except (asyncpg.PostgresError, OSError) as e:
+                print(e)
+
+
+class CachedMessage(NamedTuple):
+    """image_cache の1件（暗号化済み画像を保存したメッセージ）。"""
+
+    message_id: int
+    urls: tuple[str, ...] = ()
+    """添付ファイルのURL（未取得なら空）"""
+    expires_at: Optional[datetime.datetime] = None
+    """URLの有効期限（期限のないURLならNone）"""
+    prerendered: bool = False
+    """事前生成したもので、まだ閲覧されていないか"""
+
+    def urls_valid(self, margin: float) -> bool:
+        """URLがあり、margin秒後もまだ有効か。"""
+        if not self.urls:
+            return False
+        if self.expires_at is None:
+            return True
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return self.expires_at - now > datetime.timedelta(seconds=margin)
+
 
 class ImageCacheMapper:
     """スレッドごと・ユーザーごとの暗号化済み画像キャッシュをPostgreSQLで管理する。
 
     thread.history() O(n)走査の代替。(thread_id, internal_id) → message_id のO(1)ルックアップ。
+    添付ファイルのURLと有効期限も保持し、期限内ならメッセージを取得せずに表示できる。
+
+    閲覧が集中したときにプールを使い切らないよう、
+    - 同時に来た問い合わせは batch_delay 秒まとめて1回の unnest で引き、
+    - 書き込みはメモリに溜めて flush（start後は flush_interval 秒ごと）で
+      executemany にまとめ、
+    - prefetch で閲覧者の最近のスレッド分を先に読み込む。
+    読み込んだ結果と未反映の書き込みはメモリ上に保持し、以降はDBに問い合わせない。
     """
 
-    def __init__(self, pool: asyncpg.Pool):
+    def __init__(
+        self,
+        pool: asyncpg.Pool,
+        cache_size: int = IMAGE_CACHE_SIZE,
+        prefetch_threads: int = IMAGE_CACHE_PREFETCH_THREADS,
+        flush_interval: float = IMAGE_CACHE_FLUSH_INTERVAL,
+        batch_delay: float = IMAGE_CACHE_BATCH_DELAY,
+    ):
         self._pool = pool
+        self._prefetch_threads = prefetch_threads
+        self._flush_interval = flush_interval
+        self._batch_delay = batch_delay
+        # internal_id -> 読み込み済みの最も古いthread_id（それ以降にない組は未登録）
+        self._prefetched = ByteBudgetLRU(cache_size)
+        # (thread_id, internal_id) -> CachedMessage（件数で上限を設ける）。
+        # 追い出すと「未登録」と判断できなくなるので、そのユーザーの読み込み済みも消す
+        self._messages = ByteBudgetLRU(
+            cache_size, on_evict=lambda key, _: self._prefetched.pop(key[1])
+        )
+        self._pending_writes: dict[tuple[int, int], CachedMessage] = {}
+        self._lookups: dict[tuple[int, int], asyncio.Future] = {}
+        self._lookup_task: Optional[asyncio.Task] = None
+        self._flush_task: Optional[asyncio.Task] = None
 
     async def init(self):
         await self._pool.execute("""
@@ -112,23 +321,394 @@ class ImageCacheMapper:
                 PRIMARY KEY (thread_id, internal_id)
             )
         """)
+        # 閲覧履歴として使う列（prerendered: 事前生成したもので、まだ閲覧されていない）
+        await self._pool.execute("""
+            ALTER TABLE image_cache
+                ADD COLUMN IF NOT EXISTS created_at TIMESTAMP WITH TIME ZONE
+                    NOT NULL DEFAULT NOW(),
+                ADD COLUMN IF NOT EXISTS prerendered BOOLEAN NOT NULL DEFAULT FALSE
+        """)
+        await self._pool.execute("""
+            ALTER TABLE image_cache
+                ADD COLUMN IF NOT EXISTS urls TEXT[] NOT NULL DEFAULT '{}',
+                ADD COLUMN IF NOT EXISTS urls_expire_at TIMESTAMP WITH TIME ZONE
+        """)
+        await self._pool.execute("""
+            CREATE INDEX IF NOT EXISTS idx_image_cache_created_at
+                ON image_cache(created_at)
+        """)
+        await self._pool.execute("""
+            CREATE INDEX IF NOT EXISTS idx_image_cache_internal_id
+                ON image_cache(internal_id, thread_id DESC)
+        """)
+
+    def _cached(self, key: tuple[int, int]) -> tuple[bool, Optional[CachedMessage]]:
+        """メモリ上で分かる場合は (True, CachedMessage またはNone) を返す。"""
+        message = self._pending_writes.get(key)
+        if message is None:
+            message = self._messages.get(key)
+        if message is not None:
+            return True, message
+        oldest = self._prefetched.get(key[1])
+        return oldest is not None and key[0] >= oldest, None
+
+    def _remember(self, key: tuple[int, int], row: asyncpg.Record) -> CachedMessage:
+        message = CachedMessage(
+            row["message_id"],
+            tuple(row["urls"]),
+            row["urls_expire_at"],
+            row["prerendered"],
+        )
+        self._messages.put(key, message, 1)
+        return message
 
     async def get_message_id(self, thread_id: int, internal_id: int) -> Optional[int]:
-        row = await self._pool.fetchrow(
-            "SELECT message_id FROM image_cache WHERE thread_id = $1 AND internal_id = $2",
-            thread_id,
+        message = await self.get_message(thread_id, internal_id)
+        return message.message_id if message is not None else None
+
+    async def get_message(
+        self, thread_id: int, internal_id: int
+    ) -> Optional[CachedMessage]:
+        key = (thread_id, internal_id)
+        known, message = self._cached(key)
+        if known:
+            return message
+        future = self._lookups.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._lookups[key] = future
+            if self._lookup_task is None:
+                lookups = self._lookups
+                self._lookup_task = asyncio.create_task(self._run_lookups(lookups))
+                self._lookup_task.add_done_callback(
+                    lambda _: self._finish_lookups(lookups)
+                )
+        return await asyncio.shield(future)
+
+    async def _run_lookups(self, lookups: dict[tuple[int, int], asyncio.Future]):
+        await asyncio.sleep(self._batch_delay)
+        self._close_lookups(lookups)
+        try:
+            found = await self.get_messages(list(lookups))
+        except Exception as e:
+            for future in lookups.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for key, future in lookups.items():
+            if not future.done():
+                future.set_result(found.get(key))
+
+    def _close_lookups(self, lookups: dict[tuple[int, int], asyncio.Future]):
+        """以降の get_message を次のまとめ引きに回す。"""
+        if self._lookups is lookups:
+            self._lookups = {}
+            self._lookup_task = None
+
+    def _finish_lookups(self, lookups: dict[tuple[int, int], asyncio.Future]):
+        # 取り消された場合（開始前を含む）も、呼び出し元を待たせたままにしない
+        self._close_lookups(lookups)
+        for future in lookups.values():
+            future.cancel()
+
+    async def get_message_ids(
+        self, keys: list[tuple[int, int]]
+    ) -> dict[tuple[int, int], int]:
+        """複数の (thread_id, internal_id) をまとめて引く。
+
+        Returns:
+            {(thread_id, internal_id): message_id}（登録のあるものだけ）
+        """
+        found = await self.get_messages(keys)
+        return {key: message.message_id for key, message in found.items()}
+
+    async def get_messages(
+        self, keys: list[tuple[int, int]]
+    ) -> dict[tuple[int, int], CachedMessage]:
+        """get_message_ids と同じだが、URLと有効期限も返す。"""
+        found = {}
+        missing = []
+        for key in keys:
+            known, message = self._cached(key)
+            if message is not None:
+                found[key] = message
+            elif not known:
+                missing.append(key)
+        if not missing:
+            return found
+        rows = await self._pool.fetch(
+            """
+            SELECT c.thread_id, c.internal_id, c.message_id, c.urls, c.urls_expire_at,
+                c.prerendered
+            FROM image_cache AS c
+            JOIN unnest($1::BIGINT[], $2::INTEGER[]) AS k(thread_id, internal_id)
+                USING (thread_id, internal_id)
+            """,
+            [k[0] for k in missing],
+            [k[1] for k in missing],
+        )
+        for r in rows:
+            key = (r["thread_id"], r["internal_id"])
+            found[key] = self._remember(key, r)
+        return found
+
+    async def prefetch(self, internal_id: int) -> None:
+        """閲覧者の最近のスレッド（prefetch_threads件）の登録をまとめて読み込む。"""
+        if internal_id in self._prefetched:
+            return
+        rows = await self._pool.fetch(
+            """
+            SELECT thread_id, message_id, urls, urls_expire_at, prerendered
+            FROM image_cache
+            WHERE internal_id = $1
+            ORDER BY thread_id DESC
+            LIMIT $2
+            """,
             internal_id,
+            self._prefetch_threads,
         )
-        return row["message_id"] if row is not None else None
+        keys = [(r["thread_id"], internal_id) for r in rows]
+        for key, r in zip(keys, rows):
+            self._remember(key, r)
+        if all(key in self._messages for key in keys):
+            oldest = keys[-1][0] if len(keys) == self._prefetch_threads else 0
+            self._prefetched.put(internal_id, oldest, 1)
 
-    async def set_message_id(self, thread_id: int, internal_id: int, message_id: int) -> None:
-        await self._pool.execute(
+    async def set_message_id(
+        self,
+        thread_id: int,
+        internal_id: int,
+        message_id: int,
+        urls: tuple[str, ...] = (),
+        expires_at: Optional[datetime.datetime] = None,
+    ) -> None:
+        """登録する（添付ファイルのURLの更新にも使う）。
+
+        DBへの書き込みは次の flush で行う。
+
+        Args:
+            thread_id: 元画像を保管しているスレッドのID
+            internal_id: 閲覧者の内部ID
+            message_id: 暗号化済み画像を保存したメッセージのID
+            urls: 添付ファイルのURL
+            expires_at: URLの有効期限（期限のないURLならNone）
+        """
+        key = (thread_id, internal_id)
+        message = CachedMessage(message_id, tuple(urls), expires_at)
+        self._pending_writes[key] = message
+        self._messages.put(key, message, 1)
+
+    async def flush(self) -> None:
+        """溜まっている書き込みを1回の executemany でDBに反映する。"""
+        if not self._pending_writes:
+            return
+        writes, self._pending_writes = self._pending_writes, {}
+        try:
+            await self._pool.executemany(
+                """
+                INSERT INTO image_cache
+                    (thread_id, internal_id, message_id, urls, urls_expire_at)
+                VALUES ($1, $2, $3, $4, $5)
+                ON CONFLICT (thread_id, internal_id) DO UPDATE SET
+                    message_id = EXCLUDED.message_id,
+                    urls = EXCLUDED.urls,
+                    urls_expire_at = EXCLUDED.urls_expire_at,
+                    prerendered = FALSE
+                """,
+                [
+                    (t, i, m.message_id, list(m.urls), m.expires_at)
+                    for (t, i), m in writes.items()
+                ],
+            )
+        except BaseException:
+            # 次回の flush で書き込む（その間の新しい書き込みを優先）
+            for key, message in writes.items():
+                self._pending_writes.setdefault(key, message)
+            raise
+
+    def start(self):
+        """flush を flush_interval 秒ごとに実行する（実行中なら何もしない）。"""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """定期実行を止め、未反映の書き込みを反映する。"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except (asyncpg.PostgresError, OSError) as e:
+                print(e)
+
+    async def add_prerendered(
+        self,
+        thread_id: int,
+        internal_id: int,
+        message_id: int,
+        urls: tuple[str, ...] = (),
+        expires_at: Optional[datetime.datetime] = None,
+    ) -> bool:
+        """事前生成した画像を登録する。既に閲覧済み（登録済み）なら何もしない。
+
+        引数は set_message_id と同じ。
+
+        Returns:
+            登録したか
+        """
+        key = (thread_id, internal_id)
+        if self._cached(key)[1] is not None:
+            return False
+        row = await self._pool.fetchrow(
             """
-            INSERT INTO image_cache (thread_id, internal_id, message_id)
-            VALUES ($1, $2, $3)
-            ON CONFLICT (thread_id, internal_id) DO UPDATE SET message_id = EXCLUDED.message_id
+            INSERT INTO image_cache
+                (thread_id, internal_id, message_id, urls, urls_expire_at, prerendered)
+            VALUES ($1, $2, $3, $4, $5, TRUE)
+            ON CONFLICT (thread_id, internal_id) DO NOTHING
+            RETURNING message_id, urls, urls_expire_at, prerendered
             """,
             thread_id,
             internal_id,
             message_id,
+            list(urls),
+            expires_at,
+        )
+        if row is None:
+            return False
+        self._remember(key, row)
+        return True
+
+    async def forget_internal_ids(self, internal_ids: list[int]) -> None:
+        """回収した内部IDの暗号化済み画像を、新しいユーザーに返さないよう消す。"""
+        forgotten = set(internal_ids)
+        for key in [k for k in self._pending_writes if k[1] in forgotten]:
+            del self._pending_writes[key]
+        # まれな処理なので、メモリ上の読み込み結果はすべて捨てる
+        self._messages.clear()
+        self._prefetched.clear()
+        await self._pool.execute(
+            "DELETE FROM image_cache WHERE internal_id = ANY($1::INTEGER[])",
+            internal_ids,
+        )
+
+    async def mark_viewed(self, thread_id: int, internal_id: int) -> None:
+        """事前生成した画像が閲覧されたことを記録する。DBへの反映は次の flush で行う。
+
+        事前生成したものでなければ何もしない。
+        """
+        key = (thread_id, internal_id)
+        message = self._cached(key)[1]
+        if message is None or not message.prerendered:
+            return
+        # flush の upsert が prerendered を FALSE にする
+        message = message._replace(prerendered=False)
+        self._pending_writes[key] = message
+        self._messages.put(key, message, 1)
+
+    async def active_viewers(self, limit: int, days: int) -> list[tuple[int, int]]:
+        """直近days日間に閲覧した投稿数の多いユーザーを返す（事前生成のみの分は数えない）。
+
+        Returns:
+            [(internal_id, 閲覧した投稿数)]（多い順）
+        """
+        await self.flush()
+        rows = await self._pool.fetch(
+            """
+            SELECT internal_id, COUNT(*) AS views
+            FROM image_cache
+            WHERE NOT prerendered
+                AND created_at > NOW() - make_interval(days => $2)
+            GROUP BY internal_id
+            ORDER BY views DESC, internal_id
+            LIMIT $1
+            """,
+            limit,
+            days,
         )
+        return [(r["internal_id"], r["views"]) for r in rows]
+
+
+def _to_signed64(v: int) -> int:
+    """符号なし64bit整数をBIGINTに格納できる符号付きに変換する。"""
+    return v - (1 << 64) if v >= (1 << 63) else v
+
+
+class ImageHashMapper:
+    """ID_ROOM_BOTに保管された元画像の知覚ハッシュをPostgreSQLで永続化する。
+
+    (thread_id, 添付ファイルの番号) → (ahash, phash, dhash, 画像サイズ)。
+    起動時に全件を読み込んでBK木を構築し、流出調査や重複投稿の検出に使う
+    ハミング距離の近傍検索はメモリ上で行う。
+    """
+
+    def __init__(self, pool: asyncpg.Pool):
+        self._pool = pool
+        self._tree = BKTree()
+        self._threads: set[int] = set()
+
+    async def init(self):
+        """テーブルが存在しなければ作成し、登録済みのハッシュを読み込む。"""
+        await self._pool.execute("""
+            CREATE TABLE IF NOT EXISTS image_hash (
+                thread_id BIGINT NOT NULL,
+                attachment_index INTEGER NOT NULL,
+                ahash BIGINT NOT NULL,
+                phash BIGINT NOT NULL,
+                dhash BIGINT NOT NULL,
+                width INTEGER NOT NULL,
+                height INTEGER NOT NULL,
+                PRIMARY KEY (thread_id, attachment_index)
+            )
+        """)
+        rows = await self._pool.fetch(
+            "SELECT thread_id, attachment_index, ahash, phash, dhash FROM image_hash"
+        )
+        mask = (1 << 64) - 1
+        for r in rows:
+            key = (r["ahash"] & mask, r["phash"] & mask, r["dhash"] & mask)
+            self._tree.add(key, (r["thread_id"], r["attachment_index"]))
+            self._threads.add(r["thread_id"])
+
+    def threads(self) -> set[int]:
+        """登録済みのthread_idの集合。"""
+        return self._threads
+
+    async def add(self, thread_id: int, hashes: list[dict]) -> None:
+        """1投稿分の元画像のハッシュ（hash_jobの結果のリスト）を登録する。"""
+        keys = [hash_key(h) for h in hashes]
+        await self._pool.executemany(
+            """
+            INSERT INTO image_hash
+                (thread_id, attachment_index, ahash, phash, dhash, width, height)
+            VALUES ($1, $2, $3, $4, $5, $6, $7)
+            ON CONFLICT (thread_id, attachment_index) DO UPDATE SET
+                ahash = EXCLUDED.ahash,
+                phash = EXCLUDED.phash,
+                dhash = EXCLUDED.dhash,
+                width = EXCLUDED.width,
+                height = EXCLUDED.height
+            """,
+            [
+                (thread_id, i, *(_to_signed64(v) for v in key), h["width"], h["height"])
+                for i, (key, h) in enumerate(zip(keys, hashes))
+            ],
+        )
+        for i, key in enumerate(keys):
+            self._tree.add(key, (thread_id, i))
+        self._threads.add(thread_id)
+
+    def search(
+        self, hashes: dict, limit: int, max_distance: int
+    ) -> list[tuple[int, int, int]]:
+        """hashesに近い元画像を距離の小さい順に返す。
+
+        Returns:
+            [(距離, thread_id, 添付ファイルの番号)] 最大limit件
+        """
+        found = self._tree.search(hash_key(hashes), max_distance)
+        return [(d, thread_id, index) for d, (thread_id, index) in found[:limit]]
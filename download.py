@@ -0,0 +1,126 @@
+import asyncio
+import tempfile
+from io import BytesIO
+from typing import IO, Optional
+
+import aiohttp
+
+from perf import AsyncStageTimer
+from constants import (
+    DOWNLOAD_CONCURRENCY,
+    DOWNLOAD_RETRIES,
+    DOWNLOAD_BACKOFF,
+    DOWNLOAD_TIMEOUT,
+    DOWNLOAD_SPOOL_BYTES,
+    DOWNLOAD_CHUNK_BYTES,
+)
+
+# 一時的な失敗とみなして再試行するHTTPステータス
+_RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+
+
+def _retryable(e: Exception) -> bool:
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status in _RETRY_STATUSES
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+class AttachmentDownloader:
+    """添付ファイルを、同時に接続する数を制限しながら並行してダウンロードする。
+
+    本文は少しずつ読み、spool_bytes まではメモリに、超えた分は一時ファイルに書く。
+    接続の失敗や一時的なエラー（5xx・429）は指数バックオフで再試行する。
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = DOWNLOAD_CONCURRENCY,
+        retries: int = DOWNLOAD_RETRIES,
+        backoff: float = DOWNLOAD_BACKOFF,
+        timeout: float = DOWNLOAD_TIMEOUT,
+        spool_bytes: int = DOWNLOAD_SPOOL_BYTES,
+    ):
+        """
+        Args:
+            max_concurrency: 同時にダウンロードする数の上限（全体で共有）
+            retries: 再試行の回数
+            backoff: 最初の再試行までの待ち時間（秒、以降は倍々に延ばす）
+            timeout: 1回のダウンロードのタイムアウト（秒）
+            spool_bytes: これを超えたら一時ファイルに書き出す（バイト）
+        """
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._retries = retries
+        self._backoff = backoff
+        self._timeout = timeout
+        self._spool_bytes = spool_bytes
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self._timeout)
+            )
+        return self._session
+
+    async def fetch(self, url: str, stage: str = "download") -> IO[bytes]:
+        """1件をダウンロードする。
+
+        Returns:
+            先頭にシークしたファイルオブジェクト（BytesIO または一時ファイル）。
+            使い終わったら閉じること
+        """
+        async with AsyncStageTimer(stage):
+            for attempt in range(self._retries + 1):
+                try:
+                    # バックオフ中は枠を空けて、他のダウンロードを進める
+                    async with self._semaphore:
+                        return await self._fetch_once(url)
+                except Exception as e:
+                    if attempt == self._retries or not _retryable(e):
+                        raise
+                    delay = self._backoff * 2**attempt
+                    print(f"download failed ({e!r}), retry in {delay:.1f}s: {url}")
+                    await asyncio.sleep(delay)
+
+    async def fetch_all(
+        self, urls: list[str], stage: str = "download"
+    ) -> list[IO[bytes]]:
+        """複数を並行してダウンロードする。1件でも失敗したら他を閉じて例外を送出する。
+
+        各ダウンロードの所要時間は "{stage}/{番号}" として記録する。
+        """
+        results = await asyncio.gather(
+            *(self.fetch(url, f"{stage}/{i}") for i, url in enumerate(urls)),
+            return_exceptions=True,
+        )
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            for r in results:
+                if not isinstance(r, BaseException):
+                    r.close()
+            raise errors[0]
+        return results
+
+    async def _fetch_once(self, url: str) -> IO[bytes]:
+        fp: IO[bytes] = BytesIO()
+        try:
+            async with self._get_session().get(url) as resp:
+                resp.raise_for_status()
+                async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_BYTES):
+                    if isinstance(fp, BytesIO) and (
+                        fp.tell() + len(chunk) > self._spool_bytes
+                    ):
+                        spilled = tempfile.TemporaryFile()
+                        spilled.write(fp.getbuffer())
+                        fp = spilled
+                    fp.write(chunk)
+        except BaseException:
+            fp.close()
+            raise
+        fp.seek(0)
+        return fp
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
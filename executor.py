@@ -0,0 +1,227 @@
+import asyncio
+import datetime
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from myCrypter import myCrypter, TraceResult
+from myImageCodec import (
+    EncodedImage,
+    ImageSource,
+    bytes2image,
+    encodeBands,
+    encodePreview,
+    image2bytes,
+    loadPixels,
+    previewImage,
+    shrinkToLimit,
+    WEBP_MAX_SIDE,
+)
+from perf import StageTimer, metrics, profiler
+from constants import (
+    ENCRYPT_MAX_PENDING,
+    ENCRYPT_JOB_TIMEOUT,
+    ENCRYPT_BAND_MIN_PIXELS,
+    ENCODE_PROFILE,
+    DISCORD_UPLOAD_LIMIT,
+)
+
+
+def encrypt_job(
+    data: ImageSource,
+    internal_id: int,
+    label: str,
+    timestamp: datetime.datetime,
+    profile: str = ENCODE_PROFILE,
+    decoded_path: Optional[str] = None,
+) -> EncodedImage:
+    """ワーカープロセス内で1枚の画像を暗号化し、エンコードする。
+
+    Args:
+        data: 元画像ファイルのバイト列、またはキャッシュ済みファイルのパス
+        internal_id: 埋め込む16bit内部ID
+        label: 埋め込む閲覧者名
+        timestamp: 埋め込む閲覧日時
+        profile: エンコードのプロファイル（myImageCodec.ENCODE_PROFILES）
+        decoded_path: 展開済みの画素の .npy ファイル。あればデコードを省略し、
+            なければデコード結果を書き出す（cache.DecodedCache）
+
+    Returns:
+        EncodedImage
+    """
+    with StageTimer("worker/image_convert_rgba"):
+        im = loadPixels(data, decoded_path)
+    mycrypter = myCrypter(im)
+    mycrypter.setChannel([True, False, False, True]).encryptByID(
+        internal_id
+    ).setChannel([False, False, True, True]).encryptByLabel(label).encryptByTime(
+        timestamp
+    )
+
+    # 大きな画像は帯ごとに暗号化してそのままPNGに流し、全体の配列を作らない
+    width, height = mycrypter.originalImageData.size
+    if width * height >= ENCRYPT_BAND_MIN_PIXELS and profile in ("fast_png", "capped"):
+        with StageTimer("worker/encrypt_banded"):
+            encoded = encodeBands(mycrypter.iterEncryptedBands(), width, height)
+        if profile == "fast_png" or len(encoded.data) <= DISCORD_UPLOAD_LIMIT:
+            return encoded
+        # 上限を超える場合は、従来どおり画像全体から別の形式・縮小を試す
+        if max(width, height) > WEBP_MAX_SIDE:
+            # WebPにはできないので、PNGのまま縮小する（PNGのエンコードはやり直さない）
+            with StageTimer("worker/encrypt"):
+                encrypted_im = mycrypter.executeEncryption()
+            with StageTimer("image2file/capped"):
+                return shrinkToLimit(encrypted_im, encoded, DISCORD_UPLOAD_LIMIT)
+
+    with StageTimer("worker/encrypt"):
+        encrypted_im = mycrypter.executeEncryption()
+    return image2bytes(encrypted_im, profile)
+
+
+def trace_job(leaked: ImageSource, original: ImageSource) -> TraceResult:
+    """ワーカープロセス内で流出画像から内部IDを復元する。"""
+    with StageTimer("worker/trace"):
+        image_original = bytes2image(original)
+        return myCrypter(image_original).traceID(bytes2image(leaked), image_original)
+
+
+def preview_job(data: ImageSource) -> EncodedImage:
+    """ワーカープロセス内でぼかしプレビューを作り、パレットPNGにエンコードする。"""
+    with StageTimer("worker/preview"):
+        preview = previewImage(data)
+    return encodePreview(preview)
+
+
+def _run_job(profiling: bool, fn, *args):
+    """ワーカープロセスで fn を実行し、結果とワーカー内で計測した所要時間を返す。
+
+    メインプロセスでプロファイリング中なら、ワーカーでもステージごとのRSSの増加を記録する。
+    """
+    profiler.enabled = profiling
+    return fn(*args), metrics.drain()
+
+
+class EncryptExecutor:
+    """暗号化処理をプロセスプールで実行し、イベントループをブロックしない。
+
+    同時に受け付けるジョブ数をセマフォで制限（バックプレッシャー）し、
+    1ジョブごとにタイムアウトを設定する。
+    """
+
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        max_pending: int = ENCRYPT_MAX_PENDING,
+        job_timeout: float = ENCRYPT_JOB_TIMEOUT,
+        encode_profile: str = ENCODE_PROFILE,
+    ):
+        self._max_workers = max_workers or os.cpu_count() or 1
+        self._job_timeout = job_timeout
+        self._encode_profile = encode_profile
+        self._semaphore = asyncio.Semaphore(max_pending)
+        self._pending = 0
+        self._pool = ProcessPoolExecutor(max_workers=self._max_workers)
+
+    @property
+    def pending(self) -> int:
+        """投入済みで完了していないジョブ数。"""
+        return self._pending
+
+    async def run(self, fn, *args):
+        """任意の関数をプロセスプールで実行する。
+
+        タイムアウトしてもワーカーは処理を続けるので、そのジョブの枠は実際に
+        終わるまで空けない。
+
+        Raises:
+            asyncio.TimeoutError: job_timeout秒以内に完了しなかった場合
+            BrokenProcessPool: 実行中にワーカーが異常終了した場合（プールは作り直す）
+        """
+        await self._semaphore.acquire()
+        self._pending += 1
+        future = None
+        try:
+            loop = asyncio.get_running_loop()
+            pool = self._pool
+            try:
+                future = loop.run_in_executor(
+                    pool, _run_job, profiler.enabled, fn, *args
+                )
+            except BrokenProcessPool:
+                # ワーカーが異常終了した場合はプールを作り直して再投入する
+                pool = self._recycle_pool(pool)
+                future = loop.run_in_executor(
+                    pool, _run_job, profiler.enabled, fn, *args
+                )
+            try:
+                result, worker_metrics = await asyncio.wait_for(
+                    asyncio.shield(future), self._job_timeout
+                )
+            except BrokenProcessPool:
+                # 実行中に異常終了した場合、同じプールの他のジョブも失われている
+                self._recycle_pool(pool)
+                raise
+            metrics.merge(worker_metrics)
+            return result
+        finally:
+            if future is not None and not future.done():
+                future.add_done_callback(self._release)
+            else:
+                self._release()
+
+    def _release(self, future: Optional[asyncio.Future] = None):
+        if future is not None and not future.cancelled():
+            future.exception()  # 待つ人のいない結果の例外を回収する
+        self._pending -= 1
+        self._semaphore.release()
+
+    def _recycle_pool(self, broken: ProcessPoolExecutor) -> ProcessPoolExecutor:
+        """壊れたプールを作り直す。他のジョブが作り直し済みならそれを返す。"""
+        if self._pool is broken:
+            broken.shutdown(wait=False)
+            self._pool = ProcessPoolExecutor(max_workers=self._max_workers)
+        return self._pool
+
+    async def encrypt(
+        self,
+        data: ImageSource,
+        internal_id: int,
+        label: str,
+        timestamp: datetime.datetime,
+        decoded_path: Optional[str] = None,
+    ) -> EncodedImage:
+        """1枚の画像を暗号化する。引数・戻り値はencrypt_jobと同じ。"""
+        return await self.run(
+            encrypt_job,
+            data,
+            internal_id,
+            label,
+            timestamp,
+            self._encode_profile,
+            decoded_path,
+        )
+
+    async def encrypt_many(
+        self,
+        datas: list[ImageSource],
+        internal_id: int,
+        label: str,
+        timestamp: datetime.datetime,
+        decoded_paths: Optional[list[Optional[str]]] = None,
+    ) -> list[EncodedImage]:
+        """1投稿分の画像をワーカーに分散して暗号化する。順序は入力と同じ。"""
+        decoded_paths = decoded_paths or [None] * len(datas)
+        return await asyncio.gather(
+            *(
+                self.encrypt(d, internal_id, label, timestamp, p)
+                for d, p in zip(datas, decoded_paths)
+            )
+        )
+
+    async def trace(self, leaked: ImageSource, original: ImageSource) -> TraceResult:
+        """流出画像と元画像から内部IDを復元する。"""
+        return await self.run(trace_job, leaked, original)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,90 @@
+from typing import Any, Hashable, Optional
+
+import imagehash
+
+from myImageCodec import ImageSource, openImage
+from perf import StageTimer
+
+HASH_KINDS = ("ahash", "phash", "dhash")
+
+HashKey = tuple[int, int, int]
+
+
+def hash_job(data: ImageSource) -> dict:
+    """ワーカープロセス内で画像の知覚ハッシュ（average/perceptual/difference）を計算する。
+
+    Returns:
+        {"ahash": str, "phash": str, "dhash": str, "width": int, "height": int}
+    """
+    with StageTimer("worker/perceptual_hash"):
+        im = openImage(data)
+        return {
+            "ahash": str(imagehash.average_hash(im)),
+            "phash": str(imagehash.phash(im)),
+            "dhash": str(imagehash.dhash(im)),
+            "width": im.width,
+            "height": im.height,
+        }
+
+
+def hash_key(hashes: dict) -> HashKey:
+    """hash_jobの結果を、3種類の64bitハッシュ（符号なし整数）の組に変換する。"""
+    return tuple(int(hashes[k], 16) for k in HASH_KINDS)
+
+
+def hash_distance(a: HashKey, b: HashKey) -> int:
+    """3種類のハッシュのハミング距離の合計（最大192）。"""
+    return sum(bin(x ^ y).count("1") for x, y in zip(a, b))
+
+
+class BKTree:
+    """ハッシュの組をキーにしたBK木。hash_distanceによる半径検索を行う。
+
+    同じ項目を別のキーで再登録した場合は新しいキーだけが有効になる。
+    """
+
+    def __init__(self):
+        # ノードは [キー, 項目のリスト, {距離: 子ノード}]
+        self._root: Optional[list] = None
+        self._keys: dict[Hashable, HashKey] = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, key: HashKey, item: Hashable):
+        if self._keys.get(item) == key:
+            return
+        self._keys[item] = key
+        if self._root is None:
+            self._root = [key, [item], {}]
+            return
+        node = self._root
+        while True:
+            d = hash_distance(key, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [key, [item], {}]
+                return
+            node = child
+
+    def search(self, key: HashKey, radius: int) -> list[tuple[int, Any]]:
+        """keyから距離radius以内の項目を距離の小さい順に返す。
+
+        Returns:
+            [(距離, 項目)]
+        """
+        found = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            d = hash_distance(key, node[0])
+            if d <= radius:
+                found += [(d, i) for i in node[1] if self._keys.get(i) == node[0]]
+            for cd, child in node[2].items():
+                if d - radius <= cd <= d + radius:
+                    stack.append(child)
+        found.sort()
+        return found
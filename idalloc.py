@@ -0,0 +1,73 @@
+from typing import Iterable, Optional
+
+_WORD_BITS = 64
+_WORD_MASK = (1 << _WORD_BITS) - 1
+
+
+def _lowest_bit(x: int) -> int:
+    return (x & -x).bit_length() - 1
+
+
+class FreeIdBitmap:
+    """0〜size-1 のIDの空きを2段のビットマップで管理する。
+
+    下段は64個ずつのIDの空き（1 = 空き）を1語に持ち、上段は下段の各語に
+    空きがあるかを1bitずつ持つ。最小の空きIDは上段・下段の最下位ビットを
+    1回ずつ調べるだけで求まるので、割り当て済みのID数によらない。
+    """
+
+    def __init__(self, size: int, used: Iterable[int] = ()):
+        self._size = size
+        nwords = -(-size // _WORD_BITS)
+        self._words = [_WORD_MASK] * nwords
+        if size % _WORD_BITS:
+            self._words[-1] = (1 << (size % _WORD_BITS)) - 1
+        self._summary = (1 << nwords) - 1
+        self._free = size
+        for i in used:
+            self.acquire(i)
+
+    def __len__(self) -> int:
+        """空いているIDの数。"""
+        return self._free
+
+    def is_free(self, i: int) -> bool:
+        return bool(self._words[i // _WORD_BITS] >> (i % _WORD_BITS) & 1)
+
+    def allocate(self) -> Optional[int]:
+        """最小の空きIDを使用中にして返す。空きがなければNone。"""
+        if not self._summary:
+            return None
+        w = _lowest_bit(self._summary)
+        i = w * _WORD_BITS + _lowest_bit(self._words[w])
+        self.acquire(i)
+        return i
+
+    def acquire(self, i: int) -> bool:
+        """IDを使用中にする。
+
+        Returns:
+            空いていたか
+        """
+        w, b = divmod(i, _WORD_BITS)
+        if not self._words[w] >> b & 1:
+            return False
+        self._words[w] &= ~(1 << b)
+        if not self._words[w]:
+            self._summary &= ~(1 << w)
+        self._free -= 1
+        return True
+
+    def release(self, i: int) -> bool:
+        """IDを空きに戻す。
+
+        Returns:
+            使用中だったか
+        """
+        w, b = divmod(i, _WORD_BITS)
+        if self._words[w] >> b & 1:
+            return False
+        self._words[w] |= 1 << b
+        self._summary |= 1 << w
+        self._free += 1
+        return True
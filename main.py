@@ -1,18 +1,36 @@
 import discord
 import os
 import json
+import asyncio
+import datetime
+import logging
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
+from typing import Literal, Optional
+from urllib.parse import parse_qs, urlparse
 from PIL import Image
-import imagehash
 from dotenv import load_dotenv
-import gc
-from memory_profiler import profile
 
 import asyncpg
 
-from db import UserIdMapper, ImageCacheMapper
+from cache import DecodedCache, OriginalCache
+from db import UserIdMapper, ImageCacheMapper, ImageHashMapper
+from download import AttachmentDownloader
+from executor import EncryptExecutor, preview_job
+from hashindex import hash_job
 from myCrypter import myCrypter
-from perf import StageTimer, AsyncStageTimer, TotalTimer
+from myImageCodec import EncodedImage, ImageSource, image2bytes
+from prerender import PrerenderJob, PrerenderQueue
+from singleflight import SingleFlight
+from perf import (
+    StageTimer,
+    AsyncStageTimer,
+    TotalTimer,
+    metrics,
+    profiler,
+    current_rss_kb,
+    start_metrics_server,
+)
 from constants import (
     MASKBIT_ROW,
     MASKBIT_COLUMN,
@@ -32,8 +50,33 @@ from constants import (
     KEY_ID,
     KEY_THREAD_ID,
     KEY_AUTHOR_ID,
+    ENCRYPT_MAX_PENDING,
+    ENCRYPT_JOB_TIMEOUT,
+    ENCODE_PROFILE,
+    LEAKSCAN_CANDIDATES,
+    LEAKSCAN_MAX_DISTANCE,
+    DUPLICATE_MAX_DISTANCE,
+    ORIGINAL_CACHE_DIR,
+    ORIGINAL_CACHE_BYTES,
+    DECODED_CACHE_DIR,
+    DECODED_CACHE_BYTES,
+    PRERENDER_ENABLED,
+    PRERENDER_VIEWERS,
+    PRERENDER_HISTORY_DAYS,
+    PRERENDER_CPU_BUDGET,
+    USER_ID_RETENTION_DAYS,
+    ATTACHMENT_URL_MARGIN,
+    DOWNLOAD_CONCURRENCY,
+    METRICS_HOST,
+    METRICS_PORT,
+    PROFILE_ENABLED,
+    PROFILE_SNAPSHOT_INTERVAL,
+    PROFILE_SNAPSHOTS,
+    PROFILE_TRACE_FRAMES,
 )
 
+logger = logging.getLogger("piccord.main")
+
 # 開発時に環境変数をロード
 try:
     load_dotenv()
@@ -45,9 +88,40 @@ ID_ROOM_BOT = int(os.getenv("ID_ROOM_BOT"))
 ID_ROOM_VIEW = int(os.getenv("ID_ROOM_SHOMIN"))  # 投稿された画像が表示される
 ID_ROOM_PIC = int(os.getenv("ID_ROOM_PIC"))  # 投稿する画像を投稿する
 DATABASE_URL = os.getenv("DATABASE_URL")
+# 暗号化プールの設定（未設定ならCPUコア数・constantsの既定値）
+ENCRYPT_POOL_SIZE = int(os.getenv("ENCRYPT_POOL_SIZE", "0")) or None
+ENCRYPT_MAX_PENDING = int(os.getenv("ENCRYPT_MAX_PENDING", ENCRYPT_MAX_PENDING))
+ENCRYPT_JOB_TIMEOUT = float(os.getenv("ENCRYPT_JOB_TIMEOUT", ENCRYPT_JOB_TIMEOUT))
+ENCODE_PROFILE = os.getenv("ENCODE_PROFILE", ENCODE_PROFILE)
+ORIGINAL_CACHE_DIR = os.getenv("ORIGINAL_CACHE_DIR", ORIGINAL_CACHE_DIR)
+ORIGINAL_CACHE_BYTES = int(os.getenv("ORIGINAL_CACHE_BYTES", ORIGINAL_CACHE_BYTES))
+DECODED_CACHE_DIR = os.getenv("DECODED_CACHE_DIR", DECODED_CACHE_DIR)
+DECODED_CACHE_BYTES = int(os.getenv("DECODED_CACHE_BYTES", DECODED_CACHE_BYTES))
+# 透かし入り画像の事前生成（PRERENDER_ENABLED=1 で有効）
+PRERENDER_ENABLED = os.getenv("PRERENDER_ENABLED", str(int(PRERENDER_ENABLED))) == "1"
+PRERENDER_CPU_BUDGET = float(os.getenv("PRERENDER_CPU_BUDGET", PRERENDER_CPU_BUDGET))
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", DOWNLOAD_CONCURRENCY))
+# Prometheus形式のメトリクス（METRICS_PORT を指定すると公開する）
+METRICS_HOST = os.getenv("METRICS_HOST", METRICS_HOST)
+METRICS_PORT = int(os.getenv("METRICS_PORT", METRICS_PORT))
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", str(int(PROFILE_ENABLED))) == "1"
+USER_ID_RETENTION_DAYS = int(
+    os.getenv("USER_ID_RETENTION_DAYS", USER_ID_RETENTION_DAYS)
+)
 
 user_id_mapper: UserIdMapper = None
 image_cache_mapper: ImageCacheMapper = None
+encrypt_executor: EncryptExecutor = None
+image_hash_mapper: ImageHashMapper = None
+original_cache: OriginalCache = None
+decoded_cache: DecodedCache = None
+prerender_queue: PrerenderQueue = None
+reclaim_task: asyncio.Task = None
+attachment_downloader: AttachmentDownloader = None
+metrics_server: asyncio.AbstractServer = None
+# 実行中の閲覧用画像の生成（(thread_id, internal_id) ごと）と添付ファイルのダウンロード
+view_flights = SingleFlight()
+download_flights = SingleFlight()
 
 # discord.pyの処理
 
@@ -183,23 +257,58 @@ class myUploader:
         total = TotalTimer("upload")
         total.start()
 
-        async with AsyncStageTimer("upload/discord_create_thread_and_send"):
-            thread = await self.botroom.create_thread(
-                name=files[0].filename, auto_archive_duration=60
-            )
-            thread_id = thread.id
-            msg_in_botroom = await thread.send(None, files=files)
-        attachment = msg_in_botroom.attachments[0]
-
-        im = file2image(files[0])
-        with StageTimer("upload/resize_thumbnail"):
-            w, h = im.size
-            block_px = max(16, max(w, h) // 80)
-            blur: Image.Image = im.resize(
-                (max(1, w // block_px), max(1, h // block_px)), Image.Resampling.BOX
-            ).resize((w, h), Image.Resampling.NEAREST)
-        with StageTimer("upload/png_encode_blur"):
-            blurfile = image2file(blur)
+        datas = []
+        for f in files:
+            datas.append(f.fp.read())
+            f.reset()
+
+        # ぼかしプレビューは縮小したまま作るので、スレッドの作成と並行して進める
+        previews_future = asyncio.gather(
+            *(encrypt_executor.run(preview_job, d) for d in datas)
+        )
+
+        try:
+            async with AsyncStageTimer("upload/discord_create_thread_and_send"):
+                thread = await self.botroom.create_thread(
+                    name=files[0].filename, auto_archive_duration=60
+                )
+                thread_id = thread.id
+                msg_in_botroom = await thread.send(None, files=files)
+
+            # 閲覧時にDiscordから再ダウンロードしないよう元画像を保存
+            async with AsyncStageTimer("upload/original_cache_put"):
+                await asyncio.to_thread(
+                    original_cache.put,
+                    thread_id,
+                    [
+                        (a.id, a.filename, d)
+                        for a, d in zip(msg_in_botroom.attachments, datas)
+                    ],
+                )
+
+            # 流出調査・重複検出用に元画像の知覚ハッシュを登録
+            async with AsyncStageTimer("upload/perceptual_hash"):
+                hashes = await asyncio.gather(
+                    *(encrypt_executor.run(hash_job, d) for d in datas)
+                )
+                duplicates = 0
+                for h in hashes:
+                    for distance, dup_thread_id, _ in image_hash_mapper.search(
+                        h, 1, DUPLICATE_MAX_DISTANCE
+                    ):
+                        logger.info(
+                            f"duplicate upload? thread {dup_thread_id}"
+                            f" (distance {distance})"
+                        )
+                        duplicates += 1
+                await image_hash_mapper.add(thread_id, hashes)
+            if duplicates:
+                metrics.increment("upload/duplicate", duplicates)
+        except BaseException:
+            # 失敗したプレビューの例外が取得されないまま残らないよう、止めて待つ
+            previews_future.cancel()
+            await asyncio.gather(previews_future, return_exceptions=True)
+            raise
 
         if parameter:
             custom_id_viewing_dict = parameter.copy()
@@ -217,8 +326,22 @@ class myUploader:
         custom_id_removing_dict["author_id"] = self.id_author
         custom_id_removing = json.dumps(custom_id_removing_dict)
 
-        self.embed1.set_image(url=f"attachment://{blurfile.filename}")
+        async with AsyncStageTimer("upload/preview"):
+            previews = await previews_future
+        blurfiles = [encoded2file(p, f"preview{i}") for i, p in enumerate(previews)]
+        # 全ての画像のプレビューを、同じ url の embeds でギャラリーにまとめる
+        self.embed1.url = _GALLERY_URL
+        self.embed1.set_image(url=f"attachment://{blurfiles[0].filename}")
+        embeds = [self.embed1] + [
+            discord.Embed(url=_GALLERY_URL).set_image(url=f"attachment://{f.filename}")
+            for f in blurfiles[1:]
+        ]
         self.embed1.add_field(name=" ", value="{}枚の画像".format(len(files)))
+        if duplicates:
+            self.embed1.add_field(
+                name="重複の可能性",
+                value="{}枚が以前に投稿された画像と似ています".format(duplicates),
+            )
 
         components = discord.ui.View(timeout=None)
         components.add_item(
@@ -239,8 +362,15 @@ class myUploader:
         )
         async with AsyncStageTimer("upload/discord_send_preview_to_chatroom"):
             await self.chatroom.send(
-                None, file=blurfile, embed=self.embed1, view=components
+                None, files=blurfiles, embeds=embeds, view=components
+            )
+
+        # よく閲覧するユーザー向けの画像を、空いている時間に事前生成しておく
+        if prerender_queue is not None:
+            viewers = await image_cache_mapper.active_viewers(
+                PRERENDER_VIEWERS, PRERENDER_HISTORY_DAYS
             )
+            prerender_queue.schedule(thread_id, viewers)
         total.stop()
 
 
@@ -441,7 +571,6 @@ async def createMyUploader(
     return myuploader
 
 
-# @profile
 def file2image(file: discord.File) -> Image.Image:
     im = Image.open(file.fp)
     file.fp.seek(0)
@@ -450,18 +579,20 @@ def file2image(file: discord.File) -> Image.Image:
     return im
 
 
-# @profile
-def image2file(image: Image.Image) -> discord.File:
-    with StageTimer("image2file/png_encode"):
-        fileio = BytesIO()
-        image.save(fileio, format="png", compress_level=1)
-        fileio.seek(0)
-    with StageTimer("image2file/imagehash"):
-        hash = imagehash.average_hash(image)
-    file = discord.File(fileio, filename=f"{hash}.png")
+def image2file(image: Image.Image, profile: str = "fast_png") -> discord.File:
+    encoded = image2bytes(image, profile)
+    file = discord.File(
+        BytesIO(encoded.data), filename=f"{encoded.hash}.{encoded.format}"
+    )
     return file
 
 
+def encoded2file(encoded: EncodedImage, filename: str) -> discord.File:
+    """エンコード結果をdiscord.Fileにする。拡張子は実際の形式に合わせる。"""
+    stem = os.path.splitext(filename)[0]
+    return discord.File(BytesIO(encoded.data), filename=f"{stem}.{encoded.format}")
+
+
 @client.event
 async def on_message(msg: discord.Message):
     if msg.author.bot:
@@ -478,7 +609,16 @@ async def processImageUpload(msg: discord.Message, ctx: discord.Interaction = No
     myuploader.setTitle(
         f"{msg.author.display_name}さんの画像がアップロードされました"
     ).setAuthor(str(msg.author.id))
-    files = [await s.to_file() for s in msg.attachments]
+    async with AsyncStageTimer("upload/download_attachments"):
+        fps = await attachment_downloader.fetch_all(
+            [a.url for a in msg.attachments], "upload/download"
+        )
+    files = [
+        discord.File(
+            fp, filename=a.filename, spoiler=a.is_spoiler(), description=a.description
+        )
+        for a, fp in zip(msg.attachments, fps)
+    ]
     components = myViewforUploadImage(msg, files, myuploader)
     if ctx:
         await ctx.response.send_message(
@@ -491,20 +631,50 @@ async def processImageUpload(msg: discord.Message, ctx: discord.Interaction = No
 _GALLERY_URL = "https://discord.com"
 
 
-def _build_gallery_embeds(attachments) -> list[discord.Embed]:
+def _build_gallery_embeds(urls: list[str]) -> list[discord.Embed]:
     """同一 url を持つ embeds を返す。Discord がギャラリー1カードに束ねる。"""
     embeds = []
-    for i, a in enumerate(attachments):
+    for i, url in enumerate(urls):
         e = discord.Embed(color=0x00DD00, url=_GALLERY_URL)
         if i == 0:
             e.title = "画像を表示します"
-            e.add_field(name="画像数", value=f"{len(attachments)}枚")
-        e.set_image(url=a.url)
+            e.add_field(name="画像数", value=f"{len(urls)}枚")
+        e.set_image(url=url)
         embeds.append(e)
     return embeds
 
 
-# @profile
+def _attachmentExpiry(urls: list[str]) -> Optional[datetime.datetime]:
+    """添付ファイルのURLの有効期限（クエリの ex、16進のUNIX時刻）のうち最も早いもの。
+
+    期限のないURLだけならNone。
+    """
+    expiries = []
+    for url in urls:
+        ex = parse_qs(urlparse(url).query).get("ex")
+        if ex:
+            expiries.append(int(ex[0], 16))
+    if not expiries:
+        return None
+    return datetime.datetime.fromtimestamp(min(expiries), datetime.timezone.utc)
+
+
+async def _storeViewMessage(
+    thread_id: int, internal_id: int, msg: discord.Message, prerendered: bool = False
+) -> list[str]:
+    """暗号化済み画像のメッセージを、添付ファイルのURLとともに登録する。
+
+    Returns:
+        添付ファイルのURL。prerendered で既に登録済みだった場合は空のリスト
+    """
+    urls = [a.url for a in msg.attachments]
+    args = (thread_id, internal_id, msg.id, tuple(urls), _attachmentExpiry(urls))
+    if prerendered:
+        return urls if await image_cache_mapper.add_prerendered(*args) else []
+    await image_cache_mapper.set_message_id(*args)
+    return urls
+
+
 @client.event
 async def on_interaction(ctx: discord.Interaction):
     print(ctx.data)
@@ -532,7 +702,6 @@ async def on_interaction(ctx: discord.Interaction):
         #     await processButtonclickImageRemoveNo(ctx,d)
 
 
-@profile
 async def processButtonclickImageView(ctx: discord.Interaction, thread_id: int):
     total = TotalTimer("view")
     total.start()
@@ -543,70 +712,192 @@ async def processButtonclickImageView(ctx: discord.Interaction, thread_id: int):
     async with AsyncStageTimer("view/db_lookup"):
         internal_id = await user_id_mapper.get_or_create_internal_id(ctx.user.id)
 
-    # キャッシュ確認 O(1)
+    # キャッシュ確認 O(1)（初回の操作では最近のスレッド分をまとめて読み込む）
     async with AsyncStageTimer("view/cache_db_lookup"):
-        cached_message_id = await image_cache_mapper.get_message_id(
-            thread_id, internal_id
-        )
+        await image_cache_mapper.prefetch(internal_id)
+        cached = await image_cache_mapper.get_message(thread_id, internal_id)
 
-    if cached_message_id is not None:
+    if cached is not None:
         print("ALLOK - Using cached images")
-        async with AsyncStageTimer("view/cache_hit_fetch_and_send"):
-            cached_msg = await thread.fetch_message(cached_message_id)
-            embeds = _build_gallery_embeds(cached_msg.attachments)
+        if cached.prerendered:
+            await image_cache_mapper.mark_viewed(thread_id, internal_id)
+        urls = list(cached.urls)
+        # URLが未登録か期限切れが近いときだけメッセージを取得し直す
+        if not cached.urls_valid(ATTACHMENT_URL_MARGIN):
+            async with AsyncStageTimer("view/cache_hit_refresh_urls"):
+                cached_msg = await thread.fetch_message(cached.message_id)
+                urls = await _storeViewMessage(thread_id, internal_id, cached_msg)
+        async with AsyncStageTimer("view/cache_hit_send"):
+            embeds = _build_gallery_embeds(urls)
             await ctx.edit_original_response(content=None, embeds=embeds)
         total.stop()
         return
 
-    # キャッシュなし: 元画像取得
-    async with AsyncStageTimer("view/discord_download_original"):
-        async for m in thread.history(oldest_first=True, limit=1):
-            files = [await a.to_file() for a in m.attachments]
+    # キャッシュなし: 元画像の取得（元画像キャッシュになければDiscordから）と暗号化を
+    # 始めてから、進捗の表示を送る
+    async def render() -> list[str]:
+        msg = await _encryptAndStore(thread, internal_id, ctx.user.name, "view")
+        return await _storeViewMessage(thread_id, internal_id, msg)
 
-    # 暗号化処理
+    # 連打やインタラクションの再送で同じ閲覧が重なった場合は、実行中の処理の結果を待つ
+    storing = asyncio.ensure_future(view_flights.do((thread_id, internal_id), render))
     embed = discord.Embed(color=0x00DD00, title="画像を表示します")
     embed.add_field(name="読み込み中", value="暗号化処理中...")
     await ctx.edit_original_response(content=None, embed=embed)
 
-    encrypted_files = []
-    for i, file in enumerate(files):
-        with StageTimer(f"view/image_convert_rgba[{i}]"):
-            im = file2image(file)
-        mycrypter = myCrypter(im)
-        print(f"Encrypting image {i + 1}/{len(files)}")
-        with StageTimer(f"view/encrypt[{i}]"):
-            mycrypter.setChannel([True, False, False, True]).encryptByID(
-                internal_id
-            ).setChannel([False, False, True, True]).encryptByLabel(
-                ctx.user.name
-            ).encryptByTime()
-            encrypted_im = mycrypter.executeEncryption()
-        with StageTimer(f"view/png_encode[{i}]"):
-            encrypted_file = image2file(encrypted_im)
-        encrypted_file.filename = file.filename
-        encrypted_files.append(encrypted_file)
-
-    # スレッドに保存してユーザーに送信
-    async with AsyncStageTimer("view/discord_upload_encrypted"):
-        msg: discord.Message = await thread.send(
-            content=str(internal_id), files=encrypted_files
+    try:
+        urls = await storing
+    except asyncio.TimeoutError:
+        embed = discord.Embed(colour=0xFF0000, title="Botエラー")
+        embed.add_field(name="警告", value="暗号化処理がタイムアウトしました。")
+        await ctx.edit_original_response(content=None, embed=embed)
+        total.stop()
+        return
+    except BrokenProcessPool:
+        embed = discord.Embed(colour=0xFF0000, title="Botエラー")
+        embed.add_field(
+            name="警告", value="暗号化処理が異常終了しました。もう一度お試しください。"
         )
-
-    await image_cache_mapper.set_message_id(thread_id, internal_id, msg.id)
+        await ctx.edit_original_response(content=None, embed=embed)
+        total.stop()
+        return
 
     async with AsyncStageTimer("view/discord_edit_response"):
-        embeds = _build_gallery_embeds(msg.attachments)
+        embeds = _build_gallery_embeds(urls)
         await ctx.edit_original_response(content=None, embeds=embeds)
 
     print(f"view id->{internal_id}")
     total.stop()
 
-    # メモリ解放
-    del encrypted_files
-    gc.collect()
+
+async def _encryptOriginals(
+    thread: discord.Thread,
+    internal_id: int,
+    label: str,
+    timestamp: datetime.datetime,
+    stage: str,
+) -> tuple[list[EncodedImage], list[str]]:
+    """スレッドに保管された元画像に透かしを入れる。
+
+    元画像キャッシュになければDiscordから画像ごとにダウンロードし、届いたものから
+    暗号化を始める（i+1枚目のダウンロードとi枚目の暗号化が重なる）。
+
+    Returns:
+        (エンコード結果のリスト, ファイル名のリスト)
+
+    Raises:
+        asyncio.TimeoutError: 暗号化処理がタイムアウトした場合
+        BrokenProcessPool: 暗号化処理のワーカーが異常終了した場合
+    """
+    originals = original_cache.get(thread.id)
+    if originals is not None:
+        # 展開済みの画素があればワーカーはデコードを省略する（なければ書き出す）
+        try:
+            async with AsyncStageTimer(f"{stage}/encrypt_pool"):
+                results = await encrypt_executor.encrypt_many(
+                    [o.path for o in originals],
+                    internal_id,
+                    label,
+                    timestamp,
+                    [decoded_cache.path(o.digest) for o in originals],
+                )
+        except FileNotFoundError:
+            # 渡したキャッシュファイルが直前に追い出された場合は取得し直す
+            original_cache.discard(thread.id)
+        else:
+            for o in originals:
+                decoded_cache.touch(o.digest)
+            return results, [o.filename for o in originals]
+
+    attachments: list[discord.Attachment] = []
+    async for m in thread.history(oldest_first=True, limit=1):
+        attachments = m.attachments
+
+    async def encrypt(i: int, download_task: asyncio.Future) -> EncodedImage:
+        data = await download_task
+        async with AsyncStageTimer(f"{stage}/encrypt/{i}"):
+            return await encrypt_executor.encrypt(data, internal_id, label, timestamp)
+
+    downloads = [
+        asyncio.ensure_future(_downloadAttachment(a, f"{stage}/download/{i}"))
+        for i, a in enumerate(attachments)
+    ]
+    encrypts = asyncio.gather(*(encrypt(i, d) for i, d in enumerate(downloads)))
+    try:
+        datas = await asyncio.gather(*downloads)
+    except BaseException:
+        encrypts.cancel()
+        raise
+    # 閲覧時にDiscordから再ダウンロードしないよう元画像を保存（暗号化と並行して）
+    saving = asyncio.to_thread(
+        original_cache.put,
+        thread.id,
+        [(a.id, a.filename, d) for a, d in zip(attachments, datas)],
+    )
+    results, _ = await asyncio.gather(encrypts, saving)
+    return results, [a.filename for a in attachments]
+
+
+async def _encryptAndStore(
+    thread: discord.Thread, internal_id: int, label: str, stage: str
+) -> discord.Message:
+    """元画像に透かしを入れ、スレッドに保存する。
+
+    Args:
+        thread: 元画像を保管しているスレッド
+        internal_id: 埋め込む内部ID
+        label: 埋め込む閲覧者名
+        stage: 計測のステージ名の接頭辞（"view" など）
+
+    Returns:
+        保存したメッセージ
+
+    Raises:
+        asyncio.TimeoutError: 暗号化処理がタイムアウトした場合
+        BrokenProcessPool: 暗号化処理のワーカーが異常終了した場合
+    """
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+    async with AsyncStageTimer(f"{stage}/download_and_encrypt"):
+        results, filenames = await _encryptOriginals(
+            thread, internal_id, label, timestamp, stage
+        )
+
+    # 全ての画像がそろったらすぐに1つのメッセージとしてアップロードする
+    encrypted_files = [
+        encoded2file(encoded, filename) for encoded, filename in zip(results, filenames)
+    ]
+    async with AsyncStageTimer(f"{stage}/discord_upload_encrypted"):
+        return await thread.send(content=str(internal_id), files=encrypted_files)
+
+
+async def prerenderView(job: PrerenderJob):
+    """閲覧される前に、閲覧者向けの透かし入り画像を生成してスレッドに保存しておく。"""
+    if await image_cache_mapper.get_message_id(job.thread_id, job.internal_id):
+        return
+    discord_id = await user_id_mapper.get_discord_id(job.internal_id)
+    if discord_id is None:
+        return
+    user = client.get_user(discord_id) or await client.fetch_user(discord_id)
+    thread = client.get_channel(job.thread_id) or await client.fetch_channel(
+        job.thread_id
+    )
+
+    async def render() -> list[str]:
+        msg = await _encryptAndStore(thread, job.internal_id, user.name, "prerender")
+        urls = await _storeViewMessage(
+            job.thread_id, job.internal_id, msg, prerendered=True
+        )
+        if urls:
+            return urls
+        # 生成中に本人が閲覧し、既に保存されていた
+        await msg.delete()
+        cached = await image_cache_mapper.get_message(job.thread_id, job.internal_id)
+        return list(cached.urls) if cached else []
+
+    # 本人の閲覧と重なった場合は、閲覧の処理に任せる
+    await view_flights.do((job.thread_id, job.internal_id), render)
 
 
-# @profile
 async def processButtonclickImageRemove(ctx: discord.Interaction, prm: dict):
     if str(ctx.user.id) != prm.get("author_id"):
         embed = discord.Embed(colour=0xFF0000, title="Botエラー")
@@ -626,6 +917,8 @@ async def processButtonclickImageRemove(ctx: discord.Interaction, prm: dict):
 
             async def callback(self, ctx: discord.Interaction):
                 await self.msg.delete()
+                if prerender_queue is not None:
+                    prerender_queue.cancel(prm.get("thread_id"))
                 for c in self.view.children:
                     c.disabled = True
                 await ctx.response.edit_message(
@@ -656,7 +949,283 @@ async def processButtonclickImageRemove(ctx: discord.Interaction, prm: dict):
         )
 
 
-# @profile
+@tree.command(name="trace", description="流出した画像から閲覧者を特定します")
+@discord.app_commands.default_permissions(administrator=True)
+@discord.app_commands.describe(leaked="流出した画像", original="元画像")
+async def traceCommand(
+    ctx: discord.Interaction,
+    leaked: discord.Attachment,
+    original: discord.Attachment,
+):
+    await ctx.response.defer(ephemeral=True, thinking=True)
+    async with AsyncStageTimer("trace/discord_download"):
+        leaked_data = await leaked.read()
+        original_data = await original.read()
+    try:
+        async with AsyncStageTimer("trace/decode"):
+            result = await encrypt_executor.trace(leaked_data, original_data)
+    except asyncio.TimeoutError:
+        embed = discord.Embed(colour=0xFF0000, title="Botエラー")
+        embed.add_field(name="警告", value="解析処理がタイムアウトしました。")
+        await ctx.followup.send(embed=embed, ephemeral=True)
+        return
+    except BrokenProcessPool:
+        embed = discord.Embed(colour=0xFF0000, title="Botエラー")
+        embed.add_field(
+            name="警告", value="解析処理が異常終了しました。もう一度お試しください。"
+        )
+        await ctx.followup.send(embed=embed, ephemeral=True)
+        return
+
+    if not result.detected:
+        embed = discord.Embed(color=0x00DD00, title="解析結果")
+        embed.add_field(name="閲覧者", value="透かしが見つかりませんでした。")
+        await ctx.followup.send(embed=embed, ephemeral=True)
+        return
+
+    discord_id = None
+    if result.checksum_ok:
+        discord_id = await user_id_mapper.get_discord_id(result.internal_id)
+
+    embed = discord.Embed(color=0x00DD00, title="解析結果")
+    embed.add_field(name="内部ID", value=str(result.internal_id))
+    embed.add_field(name="確信度", value=f"{result.confidence:.0%}")
+    embed.add_field(
+        name="チェックサム", value="一致" if result.checksum_ok else "不一致"
+    )
+    embed.add_field(
+        name="閲覧者",
+        value=f"<@{discord_id}>" if discord_id is not None else "特定できませんでした",
+        inline=False,
+    )
+    await ctx.followup.send(embed=embed, ephemeral=True)
+
+
+class _ProgressMessage:
+    """interactionの応答を進捗表示として更新する。Discordのレート制限を避けるため間引く。"""
+
+    def __init__(self, ctx: discord.Interaction, interval: float = 1.5):
+        self._ctx = ctx
+        self._interval = interval
+        self._last = 0.0
+
+    async def update(self, content: str, force: bool = False):
+        now = asyncio.get_running_loop().time()
+        if force or now - self._last >= self._interval:
+            self._last = now
+            await self._ctx.edit_original_response(content=content)
+
+
+async def _iterBotroomThreads(botroom: discord.TextChannel):
+    """ID_ROOM_BOT内の全スレッド（アーカイブ済みを含む）を列挙する。"""
+    for thread in botroom.threads:
+        yield thread
+    async for thread in botroom.archived_threads(limit=None, private=True, joined=True):
+        yield thread
+
+
+async def _downloadAttachment(a: discord.Attachment, stage: str) -> bytes:
+    """添付ファイルをダウンロードする。
+
+    同じ添付ファイルをダウンロード中なら、新しく始めずにその結果を待つ
+    （未キャッシュの投稿を複数人が同時に閲覧しても1回で済む）。
+    """
+
+    async def download() -> bytes:
+        fp = await attachment_downloader.fetch(a.url, stage)
+        with fp:
+            return fp.read()
+
+    return await download_flights.do(a.id, download)
+
+
+async def _loadOriginals(
+    thread: discord.Thread, warm: bool = True
+) -> tuple[list[ImageSource], list[str], list[Optional[str]]]:
+    """スレッドに保管された元画像を取得する。
+
+    元画像キャッシュにあればファイルのパスを、なければスレッドの最初のメッセージから
+    ダウンロードしたバイト列を返す。
+
+    Args:
+        thread: 元画像を保管しているスレッド
+        warm: ダウンロードした元画像をキャッシュに保存するか
+
+    Returns:
+        (元画像のリスト, ファイル名のリスト, 内容のSHA-256のリスト)。
+        SHA-256はキャッシュ外の元画像ではNone
+    """
+    originals = original_cache.get(thread.id)
+    if originals is None:
+        originals = []
+        async for m in thread.history(oldest_first=True, limit=1):
+            datas = await asyncio.gather(
+                *(
+                    _downloadAttachment(a, f"originals/download/{i}")
+                    for i, a in enumerate(m.attachments)
+                )
+            )
+            stored = None
+            if warm:
+                stored = await asyncio.to_thread(
+                    original_cache.put,
+                    thread.id,
+                    [(a.id, a.filename, d) for a, d in zip(m.attachments, datas)],
+                )
+            if stored is None:
+                filenames = [a.filename for a in m.attachments]
+                return datas, filenames, [None] * len(datas)
+            originals = stored
+    return (
+        [o.path for o in originals],
+        [o.filename for o in originals],
+        [o.digest for o in originals],
+    )
+
+
+async def updateHashIndex(botroom: discord.TextChannel, progress: _ProgressMessage):
+    """未登録のスレッドの元画像を取得し、プロセスプールでハッシュ化して登録する。"""
+    indexed = image_hash_mapper.threads()
+    threads = [t async for t in _iterBotroomThreads(botroom) if t.id not in indexed]
+    for i, thread in enumerate(threads):
+        await progress.update(f"元画像の索引を更新しています... {i}/{len(threads)}")
+        # 索引の更新のためだけに古いスレッドでキャッシュを埋めない
+        datas, _, _ = await _loadOriginals(thread, warm=False)
+        if datas:
+            hashes = await asyncio.gather(
+                *(encrypt_executor.run(hash_job, d) for d in datas)
+            )
+            await image_hash_mapper.add(thread.id, hashes)
+
+
+@tree.command(
+    name="leakscan", description="流出した画像の元画像と閲覧者を全スレッドから探します"
+)
+@discord.app_commands.default_permissions(administrator=True)
+@discord.app_commands.describe(leaked="流出した画像")
+async def leakScanCommand(ctx: discord.Interaction, leaked: discord.Attachment):
+    total = TotalTimer("leakscan")
+    total.start()
+    await ctx.response.defer(ephemeral=True, thinking=True)
+    progress = _ProgressMessage(ctx)
+    botroom: discord.TextChannel = await ctx.guild.fetch_channel(ID_ROOM_BOT)
+
+    async with AsyncStageTimer("leakscan/update_index"):
+        await updateHashIndex(botroom, progress)
+
+    leaked_data = await leaked.read()
+    async with AsyncStageTimer("leakscan/hash_search"):
+        leaked_hashes = await encrypt_executor.run(hash_job, leaked_data)
+        candidates = image_hash_mapper.search(
+            leaked_hashes, LEAKSCAN_CANDIDATES, LEAKSCAN_MAX_DISTANCE
+        )
+    if not candidates:
+        await progress.update("似ている元画像が見つかりませんでした。", force=True)
+        total.stop()
+        return
+
+    # 候補ごとに元画像を取得してIDを復元（完了した順に進捗を表示）
+    async def decode(distance: int, thread_id: int, index: int):
+        thread = client.get_channel(thread_id) or await client.fetch_channel(thread_id)
+        original = (await _loadOriginals(thread))[0][index]
+        try:
+            result = await encrypt_executor.trace(leaked_data, original)
+        except FileNotFoundError:
+            # 渡したキャッシュファイルが直前に追い出された場合は、保存せずに取得し直す
+            original_cache.discard(thread.id)
+            original = (await _loadOriginals(thread, warm=False))[0][index]
+            result = await encrypt_executor.trace(leaked_data, original)
+        return distance, thread, result
+
+    results = []
+    async with AsyncStageTimer("leakscan/decode_candidates"):
+        tasks = [decode(*c) for c in candidates]
+        for i, task in enumerate(asyncio.as_completed(tasks)):
+            await progress.update(f"候補の画像を解析しています... {i}/{len(tasks)}")
+            try:
+                results.append(await task)
+            except (
+                discord.HTTPException,
+                IndexError,
+                asyncio.TimeoutError,
+                BrokenProcessPool,
+            ) as e:
+                print(e)
+
+    # 透かしが見つからなかった候補は、ID 0 の閲覧者と誤らないよう除く
+    undetected = sum(1 for r in results if not r[2].detected)
+    results = [r for r in results if r[2].detected]
+    # チェックサムが一致し、確信度の高いものを採用
+    results.sort(key=lambda r: (not r[2].checksum_ok, -r[2].confidence, r[0]))
+    embed = discord.Embed(color=0x00DD00, title="流出調査の結果")
+    if undetected:
+        embed.description = f"{undetected}件の候補からは透かしが見つかりませんでした。"
+    for distance, thread, result in results:
+        discord_id = None
+        if result.checksum_ok:
+            discord_id = await user_id_mapper.get_discord_id(result.internal_id)
+        viewer = (
+            f"<@{discord_id}>" if discord_id is not None else "特定できませんでした"
+        )
+        embed.add_field(
+            name=thread.name,
+            value=(
+                f"{thread.mention}\n閲覧者: {viewer}\n内部ID: {result.internal_id}"
+                f"（確信度 {result.confidence:.0%}、チェックサム"
+                f"{'一致' if result.checksum_ok else '不一致'}）\n"
+                f"ハッシュ距離: {distance}"
+            ),
+            inline=False,
+        )
+    await ctx.edit_original_response(content=None, embed=embed)
+    total.stop()
+
+
+@tree.command(
+    name="metrics",
+    description="処理ごとの所要時間・キャッシュ・キューの状況を表示します",
+)
+@discord.app_commands.default_permissions(administrator=True)
+@discord.app_commands.describe(prefix="この文字列で始まる項目だけを表示（例: view/）")
+async def metricsCommand(ctx: discord.Interaction, prefix: str = ""):
+    summary = metrics.summary(prefix)
+    # embed の説明文の上限に収める
+    if len(summary) > 4000:
+        summary = summary[:4000].rsplit("\n", 1)[0] + "\n…"
+    embed = discord.Embed(
+        color=0x00DD00, title="メトリクス", description=f"```\n{summary}\n```"
+    )
+    await ctx.response.send_message(embed=embed, ephemeral=True)
+
+
+@tree.command(
+    name="profile",
+    description="メモリのプロファイリングを開始・停止し、ヒープの状況を表示します",
+)
+@discord.app_commands.default_permissions(administrator=True)
+@discord.app_commands.describe(
+    action="start: 開始 / stop: 停止 / report: 割り当ての多い箇所と増加を表示"
+)
+async def profileCommand(
+    ctx: discord.Interaction, action: Literal["start", "stop", "report"] = "report"
+):
+    if action == "start":
+        profiler.start(
+            PROFILE_SNAPSHOT_INTERVAL, PROFILE_SNAPSHOTS, PROFILE_TRACE_FRAMES
+        )
+    elif action == "stop":
+        profiler.stop()
+    await ctx.response.send_message("集計しています...", ephemeral=True)
+    # スナップショットの比較は重いので、イベントループを止めないようにする
+    report = await asyncio.to_thread(profiler.report)
+    if len(report) > 4000:
+        report = report[:4000].rsplit("\n", 1)[0] + "\n…"
+    embed = discord.Embed(
+        color=0x00DD00, title="ヒープ", description=f"```\n{report}\n```"
+    )
+    await ctx.edit_original_response(content=None, embed=embed)
+
+
 @client.event
 async def on_reaction_add(reaction: discord.Reaction, user: discord.user):
     if reaction.message.flags.ephemeral:
@@ -664,22 +1233,77 @@ async def on_reaction_add(reaction: discord.Reaction, user: discord.user):
             pass
 
 
-# @profile
+async def reclaimUserIds():
+    """長期間アクセスのないユーザーの内部IDを1日ごとに回収する。"""
+    while True:
+        try:
+            reclaimed = await user_id_mapper.reclaim(
+                USER_ID_RETENTION_DAYS, image_cache_mapper.forget_internal_ids
+            )
+            print(f"reclaimed {len(reclaimed)} internal ids")
+        except (asyncpg.PostgresError, OSError) as e:
+            print(e)
+        await asyncio.sleep(24 * 60 * 60)
+
+
 @client.event
 async def on_ready():
-    global user_id_mapper, image_cache_mapper
+    global user_id_mapper, image_cache_mapper, image_hash_mapper, encrypt_executor
+    global original_cache, decoded_cache, prerender_queue, reclaim_task
+    global attachment_downloader, metrics_server
     print("ready")
-    pool = await asyncpg.create_pool(DATABASE_URL)
-    user_id_mapper = UserIdMapper(pool)
-    await user_id_mapper.init()
-    image_cache_mapper = ImageCacheMapper(pool)
-    await image_cache_mapper.init()
-    print("DB connected")
+    if attachment_downloader is None:
+        attachment_downloader = AttachmentDownloader(DOWNLOAD_CONCURRENCY)
+    if original_cache is None:
+        original_cache = OriginalCache(ORIGINAL_CACHE_DIR, ORIGINAL_CACHE_BYTES)
+        decoded_cache = DecodedCache(DECODED_CACHE_DIR, DECODED_CACHE_BYTES)
+    if encrypt_executor is None:
+        encrypt_executor = EncryptExecutor(
+            max_workers=ENCRYPT_POOL_SIZE,
+            max_pending=ENCRYPT_MAX_PENDING,
+            job_timeout=ENCRYPT_JOB_TIMEOUT,
+            encode_profile=ENCODE_PROFILE,
+        )
+    # on_ready は再接続のたびに呼ばれるので、DBの接続とマッパーは初回だけ作る
+    if user_id_mapper is None:
+        pool = await asyncpg.create_pool(DATABASE_URL)
+        user_id_mapper = UserIdMapper(pool)
+        await user_id_mapper.init()
+        user_id_mapper.start()
+        image_cache_mapper = ImageCacheMapper(pool)
+        await image_cache_mapper.init()
+        image_cache_mapper.start()
+        image_hash_mapper = ImageHashMapper(pool)
+        await image_hash_mapper.init()
+        print("DB connected")
+    if USER_ID_RETENTION_DAYS > 0 and reclaim_task is None:
+        reclaim_task = asyncio.create_task(reclaimUserIds())
+    if PRERENDER_ENABLED and prerender_queue is None:
+        prerender_queue = PrerenderQueue(
+            prerenderView,
+            is_idle=lambda: encrypt_executor.pending == 0,
+            cpu_budget=PRERENDER_CPU_BUDGET,
+        )
+        prerender_queue.start()
+    metrics.gauge("encrypt_pool/pending", lambda: encrypt_executor.pending)
+    metrics.gauge("original_cache/bytes", lambda: original_cache.nbytes)
+    metrics.gauge("decoded_cache/bytes", lambda: decoded_cache.nbytes)
+    metrics.gauge("view/inflight", lambda: len(view_flights))
+    metrics.gauge("download/inflight", lambda: len(download_flights))
+    if prerender_queue is not None:
+        metrics.gauge("prerender/queue", lambda: len(prerender_queue))
+    metrics.gauge("process/rss_kb", current_rss_kb)
+    if PROFILE_ENABLED and not profiler.enabled:
+        profiler.start(
+            PROFILE_SNAPSHOT_INTERVAL, PROFILE_SNAPSHOTS, PROFILE_TRACE_FRAMES
+        )
+    if METRICS_PORT and metrics_server is None:
+        metrics_server = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+        print(f"metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
     await tree.sync()
     print("ready")
 
 
-# @profile
 def main():
     client.run(TOKEN)
 
@@ -3,9 +3,13 @@ from PIL import Image, ImageDraw, ImageFont
 import numpy as np
 import textwrap
 import datetime
+import functools
+import math
+from typing import Iterator, NamedTuple, Optional, Union
 
+from cache import ByteBudgetLRU
 from myImageConcater import concateImage
-from perf import StageTimer
+from perf import StageTimer, HitRateCounter
 from constants import (
     MASKBIT_ROW,
     MASKBIT_COLUMN,
@@ -14,13 +18,163 @@ from constants import (
     MASK_BASE,
     MASK_COLOR,
     TEXT_COLOR,
+    MASK_CACHE_BYTES,
+    LABEL_TILE_CACHE_BYTES,
 )
 
 
+# ID・ラベルのマスク層キャッシュ。(サイズ, 描画内容) が同じなら描画を省略する
+mask_cache = ByteBudgetLRU(MASK_CACHE_BYTES)
+mask_cache_hit_rate = HitRateCounter("crypt/mask_cache")
+# ラベルの文字列を描いたタイル。(ラベル, 文字サイズ) が同じなら
+# 画像の大きさによらず使い回す
+label_tile_cache = ByteBudgetLRU(LABEL_TILE_CACHE_BYTES)
+label_tile_cache_hit_rate = HitRateCounter("crypt/label_tile_cache")
+
+FONT_FILE = "./data/Arial Bold.ttf"
+
+# マスクを適用する範囲を管理するタイルの一辺（px）
+DIRTY_TILE_SIZE = 64
+# 元画像をuint8配列へ写すときの帯の高さ（px）
+COPY_BAND_HEIGHT = 256
+
+Box = tuple[int, int, int, int]
+
+
+@functools.lru_cache(maxsize=64)
+def loadFont(size: int) -> ImageFont.FreeTypeFont:
+    """文字サイズごとのフォント。TTFの読み込み・解析はプロセスごとに1回で済ませる。"""
+    return ImageFont.truetype(FONT_FILE, size)
+
+
+def _textBox(fnt: ImageFont.FreeTypeFont, xy: tuple[float, float], text: str) -> Box:
+    """文字列が触れうる範囲（右端・下端は含まない）。"""
+    x, y = xy
+    left, top, right, bottom = fnt.getbbox(text)
+    # アンチエイリアスのにじみを考慮して1pxの余白を取る
+    return (
+        math.floor(x + left) - 1,
+        math.floor(y + top) - 1,
+        math.ceil(x + right) + 1,
+        math.ceil(y + bottom) + 1,
+    )
+
+
+def labelTiles(label: str, fontsize: int) -> list[tuple[Box, Image.Image]]:
+    """ラベルを敷き詰めた各行を、濃淡（"L"）のタイルとして返す。
+
+    ラベルの繰り返しを折り返した行は同じ文字列が周期的に現れるので、
+    (文字列, 描画位置の端数) が同じ行はタイルを共有する。タイルは draw.text が
+    内部で作るものと同じなので、draw.bitmap で描くと draw.text と同じ画素になる。
+
+    Returns:
+        [(描画範囲, タイル)]
+    """
+    key = (label, fontsize)
+    tiles = label_tile_cache.get(key)
+    label_tile_cache_hit_rate.record(tiles is not None)
+    if tiles is not None:
+        return tiles
+
+    fnt = loadFont(fontsize)
+    rendered: dict[tuple, Image.Image] = {}
+    tiles = []
+    for i, line in enumerate(textwrap.wrap((label + " ") * 60, 25)):
+        xy = (fontsize, i * (fontsize * 1.5) + fontsize)
+        box = x0, y0, x1, y1 = _textBox(fnt, xy, line)
+        line_key = (line, xy[0] - x0, xy[1] - y0)
+        tile = rendered.get(line_key)
+        if tile is None:
+            # 負の座標では端数の扱い（切り捨ての向き）が変わるので、描画位置が
+            # 正になる原点で描いてから範囲を切り出す
+            ox, oy = min(x0, math.floor(xy[0])), min(y0, math.floor(xy[1]))
+            tile = Image.new("L", (x1 - ox, y1 - oy), 0)
+            ImageDraw.Draw(tile).text(
+                (xy[0] - ox, xy[1] - oy), line, fill=255, font=fnt
+            )
+            tile = tile.crop((x0 - ox, y0 - oy, x1 - ox, y1 - oy))
+            rendered[line_key] = tile
+        tiles.append((box, tile))
+    nbytes = sum(tile.width * tile.height for tile in rendered.values())
+    label_tile_cache.put(key, tiles, nbytes)
+    return tiles
+
+
+def applyMask(out: np.ndarray, mask: np.ndarray) -> None:
+    """outにmaskをin-placeで適用する。
+
+    128未満の画素はmaskを加算、128以上は減算する。uint8のまま
+    out + mask - 2 * mask * (out >> 7) をmod 256で計算するので分岐がなく、
+    中間配列はuint8の1枚だけ。outは配列のスライス（ビュー）でもよい。
+    """
+    t = out >> 7
+    t *= mask
+    t <<= 1
+    out += mask
+    out -= t
+
+
+class PackedMask:
+    """ID・ラベル層のマスクを、チャンネルごとに1ビットへ詰めて持つ。
+
+    この層の画素は各チャンネルとも MASK_BASE(0) か MASK_COLOR(1) にしかならない
+    （MASK_COLOR=1 ではアンチエイリアスの濃淡も0か1に丸められる）ので、
+    RGBAで持つ場合の1/8の大きさで済む。4000x3000 なら 48MB が 6MB になる。
+    """
+
+    __slots__ = ("bits", "width", "height")
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        # 1行 = 幅×4チャンネルのビット列
+        self.bits = np.zeros((height, -(-width * 4 // 8)), dtype=np.uint8)
+
+    @property
+    def nbytes(self) -> int:
+        return self.bits.nbytes
+
+    def pack(self, y0: int, rows: np.ndarray):
+        """(行数, 幅, 4) のマスクを y0 行目から書き込む。"""
+        flat = rows.reshape(rows.shape[0], -1) != MASK_BASE
+        self.bits[y0 : y0 + rows.shape[0]] = np.packbits(flat, axis=1)
+
+    def rows(self, y0: int, y1: int) -> np.ndarray:
+        """y0〜y1 行目を (行数, 幅, 4) のuint8配列に展開する。"""
+        unpacked = np.unpackbits(self.bits[y0:y1], axis=1, count=self.width * 4)
+        if MASK_COLOR != 1:
+            unpacked *= MASK_COLOR
+        return unpacked.reshape(y1 - y0, self.width, 4)
+
+
+class TraceResult(NamedTuple):
+    """traceID の結果。"""
+
+    internal_id: int
+    """復元した内部ID（チェックサム不一致でも上位16bitから求めた値）"""
+    confidence: float
+    """0〜1の確信度"""
+    checksum_ok: bool
+    """チェックサムが一致したか"""
+    detected: bool = True
+    """透かしが見つかったか（False なら内部ID・確信度に意味はない）"""
+
+
+# 透かしが見つからなかった場合の traceID の結果
+NO_WATERMARK = TraceResult(
+    internal_id=0, confidence=0.0, checksum_ok=False, detected=False
+)
+
+
+_DRAW_STAGE_NAMES = {
+    "id": "crypt/encryptByID_draw",
+    "label": "crypt/encryptByLabel_draw",
+    "time": "crypt/encryptByTime_draw",
+}
+
+
 class myCrypter:
     originalImageData: Image.Image
-    maskImageData: Image.Image
-    draw: ImageDraw.ImageDraw
 
     crypt_mode = [True, True, True, True]
     """RGBのチャンネルを管理
@@ -30,24 +184,107 @@ class myCrypter:
         3:A
     """
 
-    def __init__(self, im: Image.Image):
+    def __init__(self, im: Union[Image.Image, np.ndarray]):
+        """
+        Args:
+            im: 元画像。(高さ, 幅, 4) のuint8配列（myImageCodec.loadPixels の
+                mmapなど）も受け付け、その場合はコピーせずに参照する。
+        """
+        if isinstance(im, np.ndarray):
+            self._pixels: Optional[np.ndarray] = im
+            im = Image.frombuffer(
+                "RGBA", (im.shape[1], im.shape[0]), im, "raw", "RGBA", 0, 1
+            )
+        else:
+            self._pixels = None
         self.originalImageData = im
-        self.maskImageData = Image.new("RGBA", im.size, MASK_BASE)
-        self.draw = ImageDraw.Draw(self.maskImageData)
+        # 描画はexecuteEncryptionまで遅延し、キャッシュにあれば省略する
+        self._ops: list[tuple] = []
+        self._mask: Optional[PackedMask] = None
+        self._patches: list[tuple[Box, np.ndarray]] = []
+
+    @property
+    def maskImageData(self) -> Optional[Image.Image]:
+        """executeEncryptionで適用したマスク画像（未実行ならNone）。"""
+        if self._mask is None:
+            return None
+        mask = Image.fromarray(self._mask.rows(0, self._mask.height))
+        if self._patches:
+            for (x0, y0, _, _), patch in self._patches:
+                mask.paste(Image.fromarray(patch), (x0, y0))
+        return mask
 
     def setChannel(self, mode: list[bool]) -> myCrypter:
         self.crypt_mode = mode
         return self
 
-    def _encrypt(self, im: Image.Image, im_mask: Image.Image) -> Image.Image:
+    def _fill(self, mode: tuple[bool, ...]) -> tuple[int, int, int, int]:
+        return (
+            MASK_COLOR * mode[0],
+            MASK_COLOR * mode[1],
+            MASK_COLOR * mode[2],
+            MASK_COLOR * mode[3],
+        )
+
+    def _originalRegion(self, box: Box) -> np.ndarray:
+        """元画像の範囲をuint8配列として返す。配列で渡された場合はそのビュー。"""
+        x0, y0, x1, y1 = box
+        if self._pixels is not None:
+            return self._pixels[y0:y1, x0:x1]
+        return np.asarray(self.originalImageData.crop(box))
+
+    def _encrypt(
+        self,
+        im: Image.Image,
+        mask: PackedMask,
+        boxes: list[Box],
+        patches: list[tuple[Box, np.ndarray]],
+    ) -> Image.Image:
+        """マスクを適用した画像を返す。
+
+        出力用のuint8配列を1枚だけ確保し、帯ごとに元画像を写してから、描画のあった
+        タイルにのみin-placeでマスクを適用する。マスクは描画のある帯だけ展開する。
+        戻り値のImageはその配列をそのまま共有する。
+        """
         with StageTimer("crypt/_encrypt_numpy"):
-            im_data = np.array(im)
-            im_mask_data = np.array(im_mask)
-            im_crypted_data = np.where(
-                im_data < 128, im_data + im_mask_data, im_data - im_mask_data
+            w, h = im.size
+            out = np.empty((h, w, 4), dtype=np.uint8)
+            rects = self._dirtyRects(boxes, im.size)
+            for y in range(0, h, COPY_BAND_HEIGHT):
+                y1 = min(y + COPY_BAND_HEIGHT, h)
+                band = out[y:y1]
+                band[...] = self._originalRegion((0, y, w, y1))
+                band_rects = [r for r in rects if r[1] < y1 and r[3] > y]
+                if band_rects:
+                    band_mask = mask.rows(y, y1)
+                    for x0, r0, x1, r1 in band_rects:
+                        r0, r1 = max(r0, y) - y, min(r1, y1) - y
+                        applyMask(band[r0:r1, x0:x1], band_mask[r0:r1, x0:x1])
+            for box, patch in patches:
+                x0, y0, x1, y1 = box
+                region = out[y0:y1, x0:x1]
+                region[...] = self._originalRegion(box)
+                applyMask(region, patch)
+        return Image.frombuffer("RGBA", (w, h), out, "raw", "RGBA", 0, 1)
+
+    def _dirtyRects(self, boxes: list[Box], size: tuple[int, int]) -> list[Box]:
+        """描画範囲を覆うタイルを、行ごとに連続する互いに重ならない矩形へまとめる。"""
+        w, h = size
+        t = DIRTY_TILE_SIZE
+        grid = np.zeros((-(-h // t), -(-w // t)), dtype=bool)
+        for x0, y0, x1, y1 in boxes:
+            x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, w), min(y1, h)
+            if x0 < x1 and y0 < y1:
+                grid[y0 // t : (y1 - 1) // t + 1, x0 // t : (x1 - 1) // t + 1] = True
+
+        rects = []
+        for r, row in enumerate(grid):
+            edges = np.flatnonzero(
+                np.diff(np.concatenate(([0], row.view(np.int8), [0])))
             )
-            im_crypted_data = im_crypted_data.astype("uint8")
-        return Image.fromarray(im_crypted_data, mode="RGBA")
+            for c0, c1 in zip(edges[::2], edges[1::2]):
+                rects.append((c0 * t, r * t, min(c1 * t, w), min((r + 1) * t, h)))
+        return rects
 
     def _decrypt(self, im_en: Image.Image, im_or: Image.Image) -> Image.Image:
         im_or_data = np.array(im_or)
@@ -57,80 +294,207 @@ class myCrypter:
         return Image.fromarray(im_decrypted_data, mode="RGBA")
 
     def encryptByID(self, num: int) -> myCrypter:
-        with StageTimer("crypt/encryptByID_draw"):
-            checker_width = int(self.maskImageData.width / MASKBIT_ROW)
-            checker_height = int(self.maskImageData.height / MASKBIT_COLUMN)
+        self._ops.append(("id", num, tuple(self.crypt_mode)))
+        return self
+
+    def encryptByLabel(self, label: str) -> myCrypter:
+        self._ops.append(("label", label, tuple(self.crypt_mode)))
+        return self
 
-            maskbooleanlist = self._num2bit(num, MASKBIT_LENGTH_NUM)
-            maskbooleanlist = self.addChecksum(maskbooleanlist)
+    def encryptByTime(self, now: Optional[datetime.datetime] = None) -> myCrypter:
+        """閲覧日時（JST）を右下に描き込む。nowを省略した場合は現在時刻。"""
+        t_delta = datetime.timedelta(hours=9)
+        JST = datetime.timezone(t_delta, "JST")
+        if now is None:
+            now = datetime.datetime.now(JST)
+        else:
+            now = now.astimezone(JST)
+        self._ops.append(("time", now.strftime(r"%Y/%m/%d %H:%M:%S")))
+        return self
 
-            for i in range(MASKBIT_COLUMN):
-                for j in range(MASKBIT_ROW):
-                    if maskbooleanlist[i * MASKBIT_ROW + j]:
-                        self.draw.rectangle(
+    def _layoutID(
+        self, size: tuple[int, int], num: int, mode: tuple[bool, ...]
+    ) -> list[tuple]:
+        checker_width = int(size[0] / MASKBIT_ROW)
+        checker_height = int(size[1] / MASKBIT_COLUMN)
+
+        maskbooleanlist = self._num2bit(num, MASKBIT_LENGTH_NUM)
+        maskbooleanlist = self.addChecksum(maskbooleanlist)
+
+        prims = []
+        for i in range(MASKBIT_COLUMN):
+            for j in range(MASKBIT_ROW):
+                if maskbooleanlist[i * MASKBIT_ROW + j]:
+                    prims.append(
+                        (
+                            "rect",
                             (
                                 checker_width * j,
                                 checker_height * i,
                                 checker_width * (j + 1),
                                 checker_height * (i + 1),
                             ),
-                            fill=(
-                                MASK_COLOR * self.crypt_mode[0],
-                                MASK_COLOR * self.crypt_mode[1],
-                                MASK_COLOR * self.crypt_mode[2],
-                                MASK_COLOR * self.crypt_mode[3],
-                            ),
+                            self._fill(mode),
                         )
-        return self
-
-    def encryptByLabel(self, label: str) -> myCrypter:
-        with StageTimer("crypt/encryptByLabel_draw"):
-            fontsize = int(min(self.maskImageData.width, self.maskImageData.height) / 15)
-            fontfile = "./data/Arial Bold.ttf"
-
-            wraplist = textwrap.wrap((label + " ") * 60, 25)
-            fnt = ImageFont.truetype(fontfile, fontsize)
-
-            for i, list in enumerate(wraplist):
-                y = i * (fontsize * 1.5) + fontsize
-                self.draw.text(
-                    (fontsize, y),
-                    list,
-                    fill=(
-                        MASK_COLOR * self.crypt_mode[0],
-                        MASK_COLOR * self.crypt_mode[1],
-                        MASK_COLOR * self.crypt_mode[2],
-                        MASK_COLOR * self.crypt_mode[3],
-                    ),
-                    font=fnt,
-                )
-
-        return self
-
-    def encryptByTime(self) -> myCrypter:
-        with StageTimer("crypt/encryptByTime_draw"):
-            fontsize = int(min(self.maskImageData.width, self.maskImageData.height) / 30)
-            fontfile = "./data/Arial Bold.ttf"
-            fnt = ImageFont.truetype(fontfile, fontsize)
-            t_delta = datetime.timedelta(hours=9)
-            JST = datetime.timezone(t_delta, "JST")
-            now = datetime.datetime.now(JST)
-            text = now.strftime(r"%Y/%m/%d %H:%M:%S")
-            w, h = self.draw.textbbox(xy=(0, 0), text=text, font=fnt)[2:]
-            self.draw.text(
-                (self.maskImageData.width - w, self.maskImageData.height - h),
+                    )
+        return prims
+
+    def _layoutLabel(
+        self, size: tuple[int, int], label: str, mode: tuple[bool, ...]
+    ) -> list[tuple]:
+        fontsize = int(min(size) / 15)
+        fill = self._fill(mode)
+        return [
+            ("bitmap", box, tile, fill) for box, tile in labelTiles(label, fontsize)
+        ]
+
+    def _layoutTime(self, size: tuple[int, int], text: str) -> list[tuple]:
+        width, height = size
+        fontsize = int(min(width, height) / 30)
+        fnt = loadFont(fontsize)
+        w, h = fnt.getbbox(text)[2:]
+        return [
+            (
+                "text",
+                (width - w, height - h),
                 text,
-                fill=(TEXT_COLOR, TEXT_COLOR, TEXT_COLOR, 0),
-                font=fnt,
+                fnt,
+                (TEXT_COLOR, TEXT_COLOR, TEXT_COLOR, 0),
             )
-
-        return self
+        ]
+
+    def _layoutOp(self, size: tuple[int, int], op: tuple) -> list[tuple]:
+        """記録された描画操作を、矩形・文字列・タイルの描画プリミティブに展開する。"""
+        if op[0] == "id":
+            return self._layoutID(size, op[1], op[2])
+        elif op[0] == "label":
+            return self._layoutLabel(size, op[1], op[2])
+        else:
+            return self._layoutTime(size, op[1])
+
+    def _primitiveBox(self, prim: tuple) -> Box:
+        """描画プリミティブが触れうる範囲（右端・下端は含まない）。"""
+        if prim[0] == "rect":
+            x0, y0, x1, y1 = prim[1]
+            return (x0, y0, x1 + 1, y1 + 1)
+        if prim[0] == "bitmap":
+            return prim[1]
+        return _textBox(prim[3], prim[1], prim[2])
+
+    def _drawPrimitives(
+        self, draw: ImageDraw.ImageDraw, prims: list[tuple], origin: tuple[int, int]
+    ):
+        ox, oy = origin
+        for prim in prims:
+            if prim[0] == "rect":
+                x0, y0, x1, y1 = prim[1]
+                draw.rectangle((x0 - ox, y0 - oy, x1 - ox, y1 - oy), fill=prim[2])
+            elif prim[0] == "bitmap":
+                x0, y0 = prim[1][:2]
+                draw.bitmap((x0 - ox, y0 - oy), prim[2], fill=prim[3])
+            else:
+                x, y = prim[1]
+                draw.text((x - ox, y - oy), prim[2], fill=prim[4], font=prim[3])
+
+    def _drawBand(
+        self, prims: list[tuple], boxes: list[Box], width: int, y0: int, y1: int
+    ) -> Optional[np.ndarray]:
+        """y0〜y1 行目にかかる描画だけを行ったマスクの帯（描画がなければNone）。"""
+        # 描画の順序（後の描画が上書きする）は全体で描く場合と同じに保つ
+        band_prims = [p for p, b in zip(prims, boxes) if b[1] < y1 and b[3] > y0]
+        if not band_prims:
+            return None
+        image = Image.new("RGBA", (width, y1 - y0), MASK_BASE)
+        self._drawPrimitives(ImageDraw.Draw(image), band_prims, (0, y0))
+        return np.asarray(image)
+
+    def _renderMask(
+        self,
+    ) -> tuple[PackedMask, list[Box], list[tuple[Box, np.ndarray]]]:
+        """記録された描画操作からマスクを生成する。
+
+        先頭から連続するID・ラベルの層は帯ごとに描いて PackedMask に詰め、
+        (幅, 高さ, 描画内容) をキーにキャッシュする。同じ閲覧者・同じサイズの
+        再描画ではImageDrawの処理を丸ごと省略する。
+        日時など閲覧ごとに変わる層は、キャッシュしたマスクの該当範囲だけを
+        切り出したパッチに描き足す。
+
+        Returns:
+            (ID・ラベル層のマスク, 描画範囲のリスト, [(範囲, パッチ配列)])
+        """
+        size = self.originalImageData.size
+        n = 0
+        while n < len(self._ops) and self._ops[n][0] != "time":
+            n += 1
+        key = (*size, tuple(self._ops[:n]))
+
+        entry = mask_cache.get(key)
+        mask_cache_hit_rate.record(entry is not None)
+        if entry is None:
+            w, h = size
+            with StageTimer("crypt/render_mask"):
+                prims = [p for op in self._ops[:n] for p in self._layoutOp(size, op)]
+                boxes = [self._primitiveBox(p) for p in prims]
+                packed = PackedMask(w, h)
+                for y0 in range(0, h, COPY_BAND_HEIGHT):
+                    y1 = min(y0 + COPY_BAND_HEIGHT, h)
+                    band = self._drawBand(prims, boxes, w, y0, y1)
+                    if band is not None:
+                        packed.pack(y0, band)
+            entry = (packed, boxes)
+            mask_cache.put(key, entry, packed.nbytes)
+        mask, boxes = entry
+
+        patches = []
+        if n < len(self._ops):
+            layouts = [(op, self._layoutOp(size, op)) for op in self._ops[n:]]
+            prim_boxes = [self._primitiveBox(p) for _, prims in layouts for p in prims]
+            x0 = max(min(b[0] for b in prim_boxes), 0)
+            y0 = max(min(b[1] for b in prim_boxes), 0)
+            x1 = min(max(b[2] for b in prim_boxes), size[0])
+            y1 = min(max(b[3] for b in prim_boxes), size[1])
+            if x0 < x1 and y0 < y1:
+                patch = Image.fromarray(mask.rows(y0, y1)[:, x0:x1].copy())
+                draw = ImageDraw.Draw(patch)
+                for op, prims in layouts:
+                    with StageTimer(_DRAW_STAGE_NAMES[op[0]]):
+                        self._drawPrimitives(draw, prims, (x0, y0))
+                patches.append(((x0, y0, x1, y1), np.asarray(patch)))
+        return mask, boxes, patches
 
     def executeEncryption(self) -> Image.Image:
         with StageTimer("crypt/executeEncryption_total"):
-            result = self._encrypt(self.originalImageData, self.maskImageData)
+            mask, boxes, patches = self._renderMask()
+            self._mask, self._patches = mask, patches
+            result = self._encrypt(self.originalImageData, mask, boxes, patches)
         return result
 
+    def iterEncryptedBands(
+        self, band_height: int = COPY_BAND_HEIGHT
+    ) -> Iterator[np.ndarray]:
+        """executeEncryption と同じ画素を、上から帯ごとに返す。
+
+        画像全体のマスク・出力は確保せず、帯ごとにその範囲にかかる描画だけを行う。
+        使用メモリは画像の大きさによらず帯の数枚分で済む。マスクキャッシュは使わない。
+
+        Yields:
+            (帯の高さ, 幅, 4) のuint8配列
+        """
+        size = w, h = self.originalImageData.size
+        prims = [p for op in self._ops for p in self._layoutOp(size, op)]
+        boxes = [self._primitiveBox(p) for p in prims]
+        rects = self._dirtyRects(boxes, size)
+        for y0 in range(0, h, band_height):
+            y1 = min(y0 + band_height, h)
+            out = np.array(self._originalRegion((0, y0, w, y1)))
+            mask = self._drawBand(prims, boxes, w, y0, y1)
+            if mask is not None:
+                for x0, r0, x1, r1 in rects:
+                    if r0 < y1 and r1 > y0:
+                        r0, r1 = max(r0, y0) - y0, min(r1, y1) - y0
+                        applyMask(out[r0:r1, x0:x1], mask[r0:r1, x0:x1])
+            yield out
+
     def decrypt(
         self, image_encrypted: Image.Image, image_original: Image.Image
     ) -> Image.Image:
@@ -191,25 +555,99 @@ class myCrypter:
 
         # image_decrypted.show()
 
-        # image_bit = np.zeros((MASKBIT_COLUMN,MASKBIT_ROW))
-
-        # for i in range(MASKBIT_COLUMN):
-        #     for j in range(MASKBIT_ROW):
-        #         image_bit[i,j] = np.mean(image_decrypted_data[checker_height * i:checker_height*(i+1),checker_width * j:checker_width*(j+1)])
-
-        # image_bit = image_bit.ravel()
-
-        # model = KMeans(n_clusters=2,random_state=0,n_init='auto')
-
-        # model.fit(image_bit.reshape(-1,1))
-
-        # print(model.cluster_centers_)
+        # IDの自動復元は traceID を使う
 
-        # list_bit_boolean = [b==np.argmax(model.cluster_centers_) for b in model.labels_]
+        return image_decrypted
 
-        # id = checkChecksum(list_bit_boolean)
+    def traceID(
+        self, image_encrypted: Image.Image, image_original: Image.Image
+    ) -> TraceResult:
+        """流出画像と元画像の差分から、埋め込まれた内部IDを復元する。
+
+        MASKBIT_COLUMN x MASKBIT_ROW の各セルについて、差分を MASK_COLOR で
+        ±MASK_COLOR に収めた符号付き平均値を求め（タイムスタンプ等の大きな差や
+        再圧縮のノイズに引っ張られないため）、20個の値を分散最小の閾値で
+        2クラスに分けてビット列にする。
+        ID 0 はセルに何も描かれず透かしのない画像と区別できないので割り当てない。
+        全セルが同じクラスに分類された場合（ID 0 か、チェックサムの合わない全ビット1）は
+        NO_WATERMARK を返す。
+
+        Args:
+            image_encrypted: 流出した（透かし入りの）画像
+            image_original: 元画像
+
+        Returns:
+            TraceResult
+        """
+        image_original = image_original.convert("RGBA")
+        image_encrypted = image_encrypted.convert("RGBA")
+        if image_encrypted.size != image_original.size:
+            image_encrypted = image_encrypted.resize(
+                image_original.size, resample=Image.Resampling.BILINEAR
+            )
+        data_or = np.asarray(image_original)
+        data_en = np.asarray(image_encrypted)
+
+        checker_width = int(image_original.width / MASKBIT_ROW)
+        checker_height = int(image_original.height / MASKBIT_COLUMN)
+        # セル境界の描画ずれを避けるため、各セルの外周1割を除いて平均する
+        mw = max(checker_width // 10, 1) if checker_width > 2 else 0
+        mh = max(checker_height // 10, 1) if checker_height > 2 else 0
+
+        # 128未満の画素は加算、以上は減算されているので、符号をそろえて差分を取る
+        h = checker_height * MASKBIT_COLUMN
+        w = checker_width * MASKBIT_ROW
+        results = []
+        for channel in (0, 3):
+            original = data_or[:h, :w, channel].astype(np.int16)
+            diff = data_en[:h, :w, channel] - original
+            diff[original >= 128] *= -1
+            np.clip(diff, -MASK_COLOR, MASK_COLOR, out=diff)
+            cells = diff.reshape(
+                MASKBIT_COLUMN, checker_height, MASKBIT_ROW, checker_width
+            )[:, mh : checker_height - mh, :, mw : checker_width - mw]
+            values = cells.mean(axis=(1, 3)).ravel() / MASK_COLOR
+            bits, confidence = self._classifyBits(values)
+            if len(set(bits)) == 1:
+                results.append(NO_WATERMARK)
+                continue
+            results.append(
+                TraceResult(
+                    internal_id=self._bit2hum(bits[:MASKBIT_LENGTH_NUM]),
+                    confidence=confidence,
+                    checksum_ok=self.checkChecksum(bits) != -1,
+                )
+            )
 
-        return image_decrypted
+        # 透過情報は保存時に失われやすいためRを優先し、Rで復元できない場合のみAを使う
+        result_r, result_a = results
+        if not result_r.checksum_ok and result_a.checksum_ok:
+            return result_a
+        return result_r
+
+    def _classifyBits(self, values: np.ndarray) -> tuple[list[bool], float]:
+        """セルごとの値を2クラスに分け、(ビット列, 確信度) を返す。
+
+        閾値は並べ替えた値の各分割点のうちクラス内分散の和が最小になる位置
+        （1次元の2-means）。値の幅が0.5未満なら全セル同じクラスとみなし、
+        閾値を0.5とする。確信度は閾値から最も近いセルまでの距離を、
+        理想値（0と1の中間からの距離0.5）で割ったもの。
+        """
+        order = np.sort(values)
+        if order[-1] - order[0] < 0.5:
+            threshold = 0.5
+        else:
+            n = len(order)
+            k = np.arange(1, n)
+            csum = np.cumsum(order)
+            csum2 = np.cumsum(order**2)
+            left = csum2[:-1] - csum[:-1] ** 2 / k
+            right = (csum2[-1] - csum2[:-1]) - (csum[-1] - csum[:-1]) ** 2 / (n - k)
+            split = int(np.argmin(left + right)) + 1
+            threshold = (order[split - 1] + order[split]) / 2
+        margin = float(np.min(np.abs(values - threshold)))
+        confidence = min(margin / 0.5, 1.0)
+        return [bool(v > threshold) for v in values], confidence
 
     def _num2bit(self, num: int, padding: int) -> list[bool]:
         bitlist = format(num, f"0{padding}b")
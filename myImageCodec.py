@@ -0,0 +1,356 @@
+import mmap
+import os
+import struct
+import zlib
+from io import BytesIO
+from typing import Iterable, Iterator, NamedTuple, Optional, Union
+
+import imagehash
+import numpy as np
+from PIL import Image
+
+from perf import StageTimer
+from constants import (
+    DISCORD_UPLOAD_LIMIT,
+    PREVIEW_BLOCKS,
+    PREVIEW_MIN_BLOCK_PX,
+    PREVIEW_MAX_SIDE,
+)
+
+# エンコードのプロファイル
+#   fast_png:      PNGStreamEncoderによる高速PNG（zlibレベル1、Upフィルタ）
+#   optimized_png: Pillowのoptimize付きPNG（遅いが小さい）
+#   webp_lossless: 可逆WebP（透過部分の色も保持する）
+#   capped:        fast_png → webp_lossless の順に試し、上限を超える場合は縮小する
+ENCODE_PROFILES = ("fast_png", "optimized_png", "webp_lossless", "capped")
+
+# 帯単位で処理するときの帯の高さ（px）
+ENCODE_BAND_HEIGHT = 256
+
+# WebPで扱える画像の辺の長さの上限（px）。これを超える画像はWebPにできない
+WEBP_MAX_SIDE = 16383
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# 画像ファイルのバイト列、またはディスク上の画像ファイルのパス（cache.OriginalCache）
+ImageSource = Union[bytes, str]
+
+
+class EncodedImage(NamedTuple):
+    """image2bytes の結果。"""
+
+    data: bytes
+    hash: str
+    """average hash（16進文字列）"""
+    format: str
+    """"png" または "webp"（拡張子として使う）"""
+
+
+def openImage(source: ImageSource) -> Image.Image:
+    """画像を開く。パスの場合はファイルをmmapして読むので、読み込み用のコピーを作らない。
+
+    mmapは画像の読み込み後（load）か、画像を閉じたとき（close）に閉じる。
+    """
+    if not isinstance(source, str):
+        return Image.open(BytesIO(source))
+    with open(source, "rb") as f:
+        fp = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        im = Image.open(fp)
+    except BaseException:
+        fp.close()
+        raise
+    # パスを渡して開いた場合と同じく、mmapの後始末をPillowに任せる
+    im._exclusive_fp = True
+    return im
+
+
+def bytes2image(data: ImageSource) -> Image.Image:
+    """画像ファイルのバイト列（またはパス）をRGBAのImageに変換する。"""
+    im = openImage(data)
+    if im.mode != "RGBA":
+        im = im.convert("RGBA")
+    return im
+
+
+def previewImage(
+    source: ImageSource,
+    blocks: int = PREVIEW_BLOCKS,
+    min_block_px: int = PREVIEW_MIN_BLOCK_PX,
+    max_side: int = PREVIEW_MAX_SIDE,
+) -> Image.Image:
+    """ぼかし（モザイク）プレビューを作る。元の解像度の画素は展開しない。
+
+    JPEGは draft で1/2〜1/8の縮尺のままデコードし、それ以外は reduce で整数分の1に
+    縮めてから、ブロックごとの平均に縮小する。ブロックは長辺 max_side 以下に拡大する。
+
+    Args:
+        source: 元画像
+        blocks: 長辺のブロック数
+        min_block_px: 元画像での1ブロックの最小の大きさ（px）
+        max_side: 出力の長辺の上限（px）
+
+    Returns:
+        RGBAのImage
+    """
+    im = openImage(source)
+    w, h = im.size
+    block_px = max(min_block_px, max(w, h) // blocks)
+    grid = (max(1, w // block_px), max(1, h // block_px))
+
+    im.draft("RGB", grid)
+    if im.mode not in ("RGB", "RGBA", "L", "LA"):
+        im = im.convert("RGBA")
+    factor = min(im.width // grid[0], im.height // grid[1])
+    if factor > 1:
+        im = im.reduce(factor)
+    small = im.resize(grid, Image.Resampling.BOX).convert("RGBA")
+
+    scale = max(1, max_side // max(grid))
+    return small.resize((grid[0] * scale, grid[1] * scale), Image.Resampling.NEAREST)
+
+
+def loadPixels(
+    source: ImageSource, decoded_path: Optional[str] = None
+) -> Union[Image.Image, np.ndarray]:
+    """元画像を読み込む。展開済みの画素があればデコードを省略する。
+
+    Args:
+        source: 元画像
+        decoded_path: 展開済みの画素を保存する .npy ファイルのパス（cache.DecodedCache）
+
+    Returns:
+        decoded_pathを指定した場合は (高さ, 幅, 4) のuint8配列（.npyをmmapしたもの）、
+        指定しない場合はRGBAのImage
+    """
+    if decoded_path is None:
+        return bytes2image(source)
+    try:
+        return np.load(decoded_path, mmap_mode="r")
+    except FileNotFoundError:
+        pass
+    im = bytes2image(source)
+    # 帯ごとに .npy へ書き出し、全体を保持した中間配列を作らない
+    tmp = f"{decoded_path}.{os.getpid()}.tmp"
+    pixels = np.lib.format.open_memmap(
+        tmp, mode="w+", dtype=np.uint8, shape=(im.height, im.width, 4)
+    )
+    y = 0
+    for band in iterBands(im):
+        pixels[y : y + band.shape[0]] = band
+        y += band.shape[0]
+    pixels.flush()
+    os.replace(tmp, decoded_path)
+    return pixels
+
+
+def iterBands(
+    image: Image.Image, band_height: int = ENCODE_BAND_HEIGHT
+) -> Iterator[np.ndarray]:
+    """RGBAのImageを上から帯ごとにuint8配列 (高さ, 幅, 4) として返す。"""
+    w, h = image.size
+    for y in range(0, h, band_height):
+        yield np.asarray(image.crop((0, y, w, min(y + band_height, h))))
+
+
+class AverageHashAccumulator:
+    """帯ごとに渡された画素から、画像全体のaverage hashを求める。
+
+    imagehash.average_hash と同じ8x8・平均値との比較だが、縮小はLANCZOSではなく
+    各セルの単純平均で行うので、エンコードと同じ走査の中で計算できる。
+    """
+
+    def __init__(self, width: int, height: int, hash_size: int = 8):
+        self._height = height
+        self._hash_size = hash_size
+        # hash_size より細い・低い画像は、画素数ぶんのセルで平均してから広げる
+        cols = min(hash_size, width)
+        self._rows = min(hash_size, height)
+        self._col_starts = np.arange(cols) * width // cols
+        self._sums = np.zeros((self._rows, cols), dtype=np.float64)
+        self._counts = np.zeros((self._rows, cols), dtype=np.float64)
+        self._y = 0
+
+    def update(self, band: np.ndarray):
+        # PILの "L" 変換と同じ係数で輝度を求める
+        lum = (
+            band[..., 0] * np.uint32(19595)
+            + band[..., 1] * np.uint32(38470)
+            + band[..., 2] * np.uint32(7471)
+            + np.uint32(0x8000)
+        ) >> 16
+        widths = np.diff(np.append(self._col_starts, band.shape[1]))
+        colsums = np.add.reduceat(lum, self._col_starts, axis=1)
+        rows = (
+            np.arange(self._y, self._y + band.shape[0]) * self._rows
+        ) // self._height
+        np.add.at(self._sums, rows, colsums)
+        np.add.at(self._counts, rows, widths)
+        self._y += band.shape[0]
+
+    def hexdigest(self) -> str:
+        means = self._sums / np.maximum(self._counts, 1)
+        rows, cols = means.shape
+        index = np.arange(self._hash_size)
+        means = means[index * rows // self._hash_size][
+            :, index * cols // self._hash_size
+        ]
+        return str(imagehash.ImageHash(means > means.mean()))
+
+
+class PNGStreamEncoder:
+    """RGBA画像を帯ごとに受け取り、PNGとして逐次圧縮する。
+
+    各行にUpフィルタ（直上の行との差分）をかけてzlibに流すので、
+    全体を保持した中間バッファを作らない。
+    """
+
+    def __init__(self, width: int, height: int, compress_level: int = 1):
+        self._width = width
+        self._out = BytesIO()
+        self._out.write(_PNG_SIGNATURE)
+        # 8bit RGBA、非インターレース
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+        self._z = zlib.compressobj(compress_level)
+        self._prev = np.zeros(width * 4, dtype=np.uint8)
+
+    def _chunk(self, kind: bytes, data: bytes):
+        self._out.write(struct.pack(">I", len(data)))
+        self._out.write(kind)
+        self._out.write(data)
+        self._out.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def write(self, band: np.ndarray):
+        """(高さ, 幅, 4) のuint8配列を追記する。"""
+        rows = band.reshape(band.shape[0], self._width * 4)
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 2  # Up
+        np.subtract(rows[0], self._prev, out=filtered[0, 1:])
+        np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+        self._prev = rows[-1].copy()
+        data = self._z.compress(filtered)
+        if data:
+            self._chunk(b"IDAT", data)
+
+    def finish(self) -> bytes:
+        self._chunk(b"IDAT", self._z.flush())
+        self._chunk(b"IEND", b"")
+        return self._out.getvalue()
+
+
+def encodeBands(bands: Iterable[np.ndarray], width: int, height: int) -> EncodedImage:
+    """帯ごとの画素を fast_png プロファイルでエンコードする。
+
+    結果は image2bytes(..., "fast_png") と同じ。
+    """
+    encoder = PNGStreamEncoder(width, height)
+    hasher = AverageHashAccumulator(width, height)
+    for band in bands:
+        encoder.write(band)
+        hasher.update(band)
+    return EncodedImage(encoder.finish(), hasher.hexdigest(), "png")
+
+
+def _encodeFastPNG(image: Image.Image) -> EncodedImage:
+    return encodeBands(iterBands(image), *image.size)
+
+
+def _hashOnly(image: Image.Image) -> str:
+    hasher = AverageHashAccumulator(*image.size)
+    for band in iterBands(image):
+        hasher.update(band)
+    return hasher.hexdigest()
+
+
+def _encodeWithPillow(image: Image.Image, format: str, **params) -> EncodedImage:
+    fileio = BytesIO()
+    image.save(fileio, format=format, **params)
+    return EncodedImage(fileio.getvalue(), _hashOnly(image), format)
+
+
+def _encodeWebPLossless(image: Image.Image) -> EncodedImage:
+    # exact: 透明な画素のRGB（透かしを含む）を捨てない
+    return _encodeWithPillow(
+        image, "webp", lossless=True, quality=20, method=0, exact=True
+    )
+
+
+def image2bytes(
+    image: Image.Image,
+    profile: str = "fast_png",
+    size_limit: int = DISCORD_UPLOAD_LIMIT,
+) -> EncodedImage:
+    """Imageを指定のプロファイルでエンコードする。
+
+    Args:
+        image: エンコードする画像
+        profile: ENCODE_PROFILES のいずれか
+        size_limit: capped プロファイルでのファイルサイズ上限（バイト）
+
+    Returns:
+        EncodedImage
+    """
+    if profile not in ENCODE_PROFILES:
+        raise ValueError(f"unknown encode profile: {profile}")
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+
+    with StageTimer(f"image2file/{profile}"):
+        if profile == "fast_png":
+            return _encodeFastPNG(image)
+        if profile == "optimized_png":
+            return _encodeWithPillow(image, "png", optimize=True)
+        if profile == "webp_lossless":
+            return _encodeWebPLossless(image)
+
+        encoded = _encodeFastPNG(image)
+        if len(encoded.data) <= size_limit:
+            return encoded
+        if max(image.size) <= WEBP_MAX_SIDE:
+            encoded = min(
+                encoded, _encodeWebPLossless(image), key=lambda e: len(e.data)
+            )
+        return shrinkToLimit(image, encoded, size_limit)
+
+
+def shrinkToLimit(
+    image: Image.Image,
+    encoded: EncodedImage,
+    size_limit: int = DISCORD_UPLOAD_LIMIT,
+) -> EncodedImage:
+    """上限を超えるエンコード結果を、収まるまで縮小してエンコードし直す。
+
+    NEARESTで縮小するので、残った各画素の値（透かし）はそのまま残る。
+
+    Args:
+        image: encoded の元になったRGBAの画像
+        encoded: image をエンコードした結果（この形式でエンコードし直す）
+        size_limit: ファイルサイズ上限（バイト）
+
+    Returns:
+        EncodedImage
+    """
+    encode = _encodeFastPNG if encoded.format == "png" else _encodeWebPLossless
+    while len(encoded.data) > size_limit and min(image.size) > 1:
+        scale = (size_limit / len(encoded.data)) ** 0.5 * 0.95
+        image = image.resize(
+            (max(1, int(image.width * scale)), max(1, int(image.height * scale))),
+            Image.Resampling.NEAREST,
+        )
+        encoded = encode(image)
+    return encoded
+
+
+def encodePreview(image: Image.Image) -> EncodedImage:
+    """ぼかしプレビューを256色のパレットPNGにエンコードする。
+
+    プレビューは単色のブロックを並べただけなので、減色しても見た目はほとんど変わらず、
+    同じ行が続くぶん圧縮もよく効く。
+    """
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    with StageTimer("image2file/preview"):
+        palette = image.quantize(256, method=Image.Quantize.FASTOCTREE)
+        fileio = BytesIO()
+        palette.save(fileio, format="png", optimize=True)
+        return EncodedImage(fileio.getvalue(), _hashOnly(image), "png")
@@ -1,8 +1,372 @@
+import asyncio
+import collections
+import ctypes
+import gc
+import math
+import os
 import time
 import logging
+import tracemalloc
+from typing import Callable, Optional
 
 logger = logging.getLogger("piccord.perf")
-logging.basicConfig(level=logging.INFO, format="[PERF] %(message)s")
+# ステージごとの行は DEBUG、合計時間は INFO で出す（PERF_LOG_LEVEL=DEBUG で全て表示）
+logging.basicConfig(
+    level=os.getenv("PERF_LOG_LEVEL", "INFO"), format="[PERF] %(message)s"
+)
+
+# 2の冪ごとの区間を等分する数（分位点の相対誤差は 1/_SUB_BUCKETS 以下）
+_SUB_BUCKETS = 32
+# 0以下の値を入れるバケット
+_ZERO_BUCKET = -(1 << 30)
+
+# エクスポートする分位点
+QUANTILES = (0.5, 0.95, 0.99)
+
+# プロファイリング中に、ステージごとのRSSの増加（KB）を記録する名前の接頭辞
+RSS_PREFIX = "rss/"
+
+
+class Histogram:
+    """所要時間（ms）の分布を、対数・線形の2段のバケットで数える（HDR Histogram 風）。
+
+    記録は辞書の加算1回で済み、件数によらず使用メモリはバケット数で抑えられる。
+    """
+
+    __slots__ = ("counts", "count", "sum", "min", "max")
+
+    def __init__(self):
+        self.counts: dict[int, int] = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def record(self, value: float):
+        if value > 0:
+            m, e = math.frexp(value)
+            key = e * _SUB_BUCKETS + int((m - 0.5) * 2 * _SUB_BUCKETS)
+        else:
+            key = _ZERO_BUCKET
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "Histogram"):
+        for key, n in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + n
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> float:
+        """q分位点（バケットの上端。最小値・最大値の範囲に収める）。"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for key in sorted(self.counts):
+            seen += self.counts[key]
+            if seen >= rank:
+                break
+        if key == _ZERO_BUCKET:
+            return max(self.min, 0.0)
+        e, sub = divmod(key, _SUB_BUCKETS)
+        upper = math.ldexp(0.5 + (sub + 1) / (2 * _SUB_BUCKETS), e)
+        return min(max(upper, self.min), self.max)
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsRegistry:
+    """ステージごとの所要時間・イベントの回数・現在値（キュー長など）を集める。
+
+    ワーカープロセスで計測したものは drain で取り出し、メインプロセスで merge する。
+    """
+
+    def __init__(self):
+        self.histograms: dict[str, Histogram] = {}
+        self.counters: dict[str, int] = {}
+        self._gauges: dict[str, Callable[[], float]] = {}
+
+    def observe(self, name: str, ms: float):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram()
+        h.record(ms)
+
+    def increment(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name: str, fn: Callable[[], float]):
+        """読み出すたびに fn() を呼んで現在値とする。"""
+        self._gauges[name] = fn
+
+    def gauges(self) -> dict[str, float]:
+        values = {}
+        for name, fn in self._gauges.items():
+            try:
+                values[name] = float(fn())
+            except Exception:
+                pass  # 未初期化などで読めない値は出さない
+        return values
+
+    def drain(self) -> tuple[dict[str, Histogram], dict[str, int]]:
+        """ここまでの所要時間・回数を取り出して空にする。"""
+        drained = (self.histograms, self.counters)
+        self.histograms, self.counters = {}, {}
+        return drained
+
+    def merge(self, drained: tuple[dict[str, Histogram], dict[str, int]]):
+        histograms, counters = drained
+        for name, h in histograms.items():
+            if name in self.histograms:
+                self.histograms[name].merge(h)
+            else:
+                self.histograms[name] = h
+        for name, n in counters.items():
+            self.increment(name, n)
+
+    def render_prometheus(self) -> str:
+        """Prometheus のテキスト形式で出力する。"""
+        lines = []
+        for family, names in (
+            (
+                "piccord_stage_duration_ms",
+                [n for n in self.histograms if not n.startswith(RSS_PREFIX)],
+            ),
+            (
+                "piccord_stage_rss_growth_kb",
+                [n for n in self.histograms if n.startswith(RSS_PREFIX)],
+            ),
+        ):
+            lines.append(f"# TYPE {family} summary")
+            for name in sorted(names):
+                h = self.histograms[name]
+                stage = _label(name)
+                if family != "piccord_stage_duration_ms":
+                    stage = _label(name[len(RSS_PREFIX) :])
+                for q in QUANTILES:
+                    lines.append(
+                        f'{family}{{stage="{stage}",quantile="{q}"}} '
+                        f"{h.quantile(q):.3f}"
+                    )
+                lines.append(f'{family}_sum{{stage="{stage}"}} {h.sum:.3f}')
+                lines.append(f'{family}_count{{stage="{stage}"}} {h.count}')
+        lines.append("# TYPE piccord_events_total counter")
+        for name in sorted(self.counters):
+            lines.append(
+                f'piccord_events_total{{event="{_label(name)}"}} {self.counters[name]}'
+            )
+        lines.append("# TYPE piccord_gauge gauge")
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f'piccord_gauge{{name="{_label(name)}"}} {value:g}')
+        return "\n".join(lines) + "\n"
+
+    def summary(self, prefix: str = "") -> str:
+        """人が読むための一覧。prefix で始まる名前だけに絞れる。"""
+        lines = [f"{'stage':<40} {'n':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}"]
+        for name in sorted(self.histograms):
+            if name.startswith(prefix):
+                h = self.histograms[name]
+                lines.append(
+                    f"{name:<40} {h.count:>6} {h.quantile(0.5):>8.1f} "
+                    f"{h.quantile(0.95):>8.1f} {h.quantile(0.99):>8.1f} {h.max:>8.1f}"
+                )
+        for name in sorted(self.counters):
+            if name.startswith(prefix):
+                lines.append(f"{name:<40} {self.counters[name]:>6}")
+        for name, value in sorted(self.gauges().items()):
+            if name.startswith(prefix):
+                lines.append(f"{name:<40} {value:>6g}")
+        return "\n".join(lines)
+
+
+# プロセス全体で共有するレジストリ（タイマーはここに記録する）
+metrics = MetricsRegistry()
+
+
+async def start_metrics_server(
+    host: str, port: int, registry: Optional[MetricsRegistry] = None
+) -> asyncio.AbstractServer:
+    """メトリクスを Prometheus のテキスト形式で返すHTTPサーバーを起動する。
+
+    リクエストのパスは問わない。
+    """
+    registry = registry or metrics
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            body = registry.render_prometheus().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: %d\r\n"
+                b"Connection: close\r\n\r\n" % len(body) + body
+            )
+            await writer.drain()
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            ConnectionError,
+        ):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+# malloc_trim を呼ぶためのglibc（ほかの環境ではNone）
+try:
+    _libc: Optional[ctypes.CDLL] = ctypes.CDLL("libc.so.6")
+except OSError:
+    _libc = None
+
+_PAGE_KB = (os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096) // 1024
+
+
+def current_rss_kb() -> Optional[int]:
+    """現在のRSS（KB）。/proc がない環境ではNone。"""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * _PAGE_KB
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def peak_rss_kb() -> Optional[int]:
+    """RSSの最大値（KB、VmHWM）。/proc がない環境ではNone。"""
+    try:
+        with open("/proc/self/status", "rb") as f:
+            for line in f:
+                if line.startswith(b"VmHWM:"):
+                    return int(line.split()[1])
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+def reset_peak_rss() -> bool:
+    """RSSの最大値（VmHWM）を現在のRSSに戻す。戻せない環境ではFalse。
+
+    解放済みのメモリをmallocが抱えたままだと、次の確保がRSSに現れないので、
+    先にOSへ返しておく（glibcのみ）。
+    """
+    gc.collect()
+    if _libc is not None:
+        _libc.malloc_trim(0)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class MemoryProfiler:
+    """実行中に切り替えられるメモリのプロファイリング。
+
+    有効な間は、タイマーがステージごとのRSSの増加を "rss/{ステージ名}" として記録し、
+    tracemalloc のスナップショットを一定間隔で保存する。無効なときのタイマーの負担は
+    属性を1回読むだけ。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.snapshots: collections.deque = collections.deque()
+        self._task: Optional[asyncio.Task] = None
+        self._started_rss: Optional[int] = None
+
+    def start(self, interval: float, keep: int, frames: int = 1):
+        """プロファイリングを始める（イベントループの中から呼ぶ）。
+
+        Args:
+            interval: tracemalloc のスナップショットを取る間隔（秒）
+            keep: 保存しておくスナップショットの数
+            frames: 割り当て1件ごとに記録する呼び出し元の深さ
+        """
+        if self.enabled:
+            return
+        tracemalloc.start(frames)
+        self.enabled = True
+        self.snapshots = collections.deque(maxlen=keep)
+        self._started_rss = current_rss_kb()
+        self._task = asyncio.ensure_future(self._sample(interval))
+
+    def stop(self):
+        self.enabled = False
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.snapshots.clear()
+        tracemalloc.stop()
+
+    async def _sample(self, interval: float):
+        while True:
+            # 割り当てが多いと数百msかかるので、イベントループを止めないようにする
+            snapshot = await asyncio.to_thread(self._snapshot)
+            self.snapshots.append((time.time(), snapshot))
+            await asyncio.sleep(interval)
+
+    @staticmethod
+    def _snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),)
+        )
+
+    def report(self, limit: int = 10) -> str:
+        """ヒープの状況を人が読める形で返す。
+
+        現在の割り当ての多い箇所と、保存した最も古いスナップショットからの増加の多い箇所。
+        """
+        rss = current_rss_kb()
+        lines = [f"rss: {rss / 1024:.1f}MB" if rss is not None else "rss: -"]
+        if not self.enabled:
+            lines.append("profiling: off")
+            return "\n".join(lines)
+        if rss is not None and self._started_rss is not None:
+            lines[0] += f" ({(rss - self._started_rss) / 1024:+.1f}MB since start)"
+        current, peak = tracemalloc.get_traced_memory()
+        lines.append(f"traced: {current / 2**20:.1f}MB (peak {peak / 2**20:.1f}MB)")
+
+        snapshot = self._snapshot()
+        lines.append(f"top {limit}:")
+        for stat in snapshot.statistics("lineno")[:limit]:
+            lines.append(f"  {stat.size / 1024:>9.1f}KB {stat.count:>7} {_where(stat)}")
+        if self.snapshots:
+            taken, oldest = self.snapshots[0]
+            lines.append(f"growth since {time.time() - taken:.0f}s ago:")
+            for stat in snapshot.compare_to(oldest, "lineno")[:limit]:
+                lines.append(
+                    f"  {stat.size_diff / 1024:>+9.1f}KB {stat.count_diff:>+7} "
+                    f"{_where(stat)}"
+                )
+        return "\n".join(lines)
+
+
+def _where(stat) -> str:
+    frame = stat.traceback[0]
+    return f"{os.path.basename(frame.filename)}:{frame.lineno}"
+
+
+# プロセス全体で共有するプロファイラー（タイマーが参照する）
+profiler = MemoryProfiler()
+
+
+def _observe_rss(name: str, before: Optional[int]):
+    after = current_rss_kb()
+    if before is not None and after is not None:
+        # 減った場合は0として数える（増加の分布を見るため）
+        metrics.observe(RSS_PREFIX + name, max(after - before, 0))
 
 
 class StageTimer:
@@ -11,14 +375,19 @@ class StageTimer:
     def __init__(self, name: str):
         self.name = name
         self._t = 0.0
+        self._rss: Optional[int] = None
 
     def __enter__(self):
+        self._rss = current_rss_kb() if profiler.enabled else None
         self._t = time.perf_counter()
         return self
 
     def __exit__(self, *_):
         ms = (time.perf_counter() - self._t) * 1000
-        logger.info(f"{self.name}: {ms:.1f}ms")
+        metrics.observe(self.name, ms)
+        if self._rss is not None:
+            _observe_rss(self.name, self._rss)
+        logger.debug("%s: %.1fms", self.name, ms)
 
 
 class AsyncStageTimer:
@@ -27,14 +396,20 @@ class AsyncStageTimer:
     def __init__(self, name: str):
         self.name = name
         self._t = 0.0
+        self._rss: Optional[int] = None
 
     async def __aenter__(self):
+        # await の間に他のタスクが増やした分も含む
+        self._rss = current_rss_kb() if profiler.enabled else None
         self._t = time.perf_counter()
         return self
 
     async def __aexit__(self, *_):
         ms = (time.perf_counter() - self._t) * 1000
-        logger.info(f"{self.name}: {ms:.1f}ms")
+        metrics.observe(self.name, ms)
+        if self._rss is not None:
+            _observe_rss(self.name, self._rss)
+        logger.debug("%s: %.1fms", self.name, ms)
 
 
 class TotalTimer:
@@ -43,10 +418,44 @@ class TotalTimer:
     def __init__(self, label: str):
         self.label = label
         self._t = 0.0
+        self._rss: Optional[int] = None
 
     def start(self):
+        self._rss = current_rss_kb() if profiler.enabled else None
         self._t = time.perf_counter()
 
     def stop(self):
         ms = (time.perf_counter() - self._t) * 1000
+        metrics.observe(self.label, ms)
+        if self._rss is not None:
+            _observe_rss(self.label, self._rss)
         logger.info(f"TOTAL [{self.label}]: {ms:.1f}ms")
+
+
+class HitRateCounter:
+    """キャッシュのヒット・ミスを集計し、ヒット率をログに出す。"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def record(self, hit: bool):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        metrics.increment(f"{self.name}/{'hit' if hit else 'miss'}")
+        logger.debug(
+            "%s: %s (hit rate %.1f%%, %d/%d)",
+            self.name,
+            "hit" if hit else "miss",
+            self.rate * 100,
+            self.hits,
+            self.hits + self.misses,
+        )
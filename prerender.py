@@ -0,0 +1,103 @@
+import asyncio
+import itertools
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+from constants import PRERENDER_CPU_BUDGET
+
+
+class PrerenderJob(NamedTuple):
+    """事前生成する1件（投稿 × 閲覧者）。"""
+
+    thread_id: int
+    internal_id: int
+
+
+class PrerenderQueue:
+    """閲覧されそうなユーザー向けの透かし入り画像を、空いているCPUで事前に生成する。
+
+    ジョブは閲覧数の多いユーザーから順に1件ずつ実行する。is_idle() が真になるまで
+    実行を待ち、各ジョブの後は所要時間に応じて休むことで、使用する時間の割合を
+    cpu_budget 以下に抑える。投稿が削除された場合は cancel で取り消す。
+    """
+
+    def __init__(
+        self,
+        render: Callable[[PrerenderJob], Awaitable[None]],
+        is_idle: Callable[[], bool],
+        cpu_budget: float = PRERENDER_CPU_BUDGET,
+        idle_poll: float = 1.0,
+    ):
+        """
+        Args:
+            render: 1件を生成して保存するコルーチン関数
+            is_idle: 閲覧などの処理が動いていなければ真を返す関数
+            cpu_budget: 事前生成に使う時間の割合の上限（0より大きく1以下）
+            idle_poll: is_idle() を確認する間隔（秒）
+
+        Raises:
+            ValueError: cpu_budget が範囲外の場合
+        """
+        if not 0 < cpu_budget <= 1:
+            raise ValueError(f"cpu_budget must be in (0, 1]: {cpu_budget}")
+        self._render = render
+        self._is_idle = is_idle
+        self._cpu_budget = cpu_budget
+        self._idle_poll = idle_poll
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._cancelled: set[int] = set()
+        self._current: Optional[tuple[PrerenderJob, asyncio.Task]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    def schedule(self, thread_id: int, viewers: list[tuple[int, int]]):
+        """投稿の事前生成を予約する。
+
+        Args:
+            thread_id: 元画像を保管しているスレッドのID
+            viewers: [(internal_id, 閲覧数)]（閲覧数の多いものから生成する）
+        """
+        self._cancelled.discard(thread_id)
+        for internal_id, views in viewers:
+            job = PrerenderJob(thread_id, internal_id)
+            self._queue.put_nowait((-views, next(self._seq), job))
+
+    def cancel(self, thread_id: int):
+        """投稿の事前生成を取り消す。実行中のものは中断する。"""
+        self._cancelled.add(thread_id)
+        if self._current is not None and self._current[0].thread_id == thread_id:
+            self._current[1].cancel()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, job = await self._queue.get()
+            while not self._is_idle():
+                await asyncio.sleep(self._idle_poll)
+            if job.thread_id in self._cancelled:
+                continue
+
+            started = loop.time()
+            task = asyncio.create_task(self._render(job))
+            self._current = (job, task)
+            try:
+                # 取り消しで中断されても、このループは止めない
+                await asyncio.wait({task})
+            finally:
+                self._current = None
+                task.cancel()
+            if not task.cancelled() and task.exception() is not None:
+                print(f"prerender failed: {job} {task.exception()!r}")
+
+            elapsed = loop.time() - started
+            await asyncio.sleep(elapsed * (1 / self._cpu_budget - 1))
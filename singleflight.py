@@ -0,0 +1,55 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class _Flight:
+    __slots__ = ("future", "waiters")
+
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.waiters = 0
+
+
+class SingleFlight:
+    """同じキーの処理が実行中なら新しく始めず、実行中の処理の結果を待つ。
+
+    処理の例外は待っている全員に送出する。待っている呼び出し元の一部が取り消されても
+    処理は続け、全員が取り消された場合だけ処理も取り消す。
+    """
+
+    def __init__(self):
+        self._inflight: dict[Hashable, _Flight] = {}
+
+    def __len__(self) -> int:
+        """実行中の処理の数。"""
+        return len(self._inflight)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._inflight
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """key の処理が実行中ならその結果を、なければ fn() を実行して結果を返す。"""
+        flight = self._inflight.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(fn()))
+            self._inflight[key] = flight
+            flight.future.add_done_callback(lambda f: self._done(key, f))
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.future)
+        except asyncio.CancelledError:
+            if flight.waiters == 1:
+                flight.future.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _done(self, key: Hashable, future: asyncio.Future):
+        flight = self._inflight.get(key)
+        if flight is not None and flight.future is future:
+            del self._inflight[key]
+        # 待っている呼び出し元が全て取り消された場合の警告を出さない
+        if not future.cancelled():
+            future.exception()
@@ -1,11 +1,16 @@
 import asyncio
+import datetime
 import os
+import random
+import time
 
 import pytest
 import pytest_asyncio
 import asyncpg
 
-from db import UserIdMapper, ImageCacheMapper
+from db import UserIdMapper, ImageCacheMapper, ImageHashMapper
+from hashindex import BKTree, hash_distance
+from idalloc import FreeIdBitmap
 
 DATABASE_URL = os.getenv(
     "TEST_DATABASE_URL",
@@ -31,6 +36,12 @@ async def test_get_or_create_returns_valid_range(mapper):
     assert 0 <= internal_id <= 65535
 
 
+@pytest.mark.asyncio
+async def test_first_allocated_id_is_one(mapper):
+    """透かしのない画像と区別できないID 0は割り当てず、最初のIDは1であること"""
+    assert await mapper.get_or_create_internal_id(111111111111111111) == 1
+
+
 @pytest.mark.asyncio
 async def test_same_user_gets_same_id(mapper):
     """同じDiscord UserIDには常に同じinternal_idが返ること"""
@@ -88,6 +99,105 @@ async def test_many_users_no_collision(mapper):
     assert len(ids) == 100
 
 
+@pytest.mark.asyncio
+async def test_cached_lookup_coalesces_access_time(mapper):
+    """キャッシュから返した分のlast_accessed_atはflushでまとめて更新されること"""
+    discord_id = 555555555555555555
+    internal_id = await mapper.get_or_create_internal_id(discord_id)
+    await mapper._pool.execute(
+        "UPDATE user_id_mapping SET last_accessed_at = '2000-01-01'"
+    )
+
+    assert await mapper.get_or_create_internal_id(discord_id) == internal_id
+    assert await mapper.get_discord_id(internal_id) == discord_id
+    query = "SELECT last_accessed_at FROM user_id_mapping WHERE discord_user_id = $1"
+    old = await mapper._pool.fetchval(query, discord_id)
+    assert old.year == 2000
+
+    await mapper.flush()
+    assert (await mapper._pool.fetchval(query, discord_id)) > old
+
+
+@pytest.mark.asyncio
+async def test_start_twice_keeps_one_flush_task(mapper):
+    """再接続で start が再度呼ばれても、定期書き込みのタスクは1つだけであること"""
+    mapper.start()
+    task = mapper._flush_task
+    mapper.start()
+    assert mapper._flush_task is task
+    await mapper.close()
+    assert mapper._flush_task is None
+
+
+@pytest.mark.asyncio
+async def test_cache_eviction_keeps_reverse_lookup_consistent(mapper):
+    """キャッシュの上限を超えても正引き・逆引きが正しいこと"""
+    small = UserIdMapper(mapper._pool, cache_size=2)
+    ids = [await small.get_or_create_internal_id(700 + i) for i in range(5)]
+    assert len(small._discord_ids) == 2
+    for i, internal_id in enumerate(ids):
+        assert await small.get_discord_id(internal_id) == 700 + i
+        assert await small.get_or_create_internal_id(700 + i) == internal_id
+
+
+@pytest.mark.asyncio
+async def test_concurrent_allocation_no_collision(mapper):
+    """別インスタンスから同時に割り当てても衝突せず、同じユーザーは同じIDになること"""
+    mapper2 = UserIdMapper(mapper._pool)
+    await mapper2.init()
+    users = [800 + i % 150 for i in range(300)]
+    ids = await asyncio.gather(
+        *(
+            (mapper if i % 2 else mapper2).get_or_create_internal_id(u)
+            for i, u in enumerate(users)
+        )
+    )
+    by_user = {}
+    for u, internal_id in zip(users, ids):
+        assert by_user.setdefault(u, internal_id) == internal_id
+    assert len(set(by_user.values())) == 150
+
+
+@pytest.mark.asyncio
+async def test_reclaim_idle_ids(mapper):
+    """アクセスのないユーザーのIDを回収し、関連データを消してから再利用すること"""
+    ids = [await mapper.get_or_create_internal_id(900 + i) for i in range(3)]
+    await mapper._pool.execute(
+        "UPDATE user_id_mapping SET last_accessed_at = '2000-01-01'"
+        " WHERE discord_user_id <> 901"
+    )
+    forgotten = []
+
+    async def forget(internal_ids):
+        forgotten.extend(internal_ids)
+
+    reclaimed = await mapper.reclaim(30, forget)
+    assert sorted(reclaimed) == sorted(forgotten) == [ids[0], ids[2]]
+    assert await mapper.get_discord_id(ids[0]) is None
+    assert await mapper.get_or_create_internal_id(999) == min(ids[0], ids[2])
+    assert await mapper.get_or_create_internal_id(901) == ids[1]
+
+
+@pytest.mark.asyncio
+async def test_allocate_full_id_space_latency(mapper):
+    """ID空間（0を除く65535）をすべて割り当てられ、その後は枯渇を報告すること（負荷試験）"""
+    latencies = []
+    for i in range(65535):
+        start = time.perf_counter()
+        await mapper.get_or_create_internal_id(10**17 + i)
+        latencies.append((time.perf_counter() - start) * 1000)
+    ordered = sorted(latencies)
+    print(
+        f"\n  allocation latency: p50={ordered[len(ordered) // 2]:.2f}ms"
+        f" p99={ordered[len(ordered) * 99 // 100]:.2f}ms"
+        f" max={ordered[-1]:.2f}ms"
+    )
+    # 埋まっていくにつれて遅くならないこと
+    assert sum(latencies[-1000:]) < sum(latencies[:1000]) * 3
+    with pytest.raises(RuntimeError):
+        await mapper.get_or_create_internal_id(10**17 + 65535)
+
+
 @pytest_asyncio.fixture
 async def cache_mapper():
     pool = await asyncpg.create_pool(DATABASE_URL)
@@ -131,3 +241,220 @@ async def test_different_keys_independent(cache_mapper):
     assert await cache_mapper.get_message_id(333, 3) == 1000000001
     assert await cache_mapper.get_message_id(333, 4) == 1000000002
     assert await cache_mapper.get_message_id(444, 3) == 1000000003
+
+
+@pytest.mark.asyncio
+async def test_prerendered_not_counted_until_viewed(cache_mapper):
+    """事前生成した分は閲覧されるまで閲覧数に数えず、既存の閲覧は上書きしないこと"""
+    await cache_mapper.set_message_id(1, 5, 100)
+    await cache_mapper.set_message_id(2, 5, 101)
+    await cache_mapper.set_message_id(1, 6, 102)
+    assert await cache_mapper.add_prerendered(3, 6, 103)
+    assert not await cache_mapper.add_prerendered(1, 5, 104)
+    assert await cache_mapper.get_message_id(1, 5) == 100
+    assert await cache_mapper.active_viewers(10, 1) == [(5, 2), (6, 1)]
+
+    # 閲覧済みの分は書き込まない
+    await cache_mapper.mark_viewed(1, 5)
+    assert not cache_mapper._pending_writes
+    assert (await cache_mapper.get_message(3, 6)).prerendered
+
+    await cache_mapper.mark_viewed(3, 6)
+    assert not (await cache_mapper.get_message(3, 6)).prerendered
+    assert await cache_mapper.active_viewers(1, 1) == [(5, 2)]
+    assert await cache_mapper.active_viewers(10, 1) == [(5, 2), (6, 2)]
+
+
+@pytest.mark.asyncio
+async def test_batch_lookup(cache_mapper):
+    """複数の組をまとめて引けること（未登録の組は含まれない）"""
+    for i in range(5):
+        await cache_mapper.set_message_id(500 + i, i, 7000 + i)
+    await cache_mapper.flush()
+    fresh = ImageCacheMapper(cache_mapper._pool)
+    keys = [(500 + i, i) for i in range(5)] + [(599, 0)]
+    expected = {(500 + i, i): 7000 + i for i in range(5)}
+    assert await fresh.get_message_ids(keys) == expected
+
+
+@pytest.mark.asyncio
+async def test_write_behind_flush(cache_mapper):
+    """登録はflushまでDBに書かれないが、同じインスタンスからは読めること"""
+    await cache_mapper.set_message_id(600, 1, 123)
+    count = "SELECT COUNT(*) FROM image_cache WHERE thread_id = 600"
+    assert await cache_mapper._pool.fetchval(count) == 0
+    assert await cache_mapper.get_message_id(600, 1) == 123
+    await cache_mapper.flush()
+    assert await cache_mapper._pool.fetchval(count) == 1
+
+
+@pytest.mark.asyncio
+async def test_cache_start_twice_keeps_one_flush_task(cache_mapper):
+    """start が再度呼ばれても、書き込みを反映するタスクは1つだけであること"""
+    cache_mapper.start()
+    task = cache_mapper._flush_task
+    cache_mapper.start()
+    assert cache_mapper._flush_task is task
+    await cache_mapper.close()
+    assert cache_mapper._flush_task is None
+
+
+@pytest.mark.asyncio
+async def test_concurrent_lookups_share_one_query(cache_mapper):
+    """同時に来た問い合わせが1回の問い合わせにまとめられること"""
+    await cache_mapper.set_message_id(700, 3, 42)
+    await cache_mapper.flush()
+    fresh = ImageCacheMapper(cache_mapper._pool)
+    batches = []
+    get_messages = fresh.get_messages
+
+    async def counting(keys):
+        batches.append(len(keys))
+        return await get_messages(keys)
+
+    fresh.get_messages = counting
+    results = await asyncio.gather(
+        *(fresh.get_message_id(700, i % 20) for i in range(100))
+    )
+    assert batches == [20]
+    assert results == [42 if i % 20 == 3 else None for i in range(100)]
+
+
+@pytest.mark.asyncio
+async def test_cancelled_lookup_does_not_hang(cache_mapper):
+    """まとめ引きが取り消されたら、待っている呼び出し元も取り消されること"""
+    fresh = ImageCacheMapper(cache_mapper._pool, batch_delay=1.0)
+    lookups = [asyncio.create_task(fresh.get_message_id(800, i)) for i in range(3)]
+    await asyncio.sleep(0)
+    fresh._lookup_task.cancel()
+    results = await asyncio.wait_for(
+        asyncio.gather(*lookups, return_exceptions=True), timeout=1.0
+    )
+    assert all(isinstance(r, asyncio.CancelledError) for r in results)
+    assert not fresh._lookups and fresh._lookup_task is None
+
+
+@pytest.mark.asyncio
+async def test_prefetch_answers_from_memory(cache_mapper):
+    """prefetchした範囲のスレッドはDBに問い合わせずに答えること"""
+    for i in range(3):
+        await cache_mapper.set_message_id(800 + i, 9, 100 + i)
+    await cache_mapper.flush()
+    fresh = ImageCacheMapper(cache_mapper._pool, prefetch_threads=2)
+    await fresh.prefetch(9)
+    get_messages = fresh.get_messages
+
+    async def fail(keys):
+        raise AssertionError(keys)
+
+    fresh.get_messages = fail
+    assert await fresh.get_message_id(802, 9) == 102
+    assert await fresh.get_message_id(801, 9) == 101
+    assert await fresh.get_message_id(900, 9) is None
+    # 読み込んだ範囲より古いスレッドはDBに問い合わせる
+    fresh.get_messages = get_messages
+    assert await fresh.get_message_id(800, 9) == 100
+
+
+@pytest.mark.asyncio
+async def test_attachment_urls_round_trip(cache_mapper):
+    """添付ファイルのURLと有効期限が保存され、期限が近いものは無効と判定されること"""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    urls = ("https://cdn.example/a.png?ex=1", "https://cdn.example/b.png?ex=1")
+    await cache_mapper.set_message_id(
+        1000, 1, 55, urls, now + datetime.timedelta(hours=2)
+    )
+    await cache_mapper.set_message_id(
+        1001, 1, 56, urls, now + datetime.timedelta(minutes=5)
+    )
+    await cache_mapper.set_message_id(1002, 1, 57)
+    await cache_mapper.flush()
+
+    fresh = ImageCacheMapper(cache_mapper._pool)
+    found = await fresh.get_messages([(1000, 1), (1001, 1), (1002, 1)])
+    assert found[(1000, 1)].urls == urls
+    assert found[(1000, 1)].urls_valid(3600)
+    assert not found[(1001, 1)].urls_valid(3600)
+    assert not found[(1002, 1)].urls_valid(3600)
+
+
+def _hashes(ahash: int, phash: int, dhash: int) -> dict:
+    return {
+        "ahash": f"{ahash:016x}",
+        "phash": f"{phash:016x}",
+        "dhash": f"{dhash:016x}",
+        "width": 100,
+        "height": 100,
+    }
+
+
+@pytest_asyncio.fixture
+async def hash_mapper():
+    pool = await asyncpg.create_pool(DATABASE_URL)
+    m = ImageHashMapper(pool)
+    await m.init()
+    yield m
+    await pool.execute("DELETE FROM image_hash")
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_hash_search_nearest_first(hash_mapper):
+    """近いハッシュから順に返り、距離の上限を超えるものは返らないこと"""
+    base = 0xF0F0F0F0F0F0F0F0
+    await hash_mapper.add(1, [_hashes(base, base, base)])
+    await hash_mapper.add(2, [_hashes(base ^ 0b1, base, base)])
+    await hash_mapper.add(3, [_hashes(~base & (2**64 - 1), base, base)])
+    result = hash_mapper.search(_hashes(base, base, base), 5, 10)
+    assert result == [(0, 1, 0), (1, 2, 0)]
+
+
+@pytest.mark.asyncio
+async def test_hash_persistence_across_instances(hash_mapper):
+    """最上位ビットが立ったハッシュも含め、別インスタンスから同じ検索結果が得られること"""
+    h = _hashes(2**64 - 1, 2**63, 12345)
+    await hash_mapper.add(10, [h, _hashes(0, 0, 0)])
+    mapper2 = ImageHashMapper(hash_mapper._pool)
+    await mapper2.init()
+    assert mapper2.search(h, 1, 0) == [(0, 10, 0)]
+    assert 10 in mapper2.threads()
+
+
+def test_bktree_matches_bruteforce():
+    """BK木の半径検索が全件走査と同じ結果を返すこと"""
+    rng = random.Random(0)
+    keys = {i: tuple(rng.getrandbits(64) for _ in range(3)) for i in range(500)}
+    # 近傍が存在するように一部は既存キーの数ビットを反転させる
+    for i in range(500, 700):
+        a, p, d = keys[rng.randrange(500)]
+        keys[i] = (a ^ (1 << rng.randrange(64)), p, d ^ (1 << rng.randrange(64)))
+    tree = BKTree()
+    for i, k in keys.items():
+        tree.add(k, i)
+    for q in rng.sample(list(keys.values()), 20):
+        for radius in (0, 2, 80):
+            expected = sorted(
+                (hash_distance(q, k), i)
+                for i, k in keys.items()
+                if hash_distance(q, k) <= radius
+            )
+            assert tree.search(q, radius) == expected
+
+
+def test_free_id_bitmap_matches_reference():
+    """空きIDのビットマップが、集合で管理した場合と同じ最小の空きIDを返すこと"""
+    rng = random.Random(0)
+    size = 1000
+    bitmap = FreeIdBitmap(size, used=range(0, size, 3))
+    free = set(range(size)) - set(range(0, size, 3))
+    for _ in range(5000):
+        if rng.random() < 0.6:
+            expected = min(free) if free else None
+            assert bitmap.allocate() == expected
+            free.discard(expected)
+        else:
+            i = rng.randrange(size)
+            assert bitmap.release(i) == (i not in free)
+            free.add(i)
+        assert len(bitmap) == len(free)
+    assert all(bitmap.is_free(i) == (i in free) for i in range(size))
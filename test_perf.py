@@ -6,16 +6,54 @@ CPU処理ベンチマーク — Discord 依存なし。
     python -m pytest test_perf.py -v -s
 """
 
+import asyncio
+import copy
+import datetime
+import logging
+import mmap
 import os
 import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
 
 import imagehash
+import numpy as np
 import pytest
-from PIL import Image, ImageFilter
+from PIL import Image, ImageDraw, ImageFilter
 
-from myCrypter import myCrypter
-from perf import StageTimer, TotalTimer
+import myCrypter as myCrypterModule
+from cache import DecodedCache, OriginalCache
+from constants import MASK_BASE, MASK_COLOR
+from download import AttachmentDownloader
+import executor
+from executor import EncryptExecutor, encrypt_job
+from myCrypter import NO_WATERMARK, myCrypter
+from myImageCodec import (
+    ENCODE_PROFILES,
+    bytes2image,
+    encodeBands,
+    encodePreview,
+    image2bytes,
+    openImage,
+    previewImage,
+    WEBP_MAX_SIDE,
+)
+from perf import (
+    MetricsRegistry,
+    StageTimer,
+    TotalTimer,
+    current_rss_kb,
+    metrics,
+    profiler,
+    start_metrics_server,
+)
+from prerender import PrerenderJob, PrerenderQueue
+from singleflight import SingleFlight
+
+# ステージごとの所要時間もログに出す
+logging.getLogger("piccord.perf").setLevel(logging.DEBUG)
 
 TEST_IMAGE_PATH = os.path.join(os.path.dirname(__file__), "test.png")
 INTERNAL_ID = 42
@@ -29,6 +67,35 @@ def test_image() -> Image.Image:
     return im
 
 
+@pytest.fixture(scope="module")
+def image_4k() -> Image.Image:
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 256, (2160, 3840, 4), dtype=np.uint8)
+    return Image.fromarray(data, mode="RGBA")
+
+
+def _encrypt_np_where(im: Image.Image, im_mask: Image.Image) -> Image.Image:
+    """np.where による従来の _encrypt 実装（比較用）。"""
+    im_data = np.array(im)
+    im_mask_data = np.array(im_mask)
+    im_crypted_data = np.where(
+        im_data < 128, im_data + im_mask_data, im_data - im_mask_data
+    )
+    im_crypted_data = im_crypted_data.astype("uint8")
+    return Image.fromarray(im_crypted_data, mode="RGBA")
+
+
+def _traced_peak_mb(fn):
+    """fn() の戻り値と、実行中に tracemalloc で観測したピーク（MB）を返す。"""
+    tracemalloc.start()
+    try:
+        result = fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, peak / 1024 / 1024
+
+
 def _image2file_time(image: Image.Image) -> float:
     """PNG encode + imagehash の合計時間を ms で返す。"""
     t = time.perf_counter()
@@ -63,6 +130,50 @@ def test_gaussianblur_downsample(test_image):
         _ = blurred_small.resize((w, h), resample=Image.Resampling.NEAREST)
 
 
+def test_preview_image():
+    """縮小デコードのぼかしプレビュー — 従来のフル解像度のモザイクとの比較。"""
+    # なめらかな写真に近い 4032x3024 のJPEG（グラデーションに弱いノイズ）
+    rng = np.random.default_rng(0)
+    y = np.linspace(0, 6, 756, dtype=np.float32)[:, None]
+    x = np.linspace(0, 8, 1008, dtype=np.float32)[None, :]
+    base = np.stack(
+        [
+            128 + 90 * np.sin(x) * np.cos(y),
+            128 + 80 * np.cos((x + y) / 2),
+            128 + 70 * np.sin(np.hypot(x - 4, y - 3)),
+        ],
+        axis=-1,
+    )
+    base += rng.normal(0, 4, base.shape)
+    photo = Image.fromarray(np.clip(base, 0, 255).astype(np.uint8))
+    buf = BytesIO()
+    photo.resize((4032, 3024), Image.Resampling.BICUBIC).save(buf, format="jpeg")
+    jpeg = buf.getvalue()
+
+    t = time.perf_counter()
+    im = bytes2image(jpeg)
+    w, h = im.size
+    block_px = max(16, max(w, h) // 80)
+    blur = im.resize(
+        (max(1, w // block_px), max(1, h // block_px)), Image.Resampling.BOX
+    ).resize((w, h), Image.Resampling.NEAREST)
+    full = image2bytes(blur, "fast_png").data
+    full_ms = (time.perf_counter() - t) * 1000
+
+    t = time.perf_counter()
+    preview = previewImage(jpeg)
+    small = encodePreview(preview).data
+    preview_ms = (time.perf_counter() - t) * 1000
+    print(
+        f"  → full: {full_ms:.1f}ms {len(full) // 1024}KB, "
+        f"preview: {preview_ms:.1f}ms {len(small) // 1024}KB"
+    )
+
+    assert preview.size == (480, 360)
+    assert preview.mode == "RGBA"
+    assert len(small) * 10 < len(full)
+
+
 def test_encrypt_pipeline(test_image):
     """myCrypter フルパイプライン（encryptByID + encryptByLabel + encryptByTime + executeEncryption）。"""
     total = TotalTimer("bench/encrypt_pipeline")
@@ -77,6 +188,152 @@ def test_encrypt_pipeline(test_image):
     assert result.size == test_image.size
 
 
+def test_encrypt_pipeline_mask_cache(test_image):
+    """同じ閲覧者の再描画はマスクキャッシュにヒットし、結果も同一になること。"""
+    myCrypterModule.mask_cache.clear()
+    now = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def run() -> Image.Image:
+        c = myCrypter(test_image)
+        c.setChannel([True, False, False, True]).encryptByID(INTERNAL_ID)
+        c.setChannel([False, False, True, True]).encryptByLabel(USER_NAME)
+        return c.encryptByTime(now).executeEncryption()
+
+    hits = myCrypterModule.mask_cache_hit_rate.hits
+    with StageTimer("bench/encrypt_pipeline_mask_cache_miss"):
+        first = run()
+    with StageTimer("bench/encrypt_pipeline_mask_cache_hit"):
+        second = run()
+    assert myCrypterModule.mask_cache_hit_rate.hits == hits + 1
+    assert first.tobytes() == second.tobytes()
+
+
+def test_label_tiles_match_text():
+    """ラベルのタイルを draw.bitmap で描いた結果が、行ごとの draw.text と同じこと。"""
+    import textwrap
+
+    myCrypterModule.label_tile_cache.clear()
+    size, fontsize = (1001, 777), 51  # 奇数の文字サイズで行の位置に端数が出る
+    label = USER_NAME + "gy"
+    fnt = myCrypterModule.loadFont(fontsize)
+    fill = (0, 0, 1, 1)
+
+    expected = Image.new("RGBA", size, 0)
+    draw = ImageDraw.Draw(expected)
+    for i, line in enumerate(textwrap.wrap((label + " ") * 60, 25)):
+        draw.text(
+            (fontsize, i * (fontsize * 1.5) + fontsize), line, fill=fill, font=fnt
+        )
+
+    hits = myCrypterModule.label_tile_cache_hit_rate.hits
+    with StageTimer("bench/label_tiles_miss"):
+        tiles = myCrypterModule.labelTiles(label, fontsize)
+    with StageTimer("bench/label_tiles_hit"):
+        assert myCrypterModule.labelTiles(label, fontsize) is tiles
+    assert myCrypterModule.label_tile_cache_hit_rate.hits == hits + 1
+    # 同じ文字列の行はタイルを共有する
+    assert len({id(tile) for _, tile in tiles}) < len(tiles)
+
+    actual = Image.new("RGBA", size, 0)
+    draw = ImageDraw.Draw(actual)
+    for box, tile in tiles:
+        draw.bitmap(box[:2], tile, fill=fill)
+    assert actual.tobytes() == expected.tobytes()
+
+
+def test_packed_mask(test_image):
+    """ID・ラベル層のマスクは1ビットずつ詰めて持ち、展開すると元のマスクに戻ること。"""
+    myCrypterModule.mask_cache.clear()
+    c = myCrypter(test_image)
+    c.setChannel([True, False, False, True]).encryptByID(INTERNAL_ID)
+    c.setChannel([False, False, True, True]).encryptByLabel(USER_NAME)
+    c.executeEncryption()
+
+    w, h = test_image.size
+    mask = np.asarray(c.maskImageData)
+    assert set(np.unique(mask)) <= {MASK_BASE, MASK_COLOR}
+    assert myCrypterModule.mask_cache.nbytes * 8 <= w * h * 4 + 8 * h
+
+    packed = myCrypterModule.PackedMask(w, h)
+    packed.pack(0, mask)
+    assert np.array_equal(packed.rows(0, h), mask)
+    assert np.array_equal(packed.rows(100, 137), mask[100:137])
+
+
+def test_encrypt_kernel_vs_np_where(image_4k):
+    """in-place uint8 カーネルと従来の np.where 実装を 4K 画像で比較する。"""
+    now = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    c = myCrypter(image_4k)
+    c.setChannel([True, False, False, True]).encryptByID(INTERNAL_ID)
+    c.setChannel([False, False, True, True]).encryptByLabel(USER_NAME)
+    c.encryptByTime(now).executeEncryption()  # マスク生成を計測から除く
+    mask = c.maskImageData
+
+    with StageTimer("bench/encrypt_np_where_4k"):
+        old, old_peak = _traced_peak_mb(lambda: _encrypt_np_where(image_4k, mask))
+    with StageTimer("bench/encrypt_inplace_kernel_4k"):
+        new, new_peak = _traced_peak_mb(c.executeEncryption)
+    print(f"  → peak np.where: {old_peak:.1f}MB, in-place: {new_peak:.1f}MB")
+
+    assert new.tobytes() == old.tobytes()
+    assert new_peak * 3 < old_peak
+
+
+def test_encrypt_banded_matches_full(image_4k):
+    """帯ごとの暗号化・エンコードは従来と同じPNGになり、ピークメモリが小さいこと。"""
+    now = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def crypter() -> myCrypter:
+        c = myCrypter(image_4k)
+        c.setChannel([True, False, False, True]).encryptByID(INTERNAL_ID)
+        c.setChannel([False, False, True, True]).encryptByLabel(USER_NAME)
+        return c.encryptByTime(now)
+
+    myCrypterModule.mask_cache.clear()
+    with StageTimer("bench/encrypt_full_4k"):
+        full, full_peak = _traced_peak_mb(
+            lambda: image2bytes(crypter().executeEncryption(), "fast_png")
+        )
+    myCrypterModule.mask_cache.clear()
+    w, h = image_4k.size
+    with StageTimer("bench/encrypt_banded_4k"):
+        banded, banded_peak = _traced_peak_mb(
+            lambda: encodeBands(crypter().iterEncryptedBands(), w, h)
+        )
+    print(f"  → peak full: {full_peak:.1f}MB, banded: {banded_peak:.1f}MB")
+
+    assert banded == full
+    # 全体の出力配列（w*h*4 バイト）を確保しない（全体のマスクは PackedMask で1/8）
+    assert full_peak - banded_peak > 0.9 * w * h * 4 / 1024 / 1024
+
+
+def test_trace_id(test_image):
+    """透かし入り画像（透過情報なし）から内部IDを復元できること。"""
+    c = myCrypter(test_image)
+    c.setChannel([True, False, False, True]).encryptByID(INTERNAL_ID)
+    c.setChannel([False, False, True, True]).encryptByLabel(USER_NAME).encryptByTime()
+    leaked = c.executeEncryption().convert("RGB")
+
+    with StageTimer("bench/trace_id"):
+        result = myCrypter(test_image).traceID(leaked, test_image)
+    assert result.internal_id == INTERNAL_ID
+    assert result.checksum_ok
+    assert result.confidence > 0.5
+
+
+def test_trace_clean_image(test_image):
+    """透かしのない画像は、内部ID 0 ではなく「透かしなし」と判定すること。"""
+    assert myCrypter(test_image).traceID(test_image, test_image) == NO_WATERMARK
+
+    buf = BytesIO()
+    test_image.convert("RGB").save(buf, format="jpeg", quality=80)
+    recompressed = Image.open(buf)
+    result = myCrypter(test_image).traceID(recompressed, test_image)
+    assert not result.detected
+    assert not result.checksum_ok
+    assert result.confidence == 0.0
+
+
 def test_png_encode(test_image):
     """PNG encode + imagehash の時間。"""
     with StageTimer("bench/png_encode_and_hash"):
@@ -84,6 +341,453 @@ def test_png_encode(test_image):
     print(f"  → png+hash total: {ms:.1f}ms")
 
 
+@pytest.mark.parametrize("size", [(3, 16), (16, 3), (1, 1)])
+def test_average_hash_small_image(size):
+    """8px未満の辺を持つ画像でも、空のセルでハッシュが偏らないこと。"""
+    uniform = Image.new("RGBA", size, (200, 100, 50, 255))
+    assert image2bytes(uniform).hash == str(imagehash.average_hash(uniform))
+
+    gradient = np.zeros((size[1], size[0], 4), dtype=np.uint8)
+    gradient[..., 3] = 255
+    gradient[size[1] // 2 :, :, :3] = 255  # 下半分だけ白
+    gradient = Image.fromarray(gradient)
+    assert image2bytes(gradient).hash == str(imagehash.average_hash(gradient))
+
+
+@pytest.mark.parametrize("profile", ENCODE_PROFILES)
+def test_encode_profiles(test_image, profile):
+    """各エンコードプロファイルの所要時間・サイズ。いずれも可逆であること。"""
+    encoded = image2bytes(test_image, profile)
+    print(f"  → {profile}: {len(encoded.data) / 1024:.0f}KB ({encoded.format})")
+    assert bytes2image(encoded.data).tobytes() == test_image.tobytes()
+
+
+def test_encode_capped_respects_limit(test_image):
+    """capped プロファイルは上限を超える場合に縮小してでも上限内に収めること。"""
+    limit = len(image2bytes(test_image, "fast_png").data) // 4
+    encoded = image2bytes(test_image, "capped", size_limit=limit)
+    assert len(encoded.data) <= limit
+
+
+def test_encode_capped_wider_than_webp(monkeypatch):
+    """WebPの上限より長い辺の画像は、WebPを試さずPNGのまま縮小すること。"""
+    rng = np.random.default_rng(0)
+    wide = Image.fromarray(
+        rng.integers(0, 256, (64, WEBP_MAX_SIDE + 17, 4), dtype=np.uint8)
+    )
+    limit = len(image2bytes(wide, "fast_png").data) // 4
+    encoded = image2bytes(wide, "capped", size_limit=limit)
+    assert encoded.format == "png"
+    assert len(encoded.data) <= limit
+
+    # 帯ごとの経路から上限超えで戻る場合も同じ
+    monkeypatch.setattr(executor, "ENCRYPT_BAND_MIN_PIXELS", 0)
+    monkeypatch.setattr(executor, "DISCORD_UPLOAD_LIMIT", limit)
+    encoded = encrypt_job(
+        image2bytes(wide, "fast_png").data,
+        1,
+        "wide",
+        datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc),
+    )
+    assert encoded.format == "png"
+    assert len(encoded.data) <= limit
+
+
+def test_original_cache(tmp_path, test_image):
+    """元画像キャッシュ: mmap経由で読め、LRUで追い出され、再起動後も残ること。"""
+    png = image2bytes(test_image, "fast_png").data
+    cache = OriginalCache(str(tmp_path), max_bytes=len(png) * 3)
+    cache.put(1, [(10, "a.png", png), (11, "b.png", png)])
+    originals = cache.get(1)
+    assert [o.filename for o in originals] == ["a.png", "b.png"]
+    assert cache.nbytes == len(png)  # 同じ内容は1つだけ保存する
+    with StageTimer("bench/original_cache_decode"):
+        assert bytes2image(originals[0].path).tobytes() == test_image.tobytes()
+    # mmapは読み込み後か、画像を閉じたときに閉じる
+    im = openImage(originals[0].path)
+    fp = im.fp
+    im.load()
+    assert fp.closed
+    im = openImage(originals[0].path)
+    fp = im.fp
+    im.close()
+    assert fp.closed
+
+    other = png + b"\0"  # IENDの後ろのゴミは無視される
+    cache.put(2, [(20, "c.png", other)])
+    cache.get(1)
+    cache.put(3, [(30, "d.png", png + b"\0\0")])
+    assert cache.get(2) is None  # 最も長く参照されていない
+    assert cache.get(1) is not None
+
+    reopened = OriginalCache(str(tmp_path), max_bytes=len(png) * 3)
+    assert reopened.get(1) == cache.get(1)
+    assert reopened.get(3) is not None
+    assert reopened.nbytes == cache.nbytes
+
+    # 索引は書き直さずに追記する。discard は次の put（か flush）でまとめて書く
+    index = tmp_path / "index.log"
+    size = index.stat().st_size
+    cache.discard(3)
+    assert index.stat().st_size == size
+    cache.flush()
+    assert index.stat().st_size > size
+    assert OriginalCache(str(tmp_path), max_bytes=len(png) * 3).get(3) is None
+
+    # 別スレッドから同じ内容を同時に保存しても壊れない
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(lambda i: cache.put(i, [(i, "e.png", png)]), range(10, 18)))
+    assert all(cache.get(i)[0].path == cache.get(1)[0].path for i in range(10, 18))
+
+
+def test_decoded_cache(tmp_path, test_image):
+    """展開済み画素キャッシュ: 暗号化結果がデコード時と同じで、上限で追い出す。"""
+    png = image2bytes(test_image, "fast_png").data
+    timestamp = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    cache = DecodedCache(
+        str(tmp_path), max_bytes=test_image.width * test_image.height * 5
+    )
+    path = cache.path("a")
+
+    def run(decoded_path):
+        return encrypt_job(
+            png, INTERNAL_ID, USER_NAME, timestamp, "fast_png", decoded_path
+        )
+
+    expected = run(None)
+    assert not cache.touch("a")
+    assert run(path) == expected  # デコードして書き出す
+    assert cache.touch("a")
+    with StageTimer("bench/decoded_cache_hit"):
+        assert run(path) == expected
+
+    run(cache.path("b"))
+    cache.touch("b")
+    assert not os.path.exists(path)
+    assert cache.nbytes == os.path.getsize(cache.path("b"))
+
+
+def test_prerender_queue():
+    """事前生成キュー: 閲覧数の多い順に実行し、取り消しと使用率の上限を守ること。"""
+
+    async def scenario():
+        done, started = [], []
+        idle = asyncio.Event()
+
+        async def render(job: PrerenderJob):
+            started.append(asyncio.get_running_loop().time())
+            await asyncio.sleep(0.05)
+            done.append(job)
+
+        queue = PrerenderQueue(render, idle.is_set, cpu_budget=0.5, idle_poll=0.01)
+        queue.schedule(1, [(10, 1), (11, 5)])
+        queue.schedule(2, [(20, 3)])
+        queue.schedule(3, [(30, 4)])
+        queue.cancel(3)
+        queue.start()
+        await asyncio.sleep(0.05)
+        assert not done  # 空くまで待つ
+        idle.set()
+        await asyncio.sleep(0.02)
+        queue.cancel(1)  # 実行中の (1, 11) を中断する
+        cancelled = asyncio.get_running_loop().time()
+        await asyncio.sleep(0.5)
+        queue.stop()
+        return done, started, cancelled
+
+    done, started, cancelled = asyncio.run(scenario())
+    assert done == [PrerenderJob(2, 20)]
+    # 中断までの実行時間と同じだけ休んでから次を始める（cpu_budget=0.5）
+    assert started[1] - started[0] >= (cancelled - started[0]) * 2 * 0.9
+
+    for cpu_budget in (0, -0.5, 1.5):
+        with pytest.raises(ValueError):
+            PrerenderQueue(lambda job: None, lambda: True, cpu_budget=cpu_budget)
+
+
+def test_encrypt_executor():
+    """タイムアウトしたジョブの枠は終わるまで空けず、異常終了したプールは作り直すこと。"""
+
+    async def scenario():
+        ex = EncryptExecutor(max_workers=1, max_pending=1, job_timeout=0.3)
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await ex.run(time.sleep, 1.0)
+            assert ex.pending == 1  # ワーカーはまだ処理している
+            for _ in range(40):
+                await asyncio.sleep(0.05)
+                if ex.pending == 0:
+                    break
+            assert ex.pending == 0
+
+            with pytest.raises(BrokenProcessPool):
+                await ex.run(os._exit, 1)
+            assert await ex.run(abs, -3) == 3
+        finally:
+            ex.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_attachment_downloader():
+    """並行ダウンロード: 同時数の上限・5xxの再試行・一時ファイルへの書き出し。"""
+    from aiohttp import web
+
+    async def scenario():
+        active, peak, failed = [0], [0], set()
+
+        async def handler(request: web.Request):
+            name = request.match_info["name"]
+            if name == "flaky" and name not in failed:
+                failed.add(name)
+                return web.Response(status=503)
+            if name == "missing":
+                return web.Response(status=404)
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+            await asyncio.sleep(0.05)
+            active[0] -= 1
+            size = 64 * 1024 if name == "large" else 100
+            return web.Response(body=name.encode().ljust(size, b"."))
+
+        app = web.Application()
+        app.router.add_get("/{name}", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+        downloader = AttachmentDownloader(2, backoff=0.01, spool_bytes=32 * 1024)
+        try:
+            urls = [f"{base}/{n}" for n in ("a", "b", "c", "d", "flaky", "large")]
+            t = time.perf_counter()
+            fps = await downloader.fetch_all(urls, "bench/download")
+            elapsed = time.perf_counter() - t
+            bodies = [fp.read() for fp in fps]
+            spooled = [isinstance(fp, BytesIO) for fp in fps]
+            for fp in fps:
+                fp.close()
+            with pytest.raises(Exception):
+                await downloader.fetch_all([f"{base}/a", f"{base}/missing"])
+        finally:
+            await downloader.close()
+            await runner.cleanup()
+        return bodies, spooled, peak[0], elapsed
+
+    bodies, spooled, peak, elapsed = asyncio.run(scenario())
+    assert [b.rstrip(b".") for b in bodies] == [
+        b"a",
+        b"b",
+        b"c",
+        b"d",
+        b"flaky",
+        b"large",
+    ]
+    assert len(bodies[-1]) == 64 * 1024
+    assert spooled == [True] * 5 + [False]
+    assert peak == 2
+    assert elapsed < 6 * 0.05  # 直列より速い
+
+
+def test_single_flight():
+    """同じキーの同時呼び出しは1回だけ実行し、全員が取り消されたときだけ中断すること。"""
+
+    async def scenario():
+        flights = SingleFlight()
+        calls = []
+
+        async def work(value):
+            calls.append(value)
+            await asyncio.sleep(0.05)
+            return value
+
+        results = await asyncio.gather(
+            *(flights.do("a", lambda: work(1)) for _ in range(5)),
+            flights.do("b", lambda: work(2)),
+        )
+        assert results == [1] * 5 + [2]
+        assert calls == [1, 2]
+        assert len(flights) == 0
+
+        # 1人が取り消しても、残りの呼び出し元は結果を受け取る
+        first = asyncio.ensure_future(flights.do("c", lambda: work(3)))
+        second = asyncio.ensure_future(flights.do("c", lambda: work(4)))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert await second == 3
+
+        # 全員が取り消したら処理も中断する
+        only = asyncio.ensure_future(flights.do("d", lambda: work(5)))
+        await asyncio.sleep(0.01)
+        only.cancel()
+        await asyncio.sleep(0.1)
+        assert "d" not in flights
+        return calls
+
+    assert asyncio.run(scenario()) == [1, 2, 3, 5]
+
+
+def test_metrics_histogram():
+    """ヒストグラムの分位点の誤差・ワーカー分の合算・タイマーのオーバーヘッド。"""
+    values = np.random.default_rng(0).lognormal(3, 1, 20000)
+    worker, main = MetricsRegistry(), MetricsRegistry()
+    for v in values[:5000]:
+        worker.observe("stage", v)
+    for v in values[5000:]:
+        main.observe("stage", v)
+    worker.increment("cache/hit", 3)
+    main.merge(worker.drain())
+
+    h = main.histograms["stage"]
+    assert h.count == len(values) and not worker.histograms
+    assert main.counters == {"cache/hit": 3}
+    for q in (0.5, 0.95, 0.99):
+        expected = np.quantile(values, q)
+        assert abs(h.quantile(q) - expected) <= expected / 16
+
+    logger = logging.getLogger("piccord.perf")
+    level = logger.level
+    logger.setLevel(logging.INFO)
+    try:
+        n = 20000
+        t = time.perf_counter()
+        for _ in range(n):
+            with StageTimer("bench/overhead"):
+                pass
+        per_call_us = (time.perf_counter() - t) / n * 1e6
+    finally:
+        logger.setLevel(level)
+    print(f"  → StageTimer overhead: {per_call_us:.2f}us")
+    assert per_call_us < 20
+
+
+def test_metrics_exporter():
+    """Prometheus形式のエクスポーターがHTTPで分位点・回数・現在値を返すこと。"""
+    registry = MetricsRegistry()
+    for v in (1.0, 2.0, 3.0, 100.0):
+        registry.observe('view/"cache"', v)
+    registry.increment("crypt/mask_cache/miss")
+    registry.gauge("encrypt_pool/pending", lambda: 7)
+    registry.gauge("broken", lambda: 1 / 0)
+
+    async def scenario() -> str:
+        server = await start_metrics_server("127.0.0.1", 0, registry)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            response = (await reader.read()).decode()
+            writer.close()
+        finally:
+            server.close()
+            await server.wait_closed()
+        return response
+
+    response = asyncio.run(scenario())
+    assert response.startswith("HTTP/1.1 200 OK")
+    body = response.split("\r\n\r\n", 1)[1]
+    assert 'piccord_stage_duration_ms_count{stage="view/\\"cache\\""} 4' in body
+    assert (
+        'piccord_stage_duration_ms{stage="view/\\"cache\\"",quantile="0.99"} 100.000'
+        in body
+    )
+    assert 'piccord_events_total{event="crypt/mask_cache/miss"} 1' in body
+    assert 'piccord_gauge{name="encrypt_pool/pending"} 7' in body
+    assert "broken" not in body
+
+
+def test_memory_profiler():
+    """プロファイリング中だけステージごとのRSSの増加を記録し、ヒープの状況を出せること。"""
+    with StageTimer("bench/profiler_off"):
+        pass
+    assert "rss/bench/profiler_off" not in metrics.histograms
+
+    async def main():
+        profiler.start(interval=0.01, keep=3)
+        try:
+            await asyncio.sleep(0.05)
+            with StageTimer("bench/profiler_on"):
+                # アロケーターの再利用に左右されないよう、新しい領域を確保して触る
+                data = mmap.mmap(-1, 64 * 1024 * 1024)
+                np.frombuffer(data, dtype=np.uint8)[:] = 1
+            return data, profiler.report(limit=3)
+        finally:
+            profiler.stop()
+
+    data, report = asyncio.run(main())
+    data.close()
+    assert not profiler.enabled
+    assert "top 3:" in report and "growth since" in report
+    assert "since start" in report
+    if current_rss_kb() is not None:
+        assert metrics.histograms["rss/bench/profiler_on"].max >= 32 * 1024
+        assert "piccord_stage_rss_growth_kb" in metrics.render_prometheus()
+    assert "profiling: off" in profiler.report()
+
+
+def test_bench_e2e(tmp_path):
+    """偽のDiscordで投稿→閲覧を2周し、2周目がキャッシュに当たることを確認。"""
+    import json
+
+    env = dict(os.environ)
+    import bench_e2e
+    import main
+
+    # import 時に入れた既定値は残さない
+    assert dict(os.environ) == env
+    before = (main.encrypt_executor, main.user_id_mapper, main.original_cache)
+
+    out = tmp_path / "result.json"
+    config = bench_e2e.BenchConfig(
+        users=3, posts=2, images=2, size=(160, 120), latency=0.001, duplicate=0.5
+    )
+    report = bench_e2e.run(config, str(out))
+
+    # 差し替えた main のグローバル変数は元に戻っている
+    assert (main.encrypt_executor, main.user_id_mapper, main.original_cache) == before
+    assert "get_channel" not in vars(main.client)
+
+    assert json.loads(out.read_text())["config"]["users"] == 3
+    assert report["upload"]["count"] == 2
+    assert report["view_round1"]["count"] >= 6
+    assert report["view_round1"]["p99_ms"] >= report["view_round1"]["p50_ms"]
+    # 二重クリックでも閲覧用メッセージは (スレッド, 閲覧者) ごとに1件
+    assert report["view_messages"] == 6
+    # 2周目は全てキャッシュ済みのメッセージを送り直すだけ
+    assert (
+        report["stages"]["view/cache_hit_send"]["count"]
+        >= report["view_round2"]["count"]
+    )
+
+
+def test_bench_corpus():
+    """形式・色モードの組み合わせでパイプラインを通し、比較で悪化を検出できることを確認。"""
+    import bench_corpus
+
+    config = bench_corpus.CorpusConfig(
+        sizes=(96,), aspects=((4, 3), (9, 16)), formats=("png", "jpeg"), repeats=1
+    )
+    report = bench_corpus.run(config, log=lambda _: None)
+
+    # JPEG は RGBA・P を保存できないので除く（png 4 + jpeg 2）× 縦横比 2
+    assert len(report["cases"]) == 12
+    assert {case["size"] for case in report["cases"]} == {(96, 72), (54, 96)}
+    for case in report["cases"]:
+        assert set(bench_corpus.STAGES) <= set(case["stages"])
+        # 描画は executeEncryption の内訳として実際のステージ名で載る
+        assert "crypt/render_mask" in case["stages"]
+        assert case["stages"]["executeEncryption"]["peak_mb"] >= 0
+
+    assert bench_corpus.compare(report, report) == []
+    faster = copy.deepcopy(report)
+    faster["cases"][0]["stages"]["executeEncryption"]["median_ms"] = 1.0
+    report["cases"][0]["stages"]["executeEncryption"]["median_ms"] = 2.0
+    (regression,) = bench_corpus.compare(faster, report, threshold=0.5)
+    assert regression.stage == "executeEncryption"
+    assert regression.ratio == 2.0
+
+
 def test_rgba_convert():
     """JPEG → RGBA 変換コスト。test.png が既に RGBA の場合は参考値。"""
     im_rgb = Image.open(TEST_IMAGE_PATH).convert("RGB")